@@ -10,6 +10,7 @@ from paramiko.ssh_exception import BadHostKeyException, AuthenticationException,
 from requests.exceptions import ConnectionError
 
 from IpTableController import IpTableController
+import mappingcodec
 
 
 class MTC(Thread):
@@ -30,6 +31,7 @@ class MTC(Thread):
         self.subnetv4 = conf_data["subnetv4"]
         self.subnetv6 = conf_data["subnetv6"]
         self.urls = conf_data["urls"]
+        self.wire_format = conf_data.get("wire_format", "json")
         # controller rest adress : controller subnet
 
         self.hopping_period = conf_data["hopping_period"]
@@ -72,14 +74,18 @@ class MTC(Thread):
                                 if address in IPNetwork(url_assigned_subnet):
                                     #reverse standard
                                     mapping_for_gateway[address] = subnet_map
-                        json_structure = {}
-                        json_structure["lf"] = mapping_for_gateway
-                        json_structure["virtual_subnets"] = self.virtual_subnets
-                        json_mapping = json.dumps(json_structure)
-                        headers = {"Content-Type": "application/json"}
+                        if self.wire_format == "binary":
+                            data = mappingcodec.encode_lf(mapping_for_gateway, self.virtual_subnets)
+                            headers = {"Content-Type": mappingcodec.CONTENT_TYPE}
+                        else:
+                            json_structure = {}
+                            json_structure["lf"] = mapping_for_gateway
+                            json_structure["virtual_subnets"] = self.virtual_subnets
+                            data = json.dumps(json_structure)
+                            headers = {"Content-Type": "application/json"}
                         print("Sending Mapping to: " + url)
                         print(mapping_for_gateway)
-                        r = requests.put(url, data=json_mapping, headers=headers)
+                        r = requests.put(url, data=data, headers=headers)
                         print("Status: " + str(r.status_code))
                     time.sleep(self.hopping_period)
                 except ConnectionError as eC:
@@ -0,0 +1,58 @@
+"""
+Binary format of the LF mapping (see MTG/rest/mappingcodec.py for the complete format)
+
+Used instead of JSON if wire_format is "binary", sent with Content-Type CONTENT_TYPE.
+"""
+import socket
+import struct
+
+CONTENT_TYPE = "application/vnd.openmtd.mapping"
+
+MAGIC = b"MTM\x02"
+
+LF = 1
+VIRTUAL_SUBNETS = 5
+
+_SECTION_HEADER = struct.Struct("!BBBI")
+
+
+def encode_lf(mapping, virtual_subnets):
+    """
+
+    :param mapping: rIP: subnet
+    :param virtual_subnets: list of subnets
+    :return: binary message (bytes)
+    """
+    data = bytearray(MAGIC)
+    _write_section(data, LF, [(_pack(address), _pack_subnet(subnet)) for address, subnet in mapping.items()])
+    _write_section(data, VIRTUAL_SUBNETS, [(_pack_subnet(subnet), b"") for subnet in virtual_subnets])
+    return bytes(data)
+
+
+def _pack(address):
+    if ":" in address:
+        return socket.inet_pton(socket.AF_INET6, address)
+    return socket.inet_pton(socket.AF_INET, address)
+
+
+def _pack_subnet(subnet):
+    (address, _, prefix_length) = subnet.partition("/")
+    address = _pack(address)
+    return address + bytes((int(prefix_length) if prefix_length else 8 * len(address),))
+
+
+def _write_section(data, section, records):
+    # one section per combination of address lengths (without the prefix length)
+    groups = {}
+    for first, second in records:
+        groups.setdefault((len(first), len(second)), []).append(first + second)
+    if not groups:
+        # empty section, the key is kept
+        groups[(5, 0) if section == VIRTUAL_SUBNETS else (4, 5) if section == LF else (4, 4)] = []
+    for (first_length, second_length), group in groups.items():
+        if section == LF:
+            second_length -= 1
+        if section == VIRTUAL_SUBNETS:
+            first_length -= 1
+        data += _SECTION_HEADER.pack(section, first_length, second_length, len(group))
+        data += b"".join(group)
@@ -0,0 +1,125 @@
+"""
+Benchmark of the Port Hopping Functions (run from the MTG directory: python -m benchmark.phfunctions)
+
+For every PH function and keymap size:
+    precompute   time to build the table of one T (all clients of the keymap)
+    table        memory of one table
+    vport/s      translations per second (real_port_to_vport)
+    rport/s      translations per second (virtual_port_to_rport, acceptance window of T-1, T, T+1)
+    batch vport/s, batch rport/s
+                 translations per second of the batch versions (real_ports_to_vports, virtual_ports_to_rports),
+                 only with NumPy
+"""
+import argparse
+import logging
+import random
+import sys
+import time
+
+from InternalLogger.internallogger import InternalLogger
+from controller.helper.address import pack
+from controller.ph_function.phfunctionregistry import PH_FUNCTIONS
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def create_keymap(size, rnd):
+    """
+    :return: Map of IPs (Strings) to PSKs, IPv4 and IPv6 clients
+    """
+    keymap = {}
+    while len(keymap) < size:
+        if rnd.random() < 0.5:
+            ip = "10.%d.%d.%d" % (rnd.randrange(256), rnd.randrange(256), rnd.randrange(1, 255))
+        else:
+            ip = "fc00:0:%x:%x::%x" % (rnd.randrange(65536), rnd.randrange(65536), rnd.randrange(1, 65536))
+        keymap[ip] = "psk-%d" % rnd.randrange(1 << 30)
+    return keymap
+
+
+def benchmark(name, size, packets, hopping_period, rnd):
+    """
+    :return: Dictionary of the results
+    """
+    keymap = create_keymap(size, rnd)
+    ph_function = PH_FUNCTIONS[name](hopping_period, 100, keymap, 1, [80])
+    try:
+        return _measure(ph_function, keymap, packets, rnd)
+    finally:
+        # the precompute thread would rebuild the tables of all clients in the background
+        ph_function.stop()
+
+
+def _measure(ph_function, keymap, packets, rnd):
+    """
+    :return: Dictionary of the results
+    """
+    t = ph_function.get_T()
+
+    # precompute (T + 2 has not been built yet) and memory of one table (the keys are shared with the keymap)
+    start = time.perf_counter()
+    table = ph_function.build_table(t + 2)
+    precompute = time.perf_counter() - start
+    table_bytes = sys.getsizeof(table) + sum(sys.getsizeof(h) for h in table.values() if h > 256)
+    del table
+
+    clients = [(pack(ip), key) for ip, key in keymap.items()]
+    requests = [clients[rnd.randrange(len(clients))] for _ in range(min(packets, 65536))]
+    requests = (requests * (packets // len(requests) + 1))[:packets]
+
+    start = time.perf_counter()
+    for client_ip, key in requests:
+        ph_function.real_port_to_vport(80, client_ip, key)
+    vport_rate = packets / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for client_ip, key in requests:
+        ph_function.virtual_port_to_rport(4711, client_ip, key)
+    rport_rate = packets / (time.perf_counter() - start)
+
+    batch_vport_rate = batch_rport_rate = float("nan")
+    if numpy is not None:
+        client_indices = ph_function.client_indices(client_ip for client_ip, key in requests)
+        r_ports = numpy.full(packets, 80, dtype=numpy.uint16)
+        v_ports = numpy.full(packets, 4711, dtype=numpy.uint16)
+        start = time.perf_counter()
+        ph_function.real_ports_to_vports(r_ports, client_indices)
+        batch_vport_rate = packets / (time.perf_counter() - start)
+        start = time.perf_counter()
+        ph_function.virtual_ports_to_rports(v_ports, client_indices)
+        batch_rport_rate = packets / (time.perf_counter() - start)
+    return {"precompute": precompute, "table_bytes": table_bytes, "vport_rate": vport_rate, "rport_rate": rport_rate,
+            "batch_vport_rate": batch_vport_rate, "batch_rport_rate": batch_rport_rate}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the Port Hopping Functions")
+    parser.add_argument("--functions", default="rpah,siphash,aes_ctr", help="comma separated PH functions")
+    parser.add_argument("--sizes", default="10,100,1000,10000,100000", help="comma separated keymap sizes")
+    parser.add_argument("--packets", type=int, default=200000, help="translations per measurement")
+    parser.add_argument("--hopping-period", type=float, default=20, help="hopping period in seconds")
+    args = parser.parse_args()
+
+    InternalLogger.init(False, False)
+    # only the result table is printed
+    InternalLogger.get().setLevel(logging.WARNING)
+    rnd = random.Random(1)
+    print("%-10s %8s %14s %14s %14s %14s %14s %14s" % ("function", "clients", "precompute [s]", "table [bytes]",
+                                                      "vport/s", "rport/s", "batch vport/s", "batch rport/s"))
+    for name in args.functions.split(","):
+        for size in (int(size) for size in args.sizes.split(",")):
+            try:
+                result = benchmark(name, size, args.packets, args.hopping_period, rnd)
+            except ImportError as e:
+                print("%-10s skipped: %s" % (name, e))
+                break
+            print("%-10s %8d %14.4f %14d %14.0f %14.0f %14.0f %14.0f" % (
+                name, size, result["precompute"], result["table_bytes"], result["vport_rate"], result["rport_rate"],
+                result["batch_vport_rate"], result["batch_rport_rate"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,16 @@
+from array import array
+from threading import Lock
+
 from InternalLogger.internallogger import InternalLogger
 
 
 class DynamicPortPriority:
     """
     Dynamic Port Priority
+
+    The block value of every port is precomputed. The tracker reports active rPorts (port_activated / port_deactivated),
+    the number of active ports per block value is counted, so the highest block value is known without searching
+    the tracked connections.
     """
     def __init__(self, continue_list, priority_list, priority_definition,  continue_all, nas_connection_tracker):
         self._continue_list = continue_list
@@ -14,6 +21,19 @@ class DynamicPortPriority:
 
         self._shuffling_blocked_count = 0
 
+        # port: block value
+        self._block_values = array("i", bytes(4 * 65536))
+        for port, priority in priority_list.items():
+            priority_block_value = priority_definition.get(priority)
+            if priority_block_value is None:
+                InternalLogger.get().error("No Priority definition found for " + str(priority))
+            else:
+                self._block_values[int(port)] = priority_block_value
+        # block value: number of active ports
+        self._active_block_values = {}
+        self._max_block_value = 0
+        self._lock = Lock()
+
     def allow_continue(self, port):
         """
         Check if Connection is allowed to continue based on connection tracking
@@ -25,6 +45,48 @@ class DynamicPortPriority:
             return True
         return port in self._continue_list
 
+    def port_priority(self, port):
+        """
+        Priority of a connection based on its rPort (block value of the priority class)
+
+        :param port: rPort of the destination
+        :returns Int (0 if the port has no priority)
+        """
+        return self._block_values[port]
+
+    def port_activated(self, port):
+        """
+        rPort is used by the first tracked connection (called by the tracker)
+
+        :param port: rPort of the destination
+        """
+        block_value = self._block_values[port]
+        if block_value <= 0:
+            return
+        with self._lock:
+            self._active_block_values[block_value] = self._active_block_values.get(block_value, 0) + 1
+            if block_value > self._max_block_value:
+                self._max_block_value = block_value
+
+    def port_deactivated(self, port):
+        """
+        rPort is not used by any tracked connection anymore (called by the tracker)
+
+        :param port: rPort of the destination
+        """
+        block_value = self._block_values[port]
+        if block_value <= 0:
+            return
+        with self._lock:
+            count = self._active_block_values[block_value] - 1
+            if count > 0:
+                self._active_block_values[block_value] = count
+            else:
+                del self._active_block_values[block_value]
+                if block_value == self._max_block_value:
+                    # at most one entry per priority class
+                    self._max_block_value = max(self._active_block_values, default=0)
+
     def block_hf_shuffling(self):
         """
         Check if HF Shuffling should be blocked
@@ -35,19 +97,7 @@ class DynamicPortPriority:
             #Dont need to block
             return False
 
-        active_ports = self._nas_connection_tracker.get_active_ports()
-        block_value = 0
-        for port in active_ports:
-            priority = self._priority_list.get(str(port))
-            if priority is None:
-                InternalLogger.get().debug("No Priority found for port " + str(port))
-            else:
-                priority_block_value = self._priority_definition.get(priority)
-                if priority_block_value is None:
-                    InternalLogger.get().error("No Priority definition found for " + str(priority))
-                else:
-                    if priority_block_value > block_value:
-                        block_value = priority_block_value
+        block_value = self._max_block_value
         InternalLogger.get().debug("Highest Priority Block Value: " + str(block_value))
         block = self._shuffling_blocked_count < block_value
         if block:
@@ -56,4 +106,4 @@ class DynamicPortPriority:
         else:
             InternalLogger.get().debug("DynPort NOT Blocking (count = " + str(self._shuffling_blocked_count) + ")")
             self._shuffling_blocked_count = 0
-        return block
\ No newline at end of file
+        return block
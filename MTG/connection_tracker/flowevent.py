@@ -0,0 +1,58 @@
+import time
+
+from controller.helper.address import unpack
+
+
+class FlowEvent:
+    """
+    Immutable summary of a TCP packet for the connection trackers
+    (trackers do not need the packet itself, copying it would be expensive)
+
+    :param src: Source IP-Address (packed)
+    :param sport: Source Port
+    :param dst: Destination IP-Address (packed)
+    :param dport: Destination Port
+    :param flags: TCP flags (Int)
+    :param io: Input or Output
+    :param timestamp: time of the packet (time.monotonic())
+    """
+    __slots__ = ("src", "sport", "dst", "dport", "flags", "io", "timestamp")
+
+    def __init__(self, src, sport, dst, dport, flags, io, timestamp):
+        object.__setattr__(self, "src", src)
+        object.__setattr__(self, "sport", sport)
+        object.__setattr__(self, "dst", dst)
+        object.__setattr__(self, "dport", dport)
+        object.__setattr__(self, "flags", flags)
+        object.__setattr__(self, "io", io)
+        object.__setattr__(self, "timestamp", timestamp)
+
+    @staticmethod
+    def from_packet(packet, io):
+        """
+        :param packet: IPv4 / IPv6 Packet (PacketView) with TCP Payload
+        :param io: Input or Output
+        :return: FlowEvent (the event of the FusedTranslator if it has translated the packet)
+        """
+        if packet.flow_event is not None:
+            return packet.flow_event
+        return FlowEvent(packet.src, packet.sport, packet.dst, packet.dport, packet.flags, io, time.monotonic())
+
+    def is_tcp(self):
+        """
+        :return: True, flow events are only created for TCP packets (same interface as PacketView)
+        """
+        return True
+
+    def __setattr__(self, name, value):
+        raise AttributeError("FlowEvent is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("FlowEvent is immutable")
+
+    def __reduce__(self):
+        return FlowEvent, (self.src, self.sport, self.dst, self.dport, self.flags, self.io, self.timestamp)
+
+    def __str__(self):
+        return unpack(self.src) + ":" + str(self.sport) + " -> " + unpack(self.dst) + ":" + str(self.dport) \
+               + " (flags " + str(self.flags) + ", " + str(self.io) + ")"
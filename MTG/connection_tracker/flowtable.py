@@ -0,0 +1,615 @@
+import math
+import time
+from array import array
+from threading import Lock
+
+from InternalLogger.internallogger import InternalLogger
+from connection_tracker.timerwheel import TimerWheel
+
+# Connection states (keys of the idle timeouts)
+STATE_SYN = "syn"
+STATE_ESTABLISHED = "established"
+STATE_FIN = "fin"
+STATE_HONEYPOT = "honeypot"
+_STATES = (STATE_SYN, STATE_ESTABLISHED, STATE_FIN, STATE_HONEYPOT)
+
+# Number of connections checked by the CLOCK hand to find the least important connection
+EVICTION_WINDOW = 8
+
+# Shards are oversized by this factor, so uneven hashing does not evict connections before the table is full
+SHARD_SLACK = 1.25
+
+# Record flags, bits 5-6: state
+_USED = 0x01
+_FIN = 0x02
+_ENFORCED = 0x04
+_REFERENCED = 0x08
+_V6 = 0x10
+_STATE_SHIFT = 5
+_STATE_MASK = 0x60
+
+# Record layout of the addresses: client IP, dest_vIP, rIP (16 bytes each, IPv4 as IPv4-mapped IPv6 address)
+_ADDRESS_SIZE = 16
+_RECORD_ADDRESSES = 3 * _ADDRESS_SIZE
+_V4_PREFIX = b"\x00" * 10 + b"\xff\xff"
+
+_EMPTY = -1
+
+
+def _pack(address):
+    """
+    :param address: packed IPv4 / IPv6 address (4 / 16 bytes)
+    :return: 16 bytes
+    """
+    if len(address) == 4:
+        return _V4_PREFIX + address
+    return address
+
+
+def _unpack(packed, v6):
+    """
+    :param packed: 16 bytes
+    :param v6: IPv6 address
+    :return: packed IPv4 / IPv6 address (4 / 16 bytes)
+    """
+    if v6:
+        return packed
+    return packed[12:]
+
+
+class _FlowShard:
+    """
+    Part of the FlowTable with its own lock, connections are stored as records in preallocated arrays
+
+    Record i: addresses[48i:48i+48] (client IP, dest_vIP, rIP), ports[2i] (client port), ports[2i+1] (dest_rPort),
+    flags[i], last_seen[i], deadline[i] (deadline of the current timer, older timers are ignored)
+    index: open addressing (linear probing) table of the records by (sourceIP, sourcePort, dest_vIP, dest_rPort)
+    reverse: open addressing table by (rIP, dest_rPort, sourceIP, sourcePort), it contains the most recent record,
+    older records with the same reverse key are linked by reverse_next
+    The record slots are the CLOCK, hand is the position of the CLOCK hand
+    """
+    __slots__ = ("lock", "capacity", "mask", "addresses", "ports", "flags", "last_seen", "deadline", "key_hash",
+                 "reverse_hash", "reverse_next", "index", "reverse", "free", "hand", "wheel")
+
+    def __init__(self, capacity, wheel):
+        self.lock = Lock()
+        self.capacity = capacity
+        # load factor <= 0.5
+        table_size = 1 << (2 * capacity - 1).bit_length()
+        self.mask = table_size - 1
+        self.addresses = bytearray(capacity * _RECORD_ADDRESSES)
+        self.ports = array("H", bytes(4 * capacity))
+        self.flags = bytearray(capacity)
+        self.last_seen = array("d", bytes(8 * capacity))
+        self.deadline = array("d", [math.inf]) * capacity
+        self.key_hash = array("q", bytes(8 * capacity))
+        self.reverse_hash = array("q", bytes(8 * capacity))
+        self.reverse_next = array("i", [_EMPTY]) * capacity
+        self.index = array("i", [_EMPTY]) * table_size
+        self.reverse = array("i", [_EMPTY]) * table_size
+        self.free = array("i", range(capacity - 1, -1, -1))
+        self.hand = 0
+        self.wheel = wheel
+
+    def __len__(self):
+        return self.capacity - len(self.free)
+
+    def find(self, key_hash, client, client_port, v_ip, dest_port):
+        """
+        :return: position in the index or _EMPTY
+        """
+        position = key_hash & self.mask
+        while True:
+            record = self.index[position]
+            if record == _EMPTY:
+                return _EMPTY
+            if (self.key_hash[record] == key_hash and self.ports[2 * record] == client_port
+                    and self.ports[2 * record + 1] == dest_port):
+                offset = record * _RECORD_ADDRESSES
+                if (self.addresses[offset:offset + _ADDRESS_SIZE] == client
+                        and self.addresses[offset + _ADDRESS_SIZE:offset + 2 * _ADDRESS_SIZE] == v_ip):
+                    return position
+            position = (position + 1) & self.mask
+
+    def find_reverse(self, reverse_hash, r_ip, dest_port, client, client_port):
+        """
+        :return: position in the reverse table or _EMPTY
+        """
+        position = reverse_hash & self.mask
+        while True:
+            record = self.reverse[position]
+            if record == _EMPTY:
+                return _EMPTY
+            if (self.reverse_hash[record] == reverse_hash and self.ports[2 * record] == client_port
+                    and self.ports[2 * record + 1] == dest_port):
+                offset = record * _RECORD_ADDRESSES
+                if (self.addresses[offset:offset + _ADDRESS_SIZE] == client
+                        and self.addresses[offset + 2 * _ADDRESS_SIZE:offset + _RECORD_ADDRESSES] == r_ip):
+                    return position
+            position = (position + 1) & self.mask
+
+    def insert(self, key_hash, reverse_hash, client, client_port, v_ip, dest_port, r_ip, flags, timestamp):
+        """
+        Store a new record (the shard must not be full)
+
+        :return: record
+        """
+        record = self.free.pop()
+        offset = record * _RECORD_ADDRESSES
+        self.addresses[offset:offset + _RECORD_ADDRESSES] = client + v_ip + r_ip
+        self.ports[2 * record] = client_port
+        self.ports[2 * record + 1] = dest_port
+        self.flags[record] = flags | _USED
+        self.last_seen[record] = timestamp
+        self.deadline[record] = math.inf
+        self.key_hash[record] = key_hash
+        self.reverse_hash[record] = reverse_hash
+        position = key_hash & self.mask
+        while self.index[position] != _EMPTY:
+            position = (position + 1) & self.mask
+        self.index[position] = record
+        # most recent record of the reverse key first
+        position = self.find_reverse(reverse_hash, r_ip, dest_port, client, client_port)
+        if position == _EMPTY:
+            self.reverse_next[record] = _EMPTY
+            position = reverse_hash & self.mask
+            while self.reverse[position] != _EMPTY:
+                position = (position + 1) & self.mask
+        else:
+            self.reverse_next[record] = self.reverse[position]
+        self.reverse[position] = record
+        return record
+
+    def delete(self, position):
+        """
+        Remove the record at the position of the index
+        """
+        record = self.index[position]
+        self._remove_position(self.index, self.key_hash, position)
+        offset = record * _RECORD_ADDRESSES
+        reverse_position = self.find_reverse(self.reverse_hash[record],
+                                             self.addresses[offset + 2 * _ADDRESS_SIZE:offset + _RECORD_ADDRESSES],
+                                             self.ports[2 * record + 1], self.addresses[offset:offset + _ADDRESS_SIZE],
+                                             self.ports[2 * record])
+        head = self.reverse[reverse_position]
+        if head == record:
+            if self.reverse_next[record] == _EMPTY:
+                self._remove_position(self.reverse, self.reverse_hash, reverse_position)
+            else:
+                self.reverse[reverse_position] = self.reverse_next[record]
+        else:
+            while self.reverse_next[head] != record:
+                head = self.reverse_next[head]
+            self.reverse_next[head] = self.reverse_next[record]
+        self.flags[record] = 0
+        self.deadline[record] = math.inf
+        self.free.append(record)
+
+    def _remove_position(self, table, hashes, position):
+        """
+        Backward shift deletion (linear probing without tombstones)
+        """
+        current = position
+        while True:
+            current = (current + 1) & self.mask
+            record = table[current]
+            if record == _EMPTY:
+                break
+            home = hashes[record] & self.mask
+            # the record stays, if its home position is (cyclically) in (position, current]
+            if position <= current:
+                stays = position < home <= current
+            else:
+                stays = home > position or home <= current
+            if not stays:
+                table[position] = record
+                position = current
+        table[position] = _EMPTY
+
+    def position_of(self, record):
+        """
+        :return: position of a record in the index
+        """
+        position = self.key_hash[record] & self.mask
+        while self.index[position] != record:
+            position = (position + 1) & self.mask
+        return position
+
+    def key(self, record):
+        """
+        :return: (sourceIP, sourcePort, dest_vIP, dest_rPort)
+        """
+        v6 = self.flags[record] & _V6
+        offset = record * _RECORD_ADDRESSES
+        return (_unpack(bytes(self.addresses[offset:offset + _ADDRESS_SIZE]), v6), self.ports[2 * record],
+                _unpack(bytes(self.addresses[offset + _ADDRESS_SIZE:offset + 2 * _ADDRESS_SIZE]), v6),
+                self.ports[2 * record + 1])
+
+    def value(self, record):
+        """
+        :return: (FIN, rIP, enforced)
+        """
+        flags = self.flags[record]
+        offset = record * _RECORD_ADDRESSES + 2 * _ADDRESS_SIZE
+        return (bool(flags & _FIN), _unpack(bytes(self.addresses[offset:offset + _ADDRESS_SIZE]), flags & _V6),
+                bool(flags & _ENFORCED))
+
+    def state(self, record):
+        return (self.flags[record] & _STATE_MASK) >> _STATE_SHIFT
+
+    def set_state(self, record, state):
+        self.flags[record] = (self.flags[record] & ~_STATE_MASK) | (state << _STATE_SHIFT)
+
+    def nbytes(self):
+        """
+        :return: size of the arrays in bytes
+        """
+        return sum(len(data) * data.itemsize if isinstance(data, array) else len(data)
+                   for data in (self.addresses, self.ports, self.flags, self.last_seen, self.deadline, self.key_hash,
+                                self.reverse_hash, self.reverse_next, self.index, self.reverse, self.free))
+
+
+class FlowTable:
+    """
+    Table of tracked connections, partitioned into shards
+
+    A connection and its reverse index entry are stored in the same shard (selected by the hash of the client endpoint),
+    so every operation locks exactly one shard. Lookups only set a reference bit instead of reordering the table.
+    A full shard evicts the least important connection (not enforced, lowest port priority, not referenced)
+    of the next EVICTION_WINDOW connections of the CLOCK hand. Every shard holds capacity * SHARD_SLACK / shards
+    connections, so up to capacity * SHARD_SLACK connections are tracked if they are distributed evenly.
+    Idle connections expire by the timeout of their state (hierarchical timer wheel per shard).
+    Connections are stored in preallocated arrays (packed addresses, uint16 ports, flags), the memory usage is fixed
+    by the capacity (see memory_usage). Addresses are packed (see controller.helper.address).
+
+    :param capacity: maximum number of connections
+    :param shards: number of shards
+    :param timeouts: idle timeouts per state in seconds ({"syn": .., "established": .., "fin": .., "honeypot": ..})
+     or None (connections dont expire)
+    :param priority: function, port priority of a dest_rPort (connections with lower priority are evicted first)
+    """
+    def __init__(self, capacity, shards=16, timeouts=None, priority=None):
+        shard_capacity = max(1, math.ceil(capacity * SHARD_SLACK / shards))
+        self._timeouts = None if timeouts is None else tuple(timeouts[state] for state in _STATES)
+        self._priority = priority
+        # number of connections per dest_rPort
+        self._port_counts = array("I", bytes(4 * 65536))
+        self._active_ports = set()
+        self._port_listener = None
+        self._port_lock = Lock()
+        # keys of changed connections (see record_changes) or None
+        self._changes = None
+        self._changes_lock = Lock()
+        self._shards = [_FlowShard(shard_capacity, self._create_wheel()) for _ in range(shards)]
+
+    def _create_wheel(self):
+        return TimerWheel(time.monotonic()) if self._timeouts is not None else None
+
+    def set_priority(self, priority):
+        """
+        :param priority: function, port priority of a dest_rPort
+        """
+        self._priority = priority
+
+    def set_port_listener(self, port_listener, report=True):
+        """
+        :param port_listener: notified if a dest_rPort is used by the first connection (port_activated(port))
+         or not used anymore (port_deactivated(port)), None: remove the listener
+        :param report: report the currently active ports immediately
+        """
+        with self._port_lock:
+            self._port_listener = port_listener
+            if port_listener is not None and report:
+                for port in self._active_ports:
+                    port_listener.port_activated(port)
+
+    def record_changes(self):
+        """
+        Record the keys of inserted, changed and removed connections (see pop_changes)
+        """
+        with self._changes_lock:
+            if self._changes is None:
+                self._changes = set()
+
+    def pop_changes(self):
+        """
+        :return: Set of keys (sourceIP, sourcePort, dest_vIP, dest_rPort) of the connections changed since the last call
+        """
+        with self._changes_lock:
+            changes = self._changes
+            if changes is not None:
+                self._changes = set()
+            return changes or set()
+
+    def _changed(self, packet_data):
+        if self._changes is not None:
+            with self._changes_lock:
+                self._changes.add(packet_data)
+
+    def active_ports(self):
+        """
+        :return: List of dest_rPorts used by at least one connection
+        """
+        with self._port_lock:
+            return list(self._active_ports)
+
+    def _port_added(self, port):
+        with self._port_lock:
+            self._port_counts[port] += 1
+            if self._port_counts[port] == 1:
+                self._active_ports.add(port)
+                if self._port_listener is not None:
+                    self._port_listener.port_activated(port)
+
+    def _port_removed(self, port):
+        with self._port_lock:
+            self._port_counts[port] -= 1
+            if self._port_counts[port] == 0:
+                self._active_ports.discard(port)
+                if self._port_listener is not None:
+                    self._port_listener.port_deactivated(port)
+
+    def _shard(self, client, client_port):
+        return self._shards[hash((client, client_port)) % len(self._shards)]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def _lookup(self, packet_data):
+        """
+        :return: (shard, key hash, client, v_ip), shard is not locked
+        """
+        (src, sport, dst, dport) = packet_data
+        client = _pack(src)
+        v_ip = _pack(dst)
+        return self._shard(client, sport), hash((client, sport, v_ip, dport)), client, v_ip
+
+    def get(self, packet_data):
+        """
+        :param packet_data: (sourceIP, sourcePort, dest_vIP, dest_rPort)
+        :return: (FIN, rIP, enforced) or None
+        """
+        (shard, key_hash, client, v_ip) = self._lookup(packet_data)
+        with shard.lock:
+            position = shard.find(key_hash, client, packet_data[1], v_ip, packet_data[3])
+            if position == _EMPTY:
+                return None
+            record = shard.index[position]
+            shard.flags[record] |= _REFERENCED
+            return shard.value(record)
+
+    def peek(self, packet_data):
+        """
+        Same as get without marking the connection as referenced (eviction)
+
+        :param packet_data: (sourceIP, sourcePort, dest_vIP, dest_rPort)
+        :return: (FIN, rIP, enforced) or None
+        """
+        (shard, key_hash, client, v_ip) = self._lookup(packet_data)
+        with shard.lock:
+            position = shard.find(key_hash, client, packet_data[1], v_ip, packet_data[3])
+            if position == _EMPTY:
+                return None
+            return shard.value(shard.index[position])
+
+    def get_reverse(self, reverse_key):
+        """
+        Search a connection by the leaving packet
+
+        :param reverse_key: (rIP, dest_rPort, sourceIP, sourcePort)
+        :return: ((sourceIP, sourcePort, dest_vIP, dest_rPort), (FIN, rIP, enforced)) of the most recent connection or None
+        """
+        (r_ip, dport, src, sport) = reverse_key
+        r_ip = _pack(r_ip)
+        client = _pack(src)
+        shard = self._shard(client, sport)
+        with shard.lock:
+            position = shard.find_reverse(hash((r_ip, dport, client, sport)), r_ip, dport, client, sport)
+            if position == _EMPTY:
+                return None
+            record = shard.reverse[position]
+            shard.flags[record] |= _REFERENCED
+            return shard.key(record), shard.value(record)
+
+    def put(self, packet_data, value, only_new=False, state=STATE_SYN, timestamp=None):
+        """
+        Insert or replace a connection
+
+        :param packet_data: (sourceIP, sourcePort, dest_vIP, dest_rPort)
+        :param value: (FIN, rIP, enforced)
+        :param only_new: dont replace an existing connection
+        :param state: connection state
+        :param timestamp: time of the packet (default: now)
+        :return: connection has been inserted / replaced
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+        (shard, key_hash, client, v_ip) = self._lookup(packet_data)
+        (fin, r_ip, enforced) = value
+        r_ip_packed = _pack(r_ip)
+        (src, sport, dst, dport) = packet_data
+        flags = (_FIN if fin else 0) | (_ENFORCED if enforced else 0) | (_V6 if len(src) == 16 else 0) \
+            | (_STATES.index(state) << _STATE_SHIFT)
+        with shard.lock:
+            position = shard.find(key_hash, client, sport, v_ip, dport)
+            if position != _EMPTY:
+                if only_new:
+                    return False
+                # same dest_rPort, the port count does not change
+                shard.delete(position)
+            else:
+                if len(shard.free) == 0:
+                    self._evict(shard)
+                self._port_added(dport)
+            record = shard.insert(key_hash, hash((r_ip_packed, dport, client, sport)), client, sport, v_ip, dport,
+                                  r_ip_packed, flags, timestamp)
+            self._schedule(shard, record)
+            self._changed(packet_data)
+            return True
+
+    def touch(self, packet_data, timestamp, established=False):
+        """
+        Packet of a connection has been seen (resets the idle timeout)
+
+        :param packet_data: (sourceIP, sourcePort, dest_vIP, dest_rPort)
+        :param timestamp: time of the packet
+        :param established: connection has been established (SYN state changes to established)
+        :return: connection found
+        """
+        (shard, key_hash, client, v_ip) = self._lookup(packet_data)
+        with shard.lock:
+            position = shard.find(key_hash, client, packet_data[1], v_ip, packet_data[3])
+            if position == _EMPTY:
+                return False
+            record = shard.index[position]
+            shard.last_seen[record] = max(shard.last_seen[record], timestamp)
+            if established and shard.state(record) == _STATES.index(STATE_SYN):
+                shard.set_state(record, _STATES.index(STATE_ESTABLISHED))
+            return True
+
+    def set_fin(self, packet_data, timestamp=None):
+        """
+        Mark a connection as closing (FIN or RST received)
+
+        :param packet_data: (sourceIP, sourcePort, dest_vIP, dest_rPort)
+        :param timestamp: time of the packet (default: now)
+        :return: connection found
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+        (shard, key_hash, client, v_ip) = self._lookup(packet_data)
+        with shard.lock:
+            position = shard.find(key_hash, client, packet_data[1], v_ip, packet_data[3])
+            if position == _EMPTY:
+                return False
+            record = shard.index[position]
+            shard.flags[record] |= _FIN
+            shard.set_state(record, _STATES.index(STATE_FIN))
+            self._changed(packet_data)
+            shard.last_seen[record] = max(shard.last_seen[record], timestamp)
+            # the closing timeout may be shorter than the current timer
+            self._schedule(shard, record)
+            return True
+
+    def remove(self, packet_data, only_fin=False):
+        """
+        Remove a connection
+
+        :param packet_data: (sourceIP, sourcePort, dest_vIP, dest_rPort)
+        :param only_fin: only remove the connection if FIN has been received
+        :return: removed value (FIN, rIP, enforced) or None
+        """
+        (shard, key_hash, client, v_ip) = self._lookup(packet_data)
+        with shard.lock:
+            position = shard.find(key_hash, client, packet_data[1], v_ip, packet_data[3])
+            if position == _EMPTY:
+                return None
+            record = shard.index[position]
+            if only_fin and not shard.flags[record] & _FIN:
+                return None
+            value = shard.value(record)
+            shard.delete(position)
+            self._port_removed(packet_data[3])
+            self._changed(packet_data)
+            return value
+
+    def expire(self, now=None):
+        """
+        Remove connections which have been idle longer than the timeout of their state
+
+        :param now: current time (default: now)
+        :return: number of removed connections
+        """
+        if self._timeouts is None:
+            return 0
+        if now is None:
+            now = time.monotonic()
+        expired = 0
+        for shard in self._shards:
+            with shard.lock:
+                for (record, deadline) in shard.wheel.advance(now):
+                    if not shard.flags[record] & _USED or shard.deadline[record] != deadline:
+                        # outdated timer
+                        continue
+                    shard.deadline[record] = math.inf
+                    if shard.last_seen[record] + self._timeouts[shard.state(record)] <= now:
+                        self._changed(shard.key(record))
+                        shard.delete(shard.position_of(record))
+                        self._port_removed(shard.ports[2 * record + 1])
+                        expired += 1
+                    else:
+                        self._schedule(shard, record)
+        if expired > 0:
+            InternalLogger.get().debug("Expired " + str(expired) + " idle connections")
+        return expired
+
+    def items(self):
+        """
+        Copy of all connections (not ordered by recency)
+
+        :return: List of (key, (FIN, rIP, enforced))
+        """
+        items = []
+        for shard in self._shards:
+            with shard.lock:
+                items.extend((shard.key(record), shard.value(record))
+                             for record in range(shard.capacity) if shard.flags[record] & _USED)
+        return items
+
+    def clear(self):
+        """
+        Remove all connections
+        """
+        for (i, shard) in enumerate(self._shards):
+            with shard.lock:
+                for record in range(shard.capacity):
+                    if shard.flags[record] & _USED:
+                        self._port_removed(shard.ports[2 * record + 1])
+                        self._changed(shard.key(record))
+                self._shards[i] = _FlowShard(shard.capacity, self._create_wheel())
+
+    def memory_usage(self):
+        """
+        Memory usage of the connection records and index tables (without timers of the timer wheels)
+
+        :return: {"capacity": .., "connections": .., "bytes": .., "bytes_per_connection": ..}
+        """
+        capacity = sum(shard.capacity for shard in self._shards)
+        nbytes = sum(shard.nbytes() for shard in self._shards)
+        return {"capacity": capacity, "connections": len(self), "bytes": nbytes,
+                "bytes_per_connection": nbytes / capacity}
+
+    def _schedule(self, shard, record):
+        """
+        Start the idle timer of a connection, if it ends before the current timer
+        """
+        if shard.wheel is None:
+            return
+        deadline = shard.last_seen[record] + self._timeouts[shard.state(record)]
+        if deadline < shard.deadline[record]:
+            shard.deadline[record] = deadline
+            shard.wheel.schedule((record, deadline), deadline)
+
+    def _evict(self, shard):
+        """
+        CLOCK: the hand passes EVICTION_WINDOW connections and clears their reference bits,
+        the least important one is removed (the shard is full)
+        """
+        victim = _EMPTY
+        victim_rank = None
+        for _ in range(min(EVICTION_WINDOW, shard.capacity)):
+            record = shard.hand
+            shard.hand = (shard.hand + 1) % shard.capacity
+            flags = shard.flags[record]
+            priority = self._priority(shard.ports[2 * record + 1]) if self._priority is not None else 0
+            rank = (bool(flags & _ENFORCED), priority, bool(flags & _REFERENCED))
+            shard.flags[record] = flags & ~_REFERENCED
+            if victim == _EMPTY or rank < victim_rank:
+                victim = record
+                victim_rank = rank
+                if rank == (False, 0, False):
+                    break
+        InternalLogger.get().debug("Removing element from buffer")
+        self._changed(shard.key(victim))
+        shard.delete(shard.position_of(victim))
+        self._port_removed(shard.ports[2 * victim + 1])
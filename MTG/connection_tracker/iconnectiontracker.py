@@ -6,7 +6,29 @@ class IConnectionTracker():
     def track_connection(self, packet, io):
         """
         :param io: Packet incoming or leaving?
-        :param packet: IP/Ipv6 Scapy Package
+        :param packet: FlowEvent of a TCP packet (or IP/Ipv6 Packet (PacketView))
+        """
+        pass
+
+    def is_inline(self):
+        """
+        Should track_connection be called synchronously on the packet thread (otherwise it is called asynchronously)
+        :rtype: Boolean
+        """
+        return False
+
+    def set_port_priority(self, port_priority):
+        """
+        Priority of the connections by their dest_rPort (connections with low priority are evicted first)
+        :param port_priority: function, priority of a dest_rPort
+        """
+        pass
+
+    def set_port_listener(self, port_listener):
+        """
+        Notify a listener about used rPorts (e.g. DynamicPortPriority)
+        :param port_listener: port_activated(port) if a rPort is used by the first connection,
+         port_deactivated(port) if it is not used anymore
         """
         pass
 
@@ -16,7 +38,7 @@ class IConnectionTracker():
         Add connection information for connection which should be generated in other components
 
         :param sourcePort: Source Port
-        :param sourceIP: Source IP-Address
+        :param sourceIP: Source IP-Address (packed, see controller.helper.address)
         :param dest_rPort: Destination virtual Port
         :param dest_vIP:  Destination virtual IP-Address
         :param dest_rIP: Destination real IP-Address
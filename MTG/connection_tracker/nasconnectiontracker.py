@@ -1,34 +1,86 @@
 
-from collections import OrderedDict
-
-from scapy.layers.inet import TCP
+import time
+from threading import Thread
 
 from InternalLogger.internallogger import InternalLogger
+from connection_tracker.flowevent import FlowEvent
+from connection_tracker.flowtable import FlowTable, STATE_SYN, STATE_ESTABLISHED, STATE_FIN, STATE_HONEYPOT
 from connection_tracker.iconnectiontracker import IConnectionTracker
+from controller.helper.address import unpack
+from controller.helper.packetview import TCP_SYN, TCP_FIN, TCP_RST, TCP_ACK
 from controller.itranslator import IO
-from readerwriterlock import rwlock
 
 
 class NasConnectionTracker(IConnectionTracker):
     """
     Tracker for Network Address Shuffling
+
+    :param inline: track_connection is called synchronously on the packet threads (SYN/FIN/ACK state changes are applied
+     before the packet is forwarded)
+    :param capacity: maximum number of tracked connections
+    :param timeouts: idle timeouts per state in seconds (see DEFAULT_TIMEOUTS) or None (connections only expire
+     after FIN + ACK or by eviction), idle connections are removed by a background thread
+    :param shards: number of shards of the connection table (each one has its own lock)
     """
-    def __init__(self):
-        self._connection_buffer = OrderedDict([])
+    DEFAULT_TIMEOUTS = {STATE_SYN: 60, STATE_ESTABLISHED: 3600, STATE_FIN: 60, STATE_HONEYPOT: 600}
+
+    def __init__(self, inline=False, capacity=1000, timeouts=None, shards=16):
+        self._connection_buffer = FlowTable(capacity, shards, timeouts)
         '''
         Buffer Structure:
         (sourceIP, sourcePort, dest_vIP, dest_rPort): (FIN (Flag received), rIP, enforced (should be used to continue connection))
         enforced: Tell other modules that this connection should be kept alive (even if other security measures prohibit it)
+        Leaving packets are searched with the reverse index of the table:
+        (rIP, dest_rPort, sourceIP, sourcePort): most recent connection
         '''
-        self._max_buffer = 1000
         self._mapping = None
-        #Write Priority Lock
-        self._lock = rwlock.RWLockWrite()
+        self._inline = inline
+        self._expired = 0
+        memory_usage = self.memory_usage()
+        InternalLogger.get().debug("Connection buffer: capacity " + str(memory_usage["capacity"]) + ", "
+                                   + str(memory_usage["bytes"]) + " bytes")
+        if timeouts is not None:
+            Thread(target=self._run_expiry, daemon=True).start()
+
+    def is_inline(self):
+        """
+        :return: Tracker should be called synchronously on the packet threads
+        """
+        return self._inline
+
+    @property
+    def expired(self):
+        """
+        :return: number of connections removed by the idle timeouts
+        """
+        return self._expired
+
+    def memory_usage(self):
+        """
+        Memory usage of the connection buffer (preallocated for the capacity)
+        :return: {"capacity": .., "connections": .., "bytes": .., "bytes_per_connection": ..}
+        """
+        return self._connection_buffer.memory_usage()
+
+    def set_port_priority(self, port_priority):
+        """
+        Connections to ports with low priority are evicted first if the buffer is full
+        :param port_priority: function, priority of a dest_rPort
+        """
+        self._connection_buffer.set_priority(port_priority)
+
+    def set_port_listener(self, port_listener, report=True):
+        """
+        :param port_listener: notified if a rPort is used by the first connection or not used anymore
+         (port_activated(port), port_deactivated(port)), None: remove the listener
+        :param report: report the currently active ports immediately
+        """
+        self._connection_buffer.set_port_listener(port_listener, report)
 
     def set_mapping(self, mapping):
         """
         Change Mapping (HF)
-        :param mapping:
+        :param mapping: vIP: rIP (packed addresses, index of a MappingSnapshot, read with get)
         """
         self._mapping = mapping
 
@@ -36,13 +88,13 @@ class NasConnectionTracker(IConnectionTracker):
         """
         Search in NAS Track Buffer
 
-        :param packet: IPv4 / IPv6 Packet
+        :param packet: IPv4 / IPv6 Packet (PacketView) or FlowEvent
         :param io: Input/Output
         :return: (rIP or None if no rIP has been found, enforced)
         """
         InternalLogger.get().debug("Searching for connection in buffer")
-        if packet.haslayer(TCP):
-            tcp = packet[TCP]
+        if packet.is_tcp():
+            tcp = packet
             if len(self._connection_buffer) > 0:
                 #Check for incoming packets
                 if io == IO.INPUT:
@@ -50,137 +102,161 @@ class NasConnectionTracker(IConnectionTracker):
 
                     packet_data = (packet.src, tcp.sport, packet.dst, tcp.dport)
                     InternalLogger.get().debug("Searching in Buffer for: " + str(packet_data))
-                    with self._lock.gen_rlock():
-                        result = self._connection_buffer.get(packet_data)
+                    result = self._connection_buffer.get(packet_data)
                     if result is not None:
                         (fin, ip, enforced) = result
                         InternalLogger.get().debug("Found mapping in buffer")
-                        with self._lock.gen_wlock():
-                            self._connection_buffer.move_to_end(packet_data, last=False)
                         return (ip, enforced)
                     else:
                         InternalLogger.get().debug("Connection not found")
                 else:
                     #Check for leaving packet
-                    InternalLogger.get().debug("Searching in Buffer for: " + str(packet.src))
-                    result_dst = None
-                    result_packet_data = None
-                    with self._lock.gen_rlock():
-                        #check connections in order
-                        #old connections with similar tuple will not be used because of the order
-                        for packet_data, (fin, r_ip, enforced) in self._connection_buffer.items():
-                            (src, sport, dst, dport) = packet_data
-                            if src == packet.dst and dport == tcp.sport and sport == tcp.dport and r_ip == packet.src:
-                                InternalLogger.get().debug("Found mapping in buffer (reverse)")
-                                result_packet_data = packet_data
-                                result_dst = (dst, enforced)
-                                break
-                    if result_packet_data is not None:
-                        with self._lock.gen_wlock():
-                            #Check again if it has been deleted (protect against race conditions)
-                            if self._connection_buffer.get(packet_data) is not None:
-                                self._connection_buffer.move_to_end(result_packet_data, last=False)
-                    if result_dst is None:
-                        InternalLogger.get().debug("Connection not found (reverse)")
-                    return result_dst
+                    InternalLogger.get().debug("Searching in Buffer for: " + unpack(packet.src))
+                    #most recent connection first
+                    #old connections with similar tuple will not be used because of the order
+                    result = self._connection_buffer.get_reverse((packet.src, tcp.sport, packet.dst, tcp.dport))
+                    if result is not None:
+                        (packet_data, (fin, r_ip, enforced)) = result
+                        InternalLogger.get().debug("Found mapping in buffer (reverse)")
+                        return (packet_data[2], enforced)
+                    InternalLogger.get().debug("Connection not found (reverse)")
         return None
 
     def track_connection(self, packet, io):
         """
 
-        :param packet: IPv4 / IPv6 Packet
+        :param packet: FlowEvent or IPv4 / IPv6 Packet (PacketView)
         :param io: Input/Output
         """
         InternalLogger.get().debug("Trying to track connection")
         '''
         called before (incoming) and after (outgoing) ph translations
         tracks connections with virtual ip addresses and real ports
+        every state change is a single operation on the shard of the connection
         '''
-        if packet.haslayer(TCP):
-            tcp = packet[TCP]
-            packet_data = None
-            if io == IO.INPUT:
-                packet_data = (packet.src, tcp.sport, packet.dst, tcp.dport)
+        if not isinstance(packet, FlowEvent):
+            if not packet.is_tcp():
+                return
+            packet = FlowEvent.from_packet(packet, io)
+        packet_data = self.connection_key(packet, io)
+        InternalLogger.get().debug("Tracking packet: " + str(packet_data))
+        flags = packet.flags
+        if flags & TCP_SYN:
+            #SYN has been received, Check if it a new connection
+            if self._connection_buffer.touch(packet_data, packet.timestamp, established=bool(flags & TCP_ACK)):
+                # retransmission or SYN/ACK
+                return
+            new_ip = self._mapping.get(packet.dst)
+            if new_ip is None:
+                InternalLogger.get().debug("No new rIP for connection in tracker")
+            # (TCP Ident) : (Fin tracked, mapped dst)
+            elif self._connection_buffer.put(packet_data, (False, new_ip, False), only_new=True, state=STATE_SYN,
+                                             timestamp=packet.timestamp):
+                InternalLogger.get().debug("SYN received for the first time, added mapping")
+        elif flags & (TCP_FIN | TCP_RST):
+            #FIN has been received, connection will close and receive one more ACK
+            #RST: connection is closed, keep it until the FIN timeout (RST may be lost or spoofed)
+            if self._connection_buffer.set_fin(packet_data, packet.timestamp):
+                InternalLogger.get().debug("FIN/RST received, FIN = True")
+        elif flags & TCP_ACK:
+            #Check if last ACK (after FIN) has been received
+            if self._connection_buffer.remove(packet_data, only_fin=True) is not None:
+                InternalLogger.get().debug("ACK received (Last Ack), deleting mapping")
             else:
-                packet_data = (packet.dst, tcp.dport, packet.src, tcp.sport)
-            InternalLogger.get().debug("Tracking packet: " + str(packet_data))
-            if tcp.flags.S:
-                #SYN has been received, Check if it a new connection
-                result = None
-                with self._lock.gen_rlock():
-                    result = self._connection_buffer.get(packet_data)
-                if result is None:
-                    InternalLogger.get().debug("SYN received for the first time, trying to add mapping")
-                    new_ip = self._mapping.get(packet.dst)
-                    if new_ip is not None:
-                        with self._lock.gen_wlock():
-                            self._connection_buffer[packet_data] = (False, new_ip, False)
-                            # (TCP Ident) : (Fin tracked, mapped dst)
-                            self._connection_buffer.move_to_end(packet_data, last=False)  # move to the beginning
-                            self.clean_buffer()
-                    else:
-                        InternalLogger.get().debug("No new rIP for connection in tracker")
-            elif tcp.flags.F:
-                #CFIN has been received, connection will close and receive one more ACK
-                result = None
-                with self._lock.gen_rlock():
-                    result = self._connection_buffer.get(packet_data)
-                if result is not None:
-                    (fin, ip, enforced) = result
-                    InternalLogger.get().debug("FIN received for the first time, FIN = True")
-                    with self._lock.gen_wlock():
-                        self._connection_buffer[packet_data] = (True, ip, enforced)
-            elif tcp.flags.A:
-                #Check if last ACK (after FIN) has been received
-                result = None
-                with self._lock.gen_rlock():
-                    result = self._connection_buffer.get(packet_data)
-                if result is not None:
-                    (fin, ip, enforced) = result
-                    if fin:
-                        InternalLogger.get().debug("ACK received (Last Ack), deleting mapping")
-                        with self._lock.gen_wlock():
-                            self._connection_buffer.pop(packet_data)
+                self._connection_buffer.touch(packet_data, packet.timestamp, established=True)
+
+    @staticmethod
+    def connection_key(packet, io):
+        """
+        Key of a connection in the buffer, for tracked (not translated) packets
+
+        :param packet: FlowEvent or IPv4 / IPv6 Packet (PacketView) with TCP Payload
+        :param io: Input/Output
+        :return: (sourceIP, sourcePort, dest_vIP, dest_rPort)
+        """
+        if io == IO.INPUT:
+            return (packet.src, packet.sport, packet.dst, packet.dport)
+        return (packet.dst, packet.dport, packet.src, packet.sport)
 
     def add_connection(self,sourceIP, sourcePort, dest_vIP, dest_rPort, dest_rIP, enforce):
         """
         Add connection information for connection which should be generated in other components
 
         :param sourcePort: Source Port
-        :param sourceIP: Source IP-Address
+        :param sourceIP: Source IP-Address (packed, see controller.helper.address)
         :param dest_rPort: Destination virtual Port
         :param dest_vIP:  Destination virtual IP-Address
         :param dest_rIP: Destination real IP-Address
         :param enforce: Tell other modules that this connection should be kept alive (even if other security measures prohibit it)
         """
-        with self._lock.gen_wlock():
-            packet_data = (sourceIP, sourcePort, dest_vIP, dest_rPort)
-            InternalLogger.get().debug("Added external connection to tracker: " + str(packet_data) + ": " + dest_rIP)
-            self._connection_buffer[packet_data] = (False, dest_rIP, enforce)
-            # (TCP Ident) : (Fin tracked, mapped dst)
-            self._connection_buffer.move_to_end(packet_data, last=False)  # move to the beginning
-
+        packet_data = (sourceIP, sourcePort, dest_vIP, dest_rPort)
+        InternalLogger.get().debug("Added external connection to tracker: " + str(packet_data) + ": " + unpack(dest_rIP))
+        # (TCP Ident) : (Fin tracked, mapped dst)
+        self._connection_buffer.put(packet_data, (False, dest_rIP, enforce), state=STATE_HONEYPOT)
 
     def get_active_ports(self):
         """
         Get all rPorts that are currently used
         :return: List of Ports
         """
-        port_list = []
-        with self._lock.gen_rlock():
-            for packet_data, (fin, r_ip, enforced) in self._connection_buffer.items():
-                (src, sport, dst, dport) = packet_data
-                if dport not in port_list:
-                    port_list.append(dport)
-        return port_list
+        return self._connection_buffer.active_ports()
 
-    def clean_buffer(self):
+    def get_connections(self):
         """
+        Copy of all tracked connections (e.g. to publish them to other processes)
+        :return: List of (key, (FIN, rIP, enforced))
+        """
+        return self._connection_buffer.items()
+
+    def set_connections(self, connections):
+        """
+        Replace all tracked connections
+        (the table is cleared first, lookups in between miss connections: load a tracker which is not in use yet)
+        :param connections: List of (key, (FIN, rIP, enforced))
+        """
+        self._connection_buffer.clear()
+        for packet_data, value in connections:
+            self._connection_buffer.put(packet_data, value)
 
+    def record_changes(self):
+        """
+        Record changed connections (e.g. to publish only the changes to other processes, see get_changes)
+        """
+        self._connection_buffer.record_changes()
+
+    def get_changes(self):
+        """
+        Connections changed since the last call (record_changes has to be called first)
+        :return: Dictionary key: (FIN, rIP, enforced) or None (removed)
+        """
+        return {packet_data: self._connection_buffer.peek(packet_data)
+                for packet_data in self._connection_buffer.pop_changes()}
+
+    def apply_changes(self, changes):
+        """
+        Insert, replace and remove connections (see get_changes)
+        :param changes: Iterable of (key, (FIN, rIP, enforced) or None)
+        """
+        for packet_data, value in changes:
+            if value is None:
+                self._connection_buffer.remove(packet_data)
+            else:
+                self._connection_buffer.put(packet_data, value)
+
+    def remove_connection(self, packet_data):
+        """
+        Remove a connection (if it exists)
+        :param packet_data: (sourceIP, sourcePort, dest_vIP, dest_rPort)
+        """
+        self._connection_buffer.remove(packet_data)
+
+    def _run_expiry(self):
+        """
+        Remove idle connections (background thread)
         """
-        # Cleanup
-        while len(self._connection_buffer) > self._max_buffer:
-            # remove first element(s)
-            InternalLogger.get().debug("Removing element from buffer")
-            with self._lock.gen_wlock():
-                self._connection_buffer.popitem(last=True)
+        while True:
+            time.sleep(1)
+            try:
+                self._expired += self._connection_buffer.expire()
+            except Exception as e:
+                InternalLogger.get().error("Error: " + str(e), exc_info=True)
@@ -0,0 +1,186 @@
+from threading import Lock
+
+from InternalLogger.internallogger import InternalLogger
+from connection_tracker.flowevent import FlowEvent
+from connection_tracker.iconnectiontracker import IConnectionTracker
+from connection_tracker.nasconnectiontracker import NasConnectionTracker
+
+
+class SharedConnectionTracker(IConnectionTracker):
+    """
+    Connection Tracker of a queue worker process (queue balancing)
+
+    Tracking events are sent to the NasConnectionTracker of the main process, which publishes all connections
+    through shared memory (SharedStatePublisher).
+    Connections tracked by this worker are kept in a local tracker until the main process has published them.
+    Published connections are loaded into a new tracker which replaces the current one by one reference swap,
+    so packet threads never search a partially loaded tracker. Changes published afterwards are applied
+    connection by connection.
+
+    :param worker_id: ID of the worker (queue number)
+    :param event_queue: multiprocessing queue to the main process
+    :param inline: track connections synchronously on the packet threads (see NasConnectionTracker)
+    :param capacity: maximum number of tracked connections
+    :param timeouts: idle timeouts of the local connections (see NasConnectionTracker),
+     published connections expire in the main process
+    """
+    def __init__(self, worker_id, event_queue, inline=False, capacity=1000, timeouts=None):
+        self._worker_id = worker_id
+        self._event_queue = event_queue
+        self._capacity = capacity
+        self._port_priority = None
+        self._port_listener = None
+        self._local = NasConnectionTracker(inline, capacity, timeouts)
+        self._published = NasConnectionTracker(capacity=capacity)
+        # generation of the loaded snapshot and number of the last applied publication of changes
+        self._generation = 0
+        self._publication = 0
+        # connection key: sequence number of the last event of this worker
+        self._local_seq = {}
+        self._seq = 0
+        self._lock = Lock()
+
+    def is_inline(self):
+        """
+        :return: Tracker should be called synchronously on the packet threads
+        """
+        return self._local.is_inline()
+
+    def set_port_priority(self, port_priority):
+        """
+        Connections to ports with low priority are evicted first if the buffer is full
+        :param port_priority: function, priority of a dest_rPort
+        """
+        self._port_priority = port_priority
+        self._local.set_port_priority(port_priority)
+        self._published.set_port_priority(port_priority)
+
+    def set_port_listener(self, port_listener):
+        """
+        :param port_listener: notified if a rPort is used by the first published connection or not used anymore
+        """
+        self._port_listener = port_listener
+        self._published.set_port_listener(port_listener)
+
+    def set_mapping(self, mapping):
+        """
+        Change Mapping (HF)
+        :param mapping:
+        """
+        self._local.set_mapping(mapping)
+
+    def track_connection(self, packet, io):
+        """
+        Track locally and forward the flow event to the tracker of the main process
+
+        :param packet: FlowEvent or IPv4 / IPv6 Packet (PacketView)
+        :param io: Input/Output
+        """
+        if not isinstance(packet, FlowEvent):
+            if not packet.is_tcp():
+                return
+            packet = FlowEvent.from_packet(packet, io)
+        self._local.track_connection(packet, io)
+        with self._lock:
+            self._seq += 1
+            self._local_seq[NasConnectionTracker.connection_key(packet, io)] = self._seq
+            self._event_queue.put(("track", self._worker_id, self._seq, io, packet))
+
+    def add_connection(self, sourceIP, sourcePort, dest_vIP, dest_rPort, dest_rIP, enforce):
+        """
+        Add connection information for connection which should be generated in other components
+
+        :param sourcePort: Source Port
+        :param sourceIP: Source IP-Address (packed, see controller.helper.address)
+        :param dest_rPort: Destination virtual Port
+        :param dest_vIP:  Destination virtual IP-Address
+        :param dest_rIP: Destination real IP-Address
+        :param enforce: Tell other modules that this connection should be kept alive (even if other security measures prohibit it)
+        """
+        self._local.add_connection(sourceIP, sourcePort, dest_vIP, dest_rPort, dest_rIP, enforce)
+        with self._lock:
+            self._seq += 1
+            self._local_seq[(sourceIP, sourcePort, dest_vIP, dest_rPort)] = self._seq
+            self._event_queue.put(("add", self._worker_id, self._seq,
+                                   (sourceIP, sourcePort, dest_vIP, dest_rPort, dest_rIP, enforce)))
+
+    def check_buffer(self, packet, io):
+        """
+        Search in the local and in the published connections
+
+        :param packet: IPv4 / IPv6 Packet (PacketView) or FlowEvent
+        :param io: Input/Output
+        :return: (rIP or None if no rIP has been found, enforced)
+        """
+        result = self._local.check_buffer(packet, io)
+        if result is None:
+            result = self._published.check_buffer(packet, io)
+        return result
+
+    def get_active_ports(self):
+        """
+        Get all rPorts that are currently used (published connections)
+        :return: List of Ports
+        """
+        return self._published.get_active_ports()
+
+    def apply_snapshot(self, snapshot):
+        """
+        Load connections published by the main process
+        Local connections are dropped as soon as all events of this worker for them have been applied
+
+        :param snapshot: {"generation": number of the snapshot, "connections": List of connections,
+         "applied": {worker_id: last applied sequence number}}
+        """
+        published = NasConnectionTracker(capacity=self._capacity)
+        if self._port_priority is not None:
+            published.set_port_priority(self._port_priority)
+        published.set_connections(snapshot["connections"])
+        old = self._published
+        # one reference swap, packet threads search the old or the new tracker
+        self._published = published
+        if self._port_listener is not None:
+            # only changes are reported (the listener counts the active ports)
+            old.set_port_listener(None)
+            old_ports = set(old.get_active_ports())
+            new_ports = set(published.get_active_ports())
+            for port in old_ports - new_ports:
+                self._port_listener.port_deactivated(port)
+            for port in new_ports - old_ports:
+                self._port_listener.port_activated(port)
+            published.set_port_listener(self._port_listener, report=False)
+        self._generation = snapshot["generation"]
+        self._publication = 0
+        self._remove_applied(snapshot["applied"])
+
+    def apply_changes(self, changes):
+        """
+        Apply the changes published by the main process since the loaded snapshot
+
+        :param changes: {"generation": number of the snapshot, "changes": {key: (publication, connection or None)},
+         "applied": {worker_id: last applied sequence number}}
+        :return: False if the changes belong to a newer snapshot (load it first)
+        """
+        if changes["generation"] != self._generation:
+            return changes["generation"] < self._generation
+        publication = self._publication
+        self._published.apply_changes((key, value) for key, (number, value) in changes["changes"].items()
+                                      if number > publication)
+        self._publication = max((number for number, value in changes["changes"].values()), default=publication)
+        self._remove_applied(changes["applied"])
+        return True
+
+    def _remove_applied(self, applied):
+        """
+        Remove local connections whose events have been applied by the main process
+
+        :param applied: {worker_id: last applied sequence number}
+        """
+        applied = applied.get(self._worker_id, 0)
+        with self._lock:
+            published_keys = [key for key, seq in self._local_seq.items() if seq <= applied]
+            for key in published_keys:
+                del self._local_seq[key]
+                self._local.remove_connection(key)
+        InternalLogger.get().debug("Worker " + str(self._worker_id) + ": loaded published connections, "
+                                   + str(len(self._local_seq)) + " local connections pending")
@@ -0,0 +1,68 @@
+class TimerWheel:
+    """
+    Hierarchical timer wheel
+
+    Level 0 has one slot per tick, every slot of level n covers slots^n ticks. A timer is stored in the lowest level
+    which covers its deadline and is moved down (cascaded) when its slot of the higher level is reached,
+    so scheduling and expiry cost O(1) amortized. Timers can not be cancelled, the owner has to ignore outdated timers.
+    Deadlines beyond the range of the highest level fire at the end of the range.
+
+    :param now: current time in seconds
+    :param tick: resolution in seconds
+    :param slots: number of slots per level
+    :param levels: number of levels
+    """
+    def __init__(self, now, tick=1.0, slots=64, levels=3):
+        self._tick = tick
+        self._slots = slots
+        self._levels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self._spans = [slots ** level for level in range(levels + 1)]
+        self._current = int(now / tick)
+
+    def schedule(self, item, deadline):
+        """
+        Add a timer
+
+        :param item: returned by advance() when the deadline has been reached
+        :param deadline: time in seconds
+        """
+        self._place(item, max(-int(-deadline // self._tick), self._current + 1))
+
+    def _place(self, item, ticks):
+        delta = ticks - self._current
+        last_level = len(self._levels) - 1
+        for level in range(len(self._levels)):
+            if delta < self._spans[level + 1] or level == last_level:
+                if level == last_level:
+                    ticks = min(ticks, self._current + self._spans[level + 1] - 1)
+                slot = (ticks // self._spans[level]) % self._slots
+                self._levels[level][slot].append((ticks, item))
+                return
+
+    def advance(self, now):
+        """
+        Move the wheel to the current time
+
+        :param now: current time in seconds
+        :return: List of items whose deadline has been reached
+        """
+        target = int(now / self._tick)
+        expired = []
+        while self._current < target:
+            self._current += 1
+            # cascade higher levels first, their timers may end in the current slot of level 0
+            for level in range(len(self._levels) - 1, 0, -1):
+                if self._current % self._spans[level] == 0:
+                    slot = (self._current // self._spans[level]) % self._slots
+                    self._cascade(self._levels[level], slot, expired)
+            self._cascade(self._levels[0], self._current % self._slots, expired)
+        return expired
+
+    def _cascade(self, wheel, slot, expired):
+        timers = wheel[slot]
+        wheel[slot] = []
+        for (ticks, item) in timers:
+            if ticks <= self._current:
+                expired.append(item)
+            else:
+                self._place(item, ticks)
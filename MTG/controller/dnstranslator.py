@@ -3,9 +3,13 @@
 from scapy.layers.dns import DNSRR, DNS
 
 from InternalLogger.internallogger import InternalLogger
+from controller.helper.address import pack, unpack
 from controller.ilayercontroller import ILayerController
 from controller.itranslator import IO
 
+DNS_TYPE_A = 1
+DNS_TYPE_AAAA = 28
+
 
 class DnsTranslator(ILayerController):
     """
@@ -26,10 +30,13 @@ class DnsTranslator(ILayerController):
     def process_packet(self, packet):
         """
 
-        :param packet: IPv4 / IPv6 packet
+        :param packet: IPv4 / IPv6 packet (PacketView)
         :return: forward?
         """
         InternalLogger.get().debug("DNS Controller processing packet...")
+        #DNS rewriting requires the full scapy dissection
+        view = packet
+        packet = view.dissect()
         # .show() = all layer informations
         #Check if it has the DNSRR Layer
         if packet.haslayer(DNSRR):
@@ -41,8 +48,12 @@ class DnsTranslator(ILayerController):
             rrname = packet[DNSRR].rrname
             dns_type = packet[DNSRR].type
             if self._mapping is not None:
-                new_ip = self._mapping.get(rdata)
+                new_ip = None
+                # A / AAAA record (rdata is an address)
+                if dns_type in (DNS_TYPE_A, DNS_TYPE_AAAA):
+                    new_ip = self._mapping.get(pack(rdata))
                 if new_ip is not None:
+                    new_ip = unpack(new_ip)
                     #vIP found in Mapping
                     InternalLogger.get().debug("DNS Response IP Replaced for " + str(rrname)
                                        + "; new = " + str(new_ip) + "; old = "
@@ -52,6 +63,8 @@ class DnsTranslator(ILayerController):
                     packet[DNS].an = dns_response
                     #change answer count
                     packet[DNS].ancount = 1
+                    #write the new response back to the raw packet
+                    view.load(packet)
             else:
                 InternalLogger.get().error("DNS Mapping is None")
         else:
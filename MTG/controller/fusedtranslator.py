@@ -0,0 +1,113 @@
+import time
+
+from scapy.layers.inet import IP
+from scapy.layers.inet6 import IPv6
+
+from InternalLogger.internallogger import InternalLogger
+from connection_tracker.flowevent import FlowEvent
+from controller.helper.networkhelper import NetworkHelper
+from controller.ilayercontroller import ILayerController
+from controller.itranslator import IO
+
+
+class FusedTranslator(ILayerController):
+    """
+    Network Address Shuffling and Port Hopping in one stage (replaces the IPTranslatorNAS and the PortTranslatorPh
+    of a direction if both are activated)
+
+    The packet is classified once (whitelist, PH server and virtual subnets, local destination). The new address
+    (HF mapping snapshot, tracked connections) and the new port (PH function tables) are calculated by the translators
+    without changing the packet, then all fields are written with one checksum update.
+    The verdict is the same as with the separate stages, both translations are always calculated.
+    Trackers get the state between port and address translation (vIP and rPort) as FlowEvent (PacketView.flow_event).
+    An inline tracker of the incoming packets is called by this stage between port and address translation,
+    so tracked connections are changed before they are searched (same order as the separate stages).
+    """
+    def layers(self):
+        """
+        :return: list of layers translated by this controller
+        """
+        return [IP, IPv6]
+
+    def __init__(self, ip_translator, port_translator, prefix_index, io, tracker=None):
+        """
+
+        :param ip_translator: Network Address Shuffling Controller of this direction (IPTranslatorNAS)
+        :param port_translator: Port Hopping Controller of this direction (PortTranslatorPh)
+        :param prefix_index: Whitelist, PH server subnets and virtual subnets (PrefixIndex, shared by all translators)
+        :param io: Input or Output
+        :param tracker: inline tracker of the incoming packets (IConnectionTracker, not a stage of the IpController)
+         or None
+        """
+        super().__init__(None, io)
+        self._ip_translator = ip_translator
+        self._port_translator = port_translator
+        self._prefix_index = prefix_index
+        self._tracker = tracker
+        self._network_helper = NetworkHelper.get()
+
+    def process_packet(self, packet):
+        """
+
+        :param packet: IPv4 / IPv6 Packet (PacketView)
+        :return: forward?
+        """
+        if self._io == IO.INPUT:
+            return self._process_incoming(packet)
+        return self._process_leaving(packet)
+
+    def _process_incoming(self, packet):
+        """
+        Ports first (PH), the address translation and the trackers use the real ports and the vIP
+
+        :param packet: IPv4 / IPv6 Packet (PacketView)
+        :return: forward?
+        """
+        forward = True
+        sport = dport = None
+        dst_classes = None
+        local = None
+        if packet.sport is not None:
+            dst_classes = self._prefix_index.lookup(packet.dst)
+            classes = dst_classes | self._prefix_index.lookup(packet.src)
+            local = self._network_helper.is_local(packet.dst)
+            (forward, sport, dport) = self._port_translator.translate(packet, packet.src, classes, local)
+        flow = packet
+        if packet.is_tcp():
+            flow = FlowEvent(packet.src, packet.sport if sport is None else sport, packet.dst,
+                             packet.dport if dport is None else dport, packet.flags, self._io, time.monotonic())
+            packet.flow_event = flow
+            if self._tracker is not None:
+                try:
+                    self._tracker.track_connection(flow, self._io)
+                except Exception as e:
+                    InternalLogger.get().critical("Error: " + str(e), exc_info=True)
+        (forward_ip, dst) = self._ip_translator.translate(packet, flow, dst_classes, local)
+        packet.rewrite(dst=dst, sport=sport, dport=dport)
+        return forward and forward_ip
+
+    def _process_leaving(self, packet):
+        """
+        Address first (NAS), the port translation and the trackers use the vIP and the real ports
+
+        :param packet: IPv4 / IPv6 Packet (PacketView)
+        :return: forward?
+        """
+        (forward, src) = self._ip_translator.translate(packet, packet)
+        v_src = packet.src if src is None else src
+        sport = dport = None
+        if packet.sport is not None:
+            classes = self._prefix_index.lookup(packet.dst) | self._prefix_index.lookup(v_src)
+            (forward_port, sport, dport) = self._port_translator.translate(packet, v_src, classes)
+            forward = forward and forward_port
+        if packet.is_tcp():
+            packet.flow_event = FlowEvent(v_src, packet.sport, packet.dst, packet.dport, packet.flags, self._io,
+                                          time.monotonic())
+        packet.rewrite(src=src, sport=sport, dport=dport)
+        return forward
+
+    def mapping_changed(self):
+        """
+        Not used, the mapping is set on the IPTranslatorNAS
+        """
+        pass
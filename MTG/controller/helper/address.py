@@ -0,0 +1,38 @@
+"""
+Canonical internal address representation: packed bytes as in the IP header (IPv4: 4 bytes, IPv6: 16 bytes)
+
+Addresses of the configuration, the MT Controller and the HF mappings are converted once at the boundaries
+(set_mapping, set_honeypot, keymap, local addresses), packets are handled without string formatting.
+Textual addresses are only created for logging and for protocols which need them (DNS, PH hash input).
+"""
+import socket
+
+
+def pack(address):
+    """
+    :param address: IPv4 / IPv6 address (String, any valid spelling)
+    :return: packed address (bytes)
+    """
+    if ":" in address:
+        return socket.inet_pton(socket.AF_INET6, address)
+    return socket.inet_pton(socket.AF_INET, address)
+
+
+def unpack(address):
+    """
+    :param address: packed address (bytes)
+    :return: canonical textual address (String)
+    """
+    if len(address) == 4:
+        return socket.inet_ntop(socket.AF_INET, address)
+    return socket.inet_ntop(socket.AF_INET6, address)
+
+
+def pack_mapping(mapping):
+    """
+    :param mapping: Map of textual addresses (e.g. HF mapping vIP: rIP) or None
+    :return: Map of packed addresses or None
+    """
+    if mapping is None:
+        return None
+    return {pack(k): pack(v) for k, v in mapping.items()}
@@ -0,0 +1,167 @@
+import math
+
+from controller.helper.address import pack, pack_mapping
+
+_MISSING = object()
+# indexes up to this size are copied with every change, larger ones are shared (_LayeredMap)
+_COPY_SIZE = 16384
+
+
+class MappingSnapshot:
+    """
+    Immutable HF mapping (total mapping of this and other gateways)
+
+    Built once per change by the HfController, it contains the indexes for both directions,
+    so translators only swap their reference (packet threads read the snapshot without locks).
+    The indexes are dictionaries or, for large mappings, _LayeredMaps sharing the index of an older snapshot
+    (read with get).
+
+    :param mapping: vIP: rIP (Strings)
+    :param forward: vIP: rIP (packed, see controller.helper.address)
+    :param reverse: rIP: vIP (packed)
+    :param epoch: version of the mapping (increases with every change)
+    """
+    __slots__ = ("mapping", "forward", "reverse", "epoch")
+
+    def __init__(self, mapping, forward, reverse, epoch):
+        object.__setattr__(self, "mapping", mapping)
+        object.__setattr__(self, "forward", forward)
+        object.__setattr__(self, "reverse", reverse)
+        object.__setattr__(self, "epoch", epoch)
+
+    @staticmethod
+    def build(mapping, epoch=0):
+        """
+        :param mapping: vIP: rIP (Strings)
+        :param epoch: version of the mapping
+        :return: MappingSnapshot
+        """
+        forward = pack_mapping(mapping)
+        reverse = {r_ip: v_ip for v_ip, r_ip in forward.items()}
+        return MappingSnapshot(dict(mapping), forward, reverse, epoch)
+
+    def apply(self, changes, epoch):
+        """
+        New snapshot with changed entries, only the changed addresses are converted.
+        The indexes are copied on write (_IndexChanges): small indexes are copied, large ones are shared
+        with this snapshot and only the changed entries are copied until they are merged into a new index.
+
+        :param changes: vIP: rIP or None if the vIP has been revoked (Strings)
+        :param epoch: version of the new mapping
+        :return: MappingSnapshot
+        """
+        mapping = _IndexChanges(self.mapping)
+        forward = _IndexChanges(self.forward)
+        reverse = _IndexChanges(self.reverse)
+        for v_ip, r_ip in changes.items():
+            packed_v_ip = pack(v_ip)
+            old_r_ip = forward.get(packed_v_ip)
+            forward.remove(packed_v_ip)
+            mapping.remove(v_ip)
+            if old_r_ip is not None and reverse.get(old_r_ip) == packed_v_ip:
+                reverse.remove(old_r_ip)
+            if r_ip is not None:
+                packed_r_ip = pack(r_ip)
+                mapping.set(v_ip, r_ip)
+                forward.set(packed_v_ip, packed_r_ip)
+                reverse.set(packed_r_ip, packed_v_ip)
+        return MappingSnapshot(mapping.build(), forward.build(), reverse.build(), epoch)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("MappingSnapshot is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("MappingSnapshot is immutable")
+
+    def __reduce__(self):
+        return MappingSnapshot, (self.mapping, self.forward, self.reverse, self.epoch)
+
+    def __len__(self):
+        return len(self.forward)
+
+
+class _LayeredMap:
+    """
+    Read-only index of a snapshot: the entries changed since an older snapshot (None: removed)
+    over the index of the older snapshot (dictionary, shared by the snapshots)
+
+    Pickled as dictionary, so workers (SharedStatePublisher) read plain dictionaries.
+    """
+    __slots__ = ("_base", "_changes", "_size")
+
+    def __init__(self, base, changes, size):
+        self._base = base
+        self._changes = changes
+        self._size = size
+
+    def get(self, key, default=None):
+        value = self._changes.get(key, _MISSING)
+        if value is _MISSING:
+            return self._base.get(key, default)
+        return default if value is None else value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return self._size
+
+    def items(self):
+        for key, value in self._base.items():
+            if key not in self._changes:
+                yield key, value
+        for key, value in self._changes.items():
+            if value is not None:
+                yield key, value
+
+    def __reduce__(self):
+        return dict, (list(self.items()),)
+
+
+class _IndexChanges:
+    """
+    Changes of an index for a new snapshot, the index of the old snapshot is not changed
+
+    :param index: index of the old snapshot (dictionary or _LayeredMap)
+    """
+    def __init__(self, index):
+        if isinstance(index, _LayeredMap):
+            self._base = index._base
+            self._changes = dict(index._changes)
+        else:
+            self._base = index
+            self._changes = {}
+        self._size = len(index)
+
+    def get(self, key):
+        value = self._changes.get(key, _MISSING)
+        if value is _MISSING:
+            return self._base.get(key)
+        return value
+
+    def set(self, key, value):
+        if self.get(key) is None:
+            self._size += 1
+        self._changes[key] = value
+
+    def remove(self, key):
+        if self.get(key) is not None:
+            self._size -= 1
+            self._changes[key] = None
+
+    def build(self):
+        """
+        :return: index of the new snapshot, the changes are merged into a copy of the index (dictionary)
+         if the index is small or the changes exceed 8 * sqrt(size), otherwise they are layered over it
+        """
+        if not self._changes:
+            return self._base
+        if len(self._base) > _COPY_SIZE and len(self._changes) <= 8 * math.isqrt(len(self._base)):
+            return _LayeredMap(self._base, self._changes, self._size)
+        index = dict(self._base)
+        for key, value in self._changes.items():
+            if value is None:
+                index.pop(key, None)
+            else:
+                index[key] = value
+        return index
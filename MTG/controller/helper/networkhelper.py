@@ -1,25 +1,144 @@
+import os
+import socket
+import struct
+import time
+from threading import Thread, Lock
+
 import netifaces
 
+from InternalLogger.internallogger import InternalLogger
+from controller.helper.address import pack
+
+# rtnetlink (linux/rtnetlink.h)
+_NETLINK_ROUTE = 0
+_RTMGRP_IPV4_IFADDR = 0x10
+_RTMGRP_IPV6_IFADDR = 0x100
+_RTM_NEWADDR = 20
+_RTM_DELADDR = 21
+_NLMSG_HEADER = struct.Struct("=IHHII")
+
+
 class NetworkHelper:
     """
     All network functions (just one at the moment, but we'll see)
+
+    Local addresses are kept in a set which is refreshed by a background thread, addresses added or removed at runtime
+    (e.g. failover) are recognized. On Linux the thread waits for rtnetlink address events,
+    otherwise (or if netlink is not available) the addresses are compared every refresh_interval.
+    Use NetworkHelper.get() to share one instance (and thread) per process.
+
+    :param refresh_interval: interval to compare the local addresses without netlink events in seconds
     """
-    def __init__(self):
-        self._if_ext = None
+    _shared = None
+    _shared_lock = Lock()
+
+    def __init__(self, refresh_interval=5.0):
         self._mode = [netifaces.AF_INET, netifaces.AF_INET6]
+        self._refresh_interval = refresh_interval
+        self._pid = os.getpid()
+        # subscribe before the first read, changes in between are not lost
+        netlink = self._open_netlink()
+        self._if_ext = frozenset(self._read_local_addresses())
+        Thread(target=self._run, args=(netlink,), daemon=True, name="NetworkHelper").start()
+
+    @staticmethod
+    def get():
+        """
+        :return: shared instance of this process (a forked process creates its own instance, threads are not inherited)
+        """
+        with NetworkHelper._shared_lock:
+            if NetworkHelper._shared is None or NetworkHelper._shared._pid != os.getpid():
+                NetworkHelper._shared = NetworkHelper()
+            return NetworkHelper._shared
 
     def local_addresses(self):
         """
-        :return: All Local addresses
-        """
-        if self._if_ext is None:
-            interfaces = netifaces.interfaces()
-            if_ext = []
-            for i in interfaces:
-                for mode in self._mode:
-                    iface = netifaces.ifaddresses(i).get(mode)
-                    if iface:
-                        for j in iface:
-                            if_ext.append(j['addr'])
-            self._if_ext = if_ext
+        :return: All Local addresses (Set of packed addresses)
+        """
         return self._if_ext
+
+    def is_local(self, address):
+        """
+        :param address: packed address
+        :return: address is a local address
+        """
+        return address in self._if_ext
+
+    def _read_local_addresses(self):
+        if_ext = set()
+        for i in netifaces.interfaces():
+            for mode in self._mode:
+                iface = netifaces.ifaddresses(i).get(mode)
+                if iface:
+                    for j in iface:
+                        # link local IPv6 addresses contain the scope (fe80::1%eth0)
+                        if_ext.add(pack(j['addr'].split('%')[0]))
+        return if_ext
+
+    def refresh(self):
+        """
+        Read the local addresses and replace the set if they have changed
+
+        :return: addresses have changed
+        """
+        if_ext = frozenset(self._read_local_addresses())
+        if if_ext == self._if_ext:
+            return False
+        InternalLogger.get().info("Local addresses changed: " + str(len(if_ext - self._if_ext)) + " added, "
+                                  + str(len(self._if_ext - if_ext)) + " removed")
+        self._if_ext = if_ext
+        return True
+
+    def _run(self, netlink):
+        """
+        Refresh thread: netlink events, periodic comparison as fallback
+
+        :param netlink: netlink socket or None
+        """
+        while True:
+            try:
+                if netlink is None:
+                    time.sleep(self._refresh_interval)
+                    self.refresh()
+                elif self._wait_for_address_event(netlink):
+                    self.refresh()
+            except Exception as e:
+                InternalLogger.get().error("Error: " + str(e), exc_info=True)
+
+    def _open_netlink(self):
+        """
+        :return: netlink socket subscribed to IPv4 / IPv6 address events or None
+        """
+        if not hasattr(socket, "AF_NETLINK"):
+            InternalLogger.get().info("Netlink not available, comparing local addresses every "
+                                      + str(self._refresh_interval) + " seconds")
+            return None
+        try:
+            netlink = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, _NETLINK_ROUTE)
+            netlink.bind((0, _RTMGRP_IPV4_IFADDR | _RTMGRP_IPV6_IFADDR))
+            return netlink
+        except OSError as e:
+            InternalLogger.get().info("Netlink not available (" + str(e) + "), comparing local addresses every "
+                                      + str(self._refresh_interval) + " seconds")
+            return None
+
+    @staticmethod
+    def _wait_for_address_event(netlink):
+        """
+        :return: address has been added or removed (or events have been lost)
+        """
+        try:
+            data = netlink.recv(65536)
+        except OSError:
+            # ENOBUFS: events have been lost
+            return True
+        offset = 0
+        while offset + _NLMSG_HEADER.size <= len(data):
+            (length, message_type, flags, seq, pid) = _NLMSG_HEADER.unpack_from(data, offset)
+            if message_type in (_RTM_NEWADDR, _RTM_DELADDR):
+                return True
+            if length < _NLMSG_HEADER.size:
+                break
+            # messages are aligned to 4 bytes
+            offset += (length + 3) & ~3
+        return False
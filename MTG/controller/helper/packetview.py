@@ -0,0 +1,491 @@
+import struct
+
+from scapy.layers.dns import DNSRR
+from scapy.layers.inet import IP, TCP, UDP
+from scapy.layers.inet6 import IPv6, _ICMPv6
+
+from controller.helper.address import unpack
+
+PROTO_TCP = 6
+PROTO_UDP = 17
+PROTO_ICMPV6 = 58
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+
+# UDP ports dissected as DNS by scapy: DNS and mDNS
+DNS_PORTS = frozenset((53, 5353))
+
+# upper layer protocols of the dispatch plan (None = other protocols or no parsed ports)
+DISPATCH_PROTOCOLS = (PROTO_TCP, PROTO_UDP, None)
+
+# IPv6 extension headers which can be skipped to find the upper layer (Hop-by-Hop, Routing, Destination Options)
+_IPV6_EXTENSION_HEADERS = (0, 43, 60)
+_IPV6_FRAGMENT_HEADER = 44
+_IPV6_AUTH_HEADER = 51
+
+# offset and length of the source address (destination follows directly)
+_ADDRESS_OFFSET = {4: (12, 4), 6: (8, 16)}
+# minimum upper layer header sizes
+_L4_HEADER_SIZE = {PROTO_TCP: 20, PROTO_UDP: 8}
+# offset of the checksum field in the upper layer header
+_CHECKSUM_OFFSET = {PROTO_TCP: 16, PROTO_UDP: 6, PROTO_ICMPV6: 2}
+
+
+class PacketView:
+    """
+    Lightweight view on a raw IPv4 / IPv6 packet (NFQUEUE payload)
+
+    Only the header fields needed by the translators and trackers are parsed from the raw bytes.
+    Address and port changes are written directly into the packet buffer.
+    In incremental mode the IPv4 header checksum and the upper layer checksum are patched with every change (RFC 1624),
+    otherwise they are recalculated over the whole packet by update_checksums().
+    A full scapy dissection is only done on demand (e.g. DNS rewriting), see dissect() and load()
+    Several fields can be changed at once by rewrite() (one checksum update).
+
+    :param data: raw IP packet
+    :param incremental: update checksums incrementally
+    """
+    __slots__ = ("_data", "version", "proto", "l4_offset", "dns_offset",
+                 "_src", "_dst", "_sport", "_dport", "_dirty", "_incremental", "flow_event")
+
+    def __init__(self, data, incremental=True):
+        self._data = bytearray(data)
+        self._incremental = incremental
+        # FlowEvent for the trackers if the translators have been fused (state between port and address translation)
+        self.flow_event = None
+        self._parse()
+
+    def _parse(self):
+        """
+        Parse IP header, upper layer ports, TCP flags and DNS offset from the packet buffer
+        """
+        data = self._data
+        if len(data) < 20:
+            raise ValueError("Packet too short (" + str(len(data)) + " bytes)")
+        self.version = data[0] >> 4
+        self.l4_offset = None
+        self.dns_offset = None
+        self._sport = None
+        self._dport = None
+        self._dirty = False
+        if self.version == 4:
+            ihl = (data[0] & 0x0F) * 4
+            self.proto = data[9]
+            (flags_fragment,) = struct.unpack_from("!H", data, 6)
+            # only the first fragment carries the upper layer header
+            if flags_fragment & 0x1FFF == 0:
+                self.l4_offset = ihl
+        elif self.version == 6:
+            if len(data) < 40:
+                raise ValueError("IPv6 packet too short (" + str(len(data)) + " bytes)")
+            self._parse_ipv6_extensions()
+        else:
+            raise ValueError("Unknown IP version " + str(self.version))
+        (offset, length) = _ADDRESS_OFFSET[self.version]
+        self._src = bytes(data[offset:offset + length])
+        self._dst = bytes(data[offset + length:offset + 2 * length])
+
+        if self.l4_offset is not None and self.proto in (PROTO_TCP, PROTO_UDP):
+            if len(data) < self.l4_offset + _L4_HEADER_SIZE[self.proto]:
+                # flags and checksum can not be read, the packet is dropped (IpController.receive)
+                raise ValueError("Truncated " + ("TCP" if self.proto == PROTO_TCP else "UDP") + " header ("
+                                 + str(len(data) - self.l4_offset) + " bytes)")
+            (self._sport, self._dport) = struct.unpack_from("!HH", data, self.l4_offset)
+            if self.proto == PROTO_UDP and (self._sport in DNS_PORTS or self._dport in DNS_PORTS):
+                self.dns_offset = self.l4_offset + 8
+
+    def _parse_ipv6_extensions(self):
+        """
+        Walk the IPv6 extension header chain to find the upper layer protocol
+        """
+        data = self._data
+        next_header = data[6]
+        offset = 40
+        while True:
+            if next_header in _IPV6_EXTENSION_HEADERS:
+                if len(data) < offset + 2:
+                    break
+                next_header, length = data[offset], (data[offset + 1] + 1) * 8
+            elif next_header == _IPV6_FRAGMENT_HEADER:
+                if len(data) < offset + 8:
+                    break
+                (fragment,) = struct.unpack_from("!H", data, offset + 2)
+                if fragment & 0xFFF8:
+                    # not the first fragment, no upper layer header
+                    self.proto = data[offset]
+                    return
+                next_header, length = data[offset], 8
+            elif next_header == _IPV6_AUTH_HEADER:
+                if len(data) < offset + 2:
+                    break
+                next_header, length = data[offset], (data[offset + 1] + 2) * 4
+            else:
+                self.proto = next_header
+                self.l4_offset = offset
+                return
+            offset += length
+        # truncated extension header chain
+        self.proto = next_header
+
+    @property
+    def src(self):
+        """
+        :return: Source IP-Address (packed, see controller.helper.address)
+        """
+        return self._src
+
+    @src.setter
+    def src(self, address):
+        self._write_address(0, address)
+        self._src = address
+
+    @property
+    def dst(self):
+        """
+        :return: Destination IP-Address (packed, see controller.helper.address)
+        """
+        return self._dst
+
+    @dst.setter
+    def dst(self, address):
+        self._write_address(1, address)
+        self._dst = address
+
+    @property
+    def sport(self):
+        """
+        :return: TCP/UDP source port or None
+        """
+        return self._sport
+
+    @sport.setter
+    def sport(self, port):
+        self._write_port(0, port)
+        self._sport = port
+
+    @property
+    def dport(self):
+        """
+        :return: TCP/UDP destination port or None
+        """
+        return self._dport
+
+    @dport.setter
+    def dport(self, port):
+        self._write_port(2, port)
+        self._dport = port
+
+    @property
+    def flags(self):
+        """
+        :return: TCP flags (Int) or 0 for other protocols
+        """
+        if self.is_tcp():
+            return self._data[self.l4_offset + 13]
+        return 0
+
+    def is_tcp(self):
+        """
+        :return: Packet has a (parsed) TCP header
+        """
+        return self.proto == PROTO_TCP and self._sport is not None
+
+    def is_udp(self):
+        """
+        :return: Packet has a (parsed) UDP header
+        """
+        return self.proto == PROTO_UDP and self._sport is not None
+
+    def dispatch_key(self):
+        """
+        :return: (ip version, PROTO_TCP / PROTO_UDP or None), see DISPATCH_PROTOCOLS
+        """
+        if self._sport is None:
+            return (self.version, None)
+        return (self.version, self.proto)
+
+    def flow_key(self):
+        """
+        :return: (src, sport, dst, dport, proto), ports are None for packets without TCP/UDP header
+        """
+        return (self._src, self._sport, self._dst, self._dport, self.proto)
+
+    def has_dns_answer(self):
+        """
+        :return: Packet is a DNS message (UDP port 53 or 5353) with at least one answer record
+        """
+        if self.dns_offset is None or len(self._data) < self.dns_offset + 12:
+            return False
+        (ancount,) = struct.unpack_from("!H", self._data, self.dns_offset + 6)
+        return ancount > 0
+
+    def haslayer(self, layer):
+        """
+        Check the layers which are used by the layer controllers without dissecting the packet
+
+        :param layer: scapy layer class (IP, IPv6, TCP, UDP, DNSRR)
+        :return: Boolean
+        """
+        if layer is IP:
+            return self.version == 4
+        if layer is IPv6:
+            return self.version == 6
+        if layer is TCP:
+            return self.is_tcp()
+        if layer is UDP:
+            return self.is_udp()
+        if layer is DNSRR:
+            return self.has_dns_answer()
+        return self.dissect().haslayer(layer)
+
+    def rewrite(self, src=None, dst=None, sport=None, dport=None):
+        """
+        Change several header fields with one checksum update (same result as setting the fields one by one)
+
+        :param src: new Source IP-Address (packed) or None
+        :param dst: new Destination IP-Address (packed) or None
+        :param sport: new TCP/UDP source port or None
+        :param dport: new TCP/UDP destination port or None
+        """
+        (offset, length) = _ADDRESS_OFFSET[self.version]
+        # (offset, new bytes) of the changed fields
+        fields = []
+        for index, address in ((0, src), (1, dst)):
+            if address is not None:
+                new = bytes(address)
+                if len(new) != length:
+                    raise ValueError("Address length " + str(len(new)) + " does not match IPv" + str(self.version))
+                fields.append((offset + index * length, new))
+        address_count = len(fields)
+        for index, port in ((0, sport), (2, dport)):
+            if port is not None:
+                if self._sport is None:
+                    raise ValueError("Packet has no TCP/UDP header")
+                fields.append((self.l4_offset + index, struct.pack("!H", port)))
+        if not fields:
+            return
+        data = self._data
+        if self._incremental:
+            # all fields have an even offset and length, the sums of the concatenated words are equal
+            old = b"".join(bytes(data[field_offset:field_offset + len(new)]) for field_offset, new in fields)
+            new = b"".join(new for _, new in fields)
+            if self.version == 4 and address_count:
+                address_length = address_count * length
+                self._patch_checksum(10, old[:address_length], new[:address_length])
+            self._patch_l4_checksum(old, new)
+        else:
+            self._dirty = True
+        for field_offset, new in fields:
+            data[field_offset:field_offset + len(new)] = new
+        if src is not None:
+            self._src = src
+        if dst is not None:
+            self._dst = dst
+        if sport is not None:
+            self._sport = sport
+        if dport is not None:
+            self._dport = dport
+
+    def _write_address(self, index, address):
+        (offset, length) = _ADDRESS_OFFSET[self.version]
+        offset += index * length
+        new = bytes(address)
+        if len(new) != length:
+            raise ValueError("Address length " + str(len(new)) + " does not match IPv" + str(self.version))
+        if self._incremental:
+            old = bytes(self._data[offset:offset + length])
+            if self.version == 4:
+                self._patch_checksum(10, old, new)
+            # addresses are part of the pseudo header
+            self._patch_l4_checksum(old, new)
+        else:
+            self._dirty = True
+        self._data[offset:offset + length] = new
+
+    def _write_port(self, index, port):
+        if self._sport is None:
+            raise ValueError("Packet has no TCP/UDP header")
+        offset = self.l4_offset + index
+        new = struct.pack("!H", port)
+        if self._incremental:
+            self._patch_l4_checksum(bytes(self._data[offset:offset + 2]), new)
+        else:
+            self._dirty = True
+        self._data[offset:offset + 2] = new
+
+    def _patch_l4_checksum(self, old, new):
+        """
+        Patch the TCP/UDP/ICMPv6 checksum (if the upper layer header is available)
+
+        :param old: replaced bytes
+        :param new: new bytes
+        """
+        offset = _CHECKSUM_OFFSET.get(self.proto)
+        if offset is None or self.l4_offset is None or len(self._data) < self.l4_offset + offset + 2:
+            return
+        if self._has_no_checksum():
+            return
+        self._patch_checksum(self.l4_offset + offset, old, new, self.proto == PROTO_UDP)
+
+    def _patch_checksum(self, offset, old, new, udp=False):
+        """
+        Incremental checksum update, RFC 1624 (Eqn. 3): HC' = ~(~HC + ~m + m')
+
+        :param offset: offset of the checksum field in the packet
+        :param old: replaced bytes (m, even length)
+        :param new: new bytes (m')
+        :param udp: UDP checksum (0 is transmitted as 0xFFFF)
+        """
+        (checksum,) = struct.unpack_from("!H", self._data, offset)
+        total = (~checksum & 0xFFFF) + (~_ones_complement_sum(old) & 0xFFFF) + _ones_complement_sum(new)
+        while total >> 16:
+            total = (total & 0xFFFF) + (total >> 16)
+        checksum = ~total & 0xFFFF
+        if checksum == 0 and udp:
+            # 0 means "no checksum" for UDP
+            checksum = 0xFFFF
+        struct.pack_into("!H", self._data, offset, checksum)
+
+    def update_checksums(self):
+        """
+        Recalculate the IPv4 header checksum and the TCP/UDP/ICMPv6 checksum if the header has been changed
+        """
+        if not self._dirty:
+            return
+        data = self._data
+        if self.version == 4:
+            ihl = (data[0] & 0x0F) * 4
+            data[10:12] = b"\x00\x00"
+            struct.pack_into("!H", data, 10, _checksum(data[:ihl]))
+        offset = _CHECKSUM_OFFSET.get(self.proto)
+        if offset is not None and self.l4_offset is not None and len(data) >= self.l4_offset + offset + 2:
+            if not self._has_no_checksum():
+                checksum_offset = self.l4_offset + offset
+                data[checksum_offset:checksum_offset + 2] = b"\x00\x00"
+                checksum = _checksum(self._pseudo_header() + data[self.l4_offset:])
+                if checksum == 0 and self.proto == PROTO_UDP:
+                    checksum = 0xFFFF
+                struct.pack_into("!H", data, checksum_offset, checksum)
+        self._dirty = False
+
+    def _has_no_checksum(self):
+        """
+        :return: True for IPv4 UDP packets without checksum (0) and ICMPv6 in IPv4
+        """
+        if self.version != 4:
+            return False
+        if self.proto == PROTO_UDP:
+            return self._data[self.l4_offset + 6:self.l4_offset + 8] == b"\x00\x00"
+        return self.proto == PROTO_ICMPV6
+
+    def _pseudo_header(self):
+        """
+        :return: IPv4 / IPv6 pseudo header of the upper layer checksum
+        """
+        (offset, length) = _ADDRESS_OFFSET[self.version]
+        addresses = bytes(self._data[offset:offset + 2 * length])
+        upper_length = len(self._data) - self.l4_offset
+        if self.version == 4:
+            return addresses + struct.pack("!BBH", 0, self.proto, upper_length)
+        return addresses + struct.pack("!I3xB", upper_length, self.proto)
+
+    def dissect(self):
+        """
+        Full scapy dissection of the current packet (slow, only use it if necessary)
+
+        :return: IPv4 / IPv6 packet (scapy)
+        """
+        if self.version == 4:
+            return IP(bytes(self._data))
+        return IPv6(bytes(self._data))
+
+    def load(self, packet):
+        """
+        Replace the packet with a (modified) scapy packet, lengths and checksums are recalculated by scapy
+
+        :param packet: IPv4 / IPv6 packet (scapy)
+        """
+        if self.version == 4:
+            del packet.chksum
+            del packet.len
+        counter = 0
+        while True:
+            layer = packet.getlayer(counter)
+            if layer is None:
+                break
+            # recalculate layer checksums
+            if isinstance(layer, _ICMPv6):
+                del layer.cksum
+            if isinstance(layer, UDP):
+                del layer.chksum
+                del layer.len
+            if isinstance(layer, TCP):
+                del layer.chksum
+            counter += 1
+        self._data = bytearray(bytes(packet))
+        self._parse()
+
+    def copy(self):
+        """
+        :return: Independent copy of this packet
+        """
+        return PacketView(self._data, self._incremental)
+
+    def payload(self):
+        """
+        :return: raw packet (bytes)
+        """
+        return bytes(self._data)
+
+    def __str__(self):
+        return "IPv" + str(self.version) + " " + unpack(self._src) + ":" + str(self._sport) + " -> " \
+               + unpack(self._dst) + ":" + str(self._dport) + " (proto " + str(self.proto) + ")"
+
+
+def _ones_complement_sum(data):
+    """
+    One's complement sum of 16 bit words
+    The sum is congruent to the big endian integer modulo 0xFFFF
+
+    :param data: bytes
+    :return: sum (Int)
+    """
+    if len(data) % 2:
+        data = bytes(data) + b"\x00"
+    total = int.from_bytes(data, "big") % 0xFFFF
+    if total == 0 and any(data):
+        total = 0xFFFF
+    return total
+
+
+def _checksum(data):
+    """
+    Internet checksum (RFC 1071)
+
+    :param data: bytes
+    :return: checksum (Int)
+    """
+    return ~_ones_complement_sum(data) & 0xFFFF
+
+
+def layer_filter(layer):
+    """
+    Describe which packets contain a scapy layer (used to compile the dispatch plan of the IpController)
+
+    :param layer: scapy layer class
+    :return: (ip versions, protocols (see DISPATCH_PROTOCOLS), predicate(packet) or None if no further check is required)
+    """
+    if layer is IP:
+        return (4,), DISPATCH_PROTOCOLS, None
+    if layer is IPv6:
+        return (6,), DISPATCH_PROTOCOLS, None
+    if layer is TCP:
+        return (4, 6), (PROTO_TCP,), None
+    if layer is UDP:
+        return (4, 6), (PROTO_UDP,), None
+    if layer is DNSRR:
+        return (4, 6), (PROTO_UDP,), PacketView.has_dns_answer
+    return (4, 6), DISPATCH_PROTOCOLS, lambda packet: packet.haslayer(layer)
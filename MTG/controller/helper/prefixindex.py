@@ -0,0 +1,83 @@
+from threading import Lock
+
+from netaddr import IPNetwork
+
+# Prefix classes (bit mask)
+WHITELIST = 0x01
+PH_SERVER = 0x02
+VIRTUAL_SUBNET = 0x04
+
+_ADDRESS_BITS = {4: 32, 6: 128}
+
+
+class PrefixIndex:
+    """
+    Longest prefix match index for IPv4 and IPv6 subnets (whitelist, PH server subnets, virtual subnets)
+
+    Prefixes are stored in one hash table per prefix length, a lookup checks the lengths in use from the longest
+    to the shortest one. Every prefix stores the classes of all configured prefixes which contain it,
+    so the longest match returns all classes of the address.
+    The tables are rebuilt if the prefixes of a class change (e.g. virtual subnets of the MT Controller)
+    and replaced at once, lookups are not blocked.
+    """
+    def __init__(self):
+        # class: List of IPNetwork
+        self._prefixes = {}
+        # version: ((host bits, {network >> host bits: classes}), ..) longest prefix first
+        self._tables = {4: (), 6: ()}
+        self._lock = Lock()
+
+    def set_prefixes(self, prefix_class, prefixes):
+        """
+        Replace the prefixes of a class
+
+        :param prefix_class: WHITELIST, PH_SERVER or VIRTUAL_SUBNET
+        :param prefixes: List of IP-Addresses or Subnets (Strings) or None
+        """
+        networks = [IPNetwork(prefix) for prefix in (prefixes or [])]
+        with self._lock:
+            self._prefixes[prefix_class] = networks
+            self._tables = self._build()
+
+    def _build(self):
+        entries = {4: {}, 6: {}}
+        for prefix_class, networks in self._prefixes.items():
+            for network in networks:
+                key = (network.prefixlen, network.value >> (_ADDRESS_BITS[network.version] - network.prefixlen))
+                entries[network.version][key] = entries[network.version].get(key, 0) | prefix_class
+        tables = {}
+        for version, version_entries in entries.items():
+            bits = _ADDRESS_BITS[version]
+            tables_by_length = {}
+            for (length, key), classes in version_entries.items():
+                # inherit the classes of all shorter prefixes containing this prefix
+                for (other_length, other_key), other_classes in version_entries.items():
+                    if other_length < length and key >> (length - other_length) == other_key:
+                        classes |= other_classes
+                tables_by_length.setdefault(length, {})[key] = classes
+            lengths = tuple(sorted(tables_by_length, reverse=True))
+            tables[version] = tuple((bits - length, tables_by_length[length]) for length in lengths)
+        return tables
+
+    def lookup(self, address):
+        """
+        Classes of an address
+
+        :param address: IPv4 (4 bytes) or IPv6 (16 bytes) address (binary)
+        :return: bit mask of the classes (0 if no prefix matches)
+        """
+        return self.lookup_int(int.from_bytes(address, "big"), 4 if len(address) == 4 else 6)
+
+    def lookup_int(self, value, version):
+        """
+        Classes of an address
+
+        :param value: IPv4 / IPv6 address (Integer)
+        :param version: 4 / 6
+        :return: bit mask of the classes (0 if no prefix matches)
+        """
+        for (host_bits, table) in self._tables[version]:
+            classes = table.get(value >> host_bits)
+            if classes is not None:
+                return classes
+        return 0
@@ -10,7 +10,7 @@ class ILayerController(ITranslator):
         Return true if packet should be redirected
         Return false if packet should be dropped
         :rtype: Boolean
-        :param packet: IP/Ipv6 Scapy Package
+        :param packet: IP/Ipv6 Packet (PacketView)
         """
         pass
     
@@ -1,11 +1,12 @@
-from scapy.layers.inet import TCP, IP
+from scapy.layers.inet import IP
 from scapy.layers.inet6 import IPv6
 
 from InternalLogger.internallogger import InternalLogger
+from controller.helper.address import pack, unpack
 from controller.helper.networkhelper import NetworkHelper
+from controller.helper.prefixindex import WHITELIST, VIRTUAL_SUBNET
 from controller.ilayercontroller import ILayerController
 from controller.itranslator import IO
-from netaddr import *
 
 class IPTranslatorNAS(ILayerController):
     """
@@ -18,107 +19,129 @@ class IPTranslatorNAS(ILayerController):
         """
         return [IP, IPv6]
 
-    def __init__(self, mapping, whitelist, io, track, nas_tracker, dynamic_port_priority):
+    def __init__(self, mapping, prefix_index, io, track, nas_tracker, dynamic_port_priority):
         """
 
         :param mapping: HF Mapping
-        :param whitelist: Whitelist IPs
+        :param prefix_index: Whitelist and virtual subnets (PrefixIndex, shared by all translators)
         :param io: Input or Output
         :param track: Track Connections (Bool)
         :param nas_tracker: NAS Tracker Class (IConnectionTracker)
         """
         self._nas_tracker = nas_tracker
         super().__init__(mapping, io)
-        self._whitelist = whitelist
+        self._prefix_index = prefix_index
         self._track = track
-        self._network_helper = NetworkHelper()
+        self._network_helper = NetworkHelper.get()
         self._dyn_port_priority = dynamic_port_priority
         self._honeypot = False
         self._honey_v4 = None
         self._honey_v6 = None
 
     def set_honeypot(self, v4, v6):
+        """
+        :param v4: IPv4 address of the honeypot (String)
+        :param v6: IPv6 address of the honeypot (String)
+        """
         self._honeypot = True
-        self._honey_v4 = v4
-        self._honey_v6 = v6
+        self._honey_v4 = pack(v4)
+        self._honey_v6 = pack(v6)
+
+    def set_virtual_subnets(self, v_subnets):
+        """
+        :param v_subnets: List of virtual subnets (MT Controller)
+        """
+        super().set_virtual_subnets(v_subnets)
+        self._prefix_index.set_prefixes(VIRTUAL_SUBNET, v_subnets)
 
     def process_packet(self, packet):
         """
 
-        :param packet: IPv4 /Ipv6 Packet
+        :param packet: IPv4 /Ipv6 Packet (PacketView)
         :return: Forward?
         """
+        (forward, new_ip) = self.translate(packet, packet)
+        if new_ip is not None:
+            if self._io == IO.INPUT:
+                packet.dst = new_ip
+            else:
+                packet.src = new_ip
+        return forward
+
+    def translate(self, packet, flow, dst_classes=None, local=None):
+        """
+        Calculate the new address without changing the packet (used by the FusedTranslator as well)
+
+        :param packet: IPv4 /Ipv6 Packet (PacketView)
+        :param flow: packet or FlowEvent of the packet with translated ports (incoming packets, FusedTranslator),
+         used to search and add tracked connections
+        :param dst_classes: classes of the destination (PrefixIndex), looked up if None
+        :param local: destination is a local address, checked if None
+        :return: (Forward?, new destination (incoming) / source (leaving) address or None)
+        """
         #manipulate incoming packet
         if self._io == IO.INPUT:
             if self._mapping is not None:
                 new_ip = self._mapping.get(packet.dst)
                 #vIP found in Mapping
                 if new_ip is not None:
-                    packet.dst = new_ip
-                    InternalLogger.get().debug("DST changed to " + new_ip + "(from mapping)")
+                    InternalLogger.get().debug("DST changed to " + unpack(new_ip) + "(from mapping)")
+                    return True, new_ip
                 else:
                 #no vIP found in mapping
-                    is_whitelist = False
-                    #search in whitelist
-                    for whitelist_address in self._whitelist:
-                        if packet.dst in IPNetwork(whitelist_address):
-                            is_whitelist = True
-                            break
-                    if is_whitelist:
+                    #search in whitelist and virtual subnets (one lookup)
+                    if dst_classes is None:
+                        dst_classes = self._prefix_index.lookup(packet.dst)
+                    if dst_classes & WHITELIST:
                         InternalLogger.get().debug("IP-NAS: Forwarding the incoming packet, "
                                                    "whitelist")
-                        return True
+                        return True, None
                     #search in local addresses (should it be forwarded to this host internally?)
-                    elif packet.dst in self._network_helper.local_addresses():
+                    elif local if local is not None else self._network_helper.is_local(packet.dst):
                         InternalLogger.get().debug("IP-NAS: Accepting the incoming packet, destination = local address")
-                        return True
+                        return True, None
 
                     #search for vIP in Connection Tracker
                     InternalLogger.get().debug("No mapping, searching tracker buffer")
                     new_ip_tracked = None
                     if self._track:
-                        new_ip_tracked = self.check_buffer(packet)
+                        new_ip_tracked = self.check_buffer(flow)
                     else:
                         InternalLogger.get().debug("WARNING: Tried to reach MT Area, DROPPED")
                     if new_ip_tracked is not None:
                         #vIP found
-                        packet.dst = new_ip_tracked
+                        return True, new_ip_tracked
                     else:
                         #Send to honeypot?
-                        if self._honeypot and packet.haslayer(TCP):
+                        if self._honeypot and packet.is_tcp():
                             vsubnet = False
                             #check if destination is part of the virtual subnet
                             if self._virtual_subnets is not None:
-                                for subnet in self._virtual_subnets:
-                                    if packet.dst in IPNetwork(subnet):
-                                        vsubnet = True
-                                        break
+                                vsubnet = bool(dst_classes & VIRTUAL_SUBNET)
                             else:
                                 InternalLogger.get().error("No virtual subnets")
                             if vsubnet:
                                 #dst is in vSubnet, set honeypot
                                 new_ip_honeypot = None
-                                if IPAddress(packet.dst).version == 4:
+                                if packet.version == 4:
                                     new_ip_honeypot = self._honey_v4
                                 else:
                                     new_ip_honeypot = self._honey_v6
                                 if new_ip_honeypot is not None:
                                     #add to connection tracking:
-                                    tcp = packet[TCP]
-                                    self._nas_tracker.add_connection(packet.src, tcp.sport, packet.dst, tcp.dport, new_ip_honeypot, True)
-                                    packet.dst = new_ip_honeypot
+                                    self._nas_tracker.add_connection(flow.src, flow.sport, flow.dst, flow.dport, new_ip_honeypot, True)
 
-                                    InternalLogger.get().debug("WARNING: Tried to reach MT Area, forwarded to HONEYPOT (" + new_ip_honeypot + ")")
-                                    return True
+                                    InternalLogger.get().debug("WARNING: Tried to reach MT Area, forwarded to HONEYPOT (" + unpack(new_ip_honeypot) + ")")
+                                    return True, new_ip_honeypot
                                 else:
                                     InternalLogger.get().error("No HoneyPot Address")
-                                    return False
+                                    return False, None
                             else:
                                 InternalLogger.get().debug("WARNING: Tried to reach MT Area, DROPPED (Not in Virtual Subnet, Honeypot not used)")
                         else:
                             #vIP not found
                             InternalLogger.get().debug("WARNING: Tried to reach MT Area, DROPPED")
-                            return False
+                            return False, None
             else:
                 InternalLogger.get().critical("ERROR: No mapping")
 
@@ -129,32 +152,31 @@ class IPTranslatorNAS(ILayerController):
             if self._track:
                 new_ip_tracked = self.check_buffer(packet)
             if new_ip_tracked is not None:
-                packet.src = new_ip_tracked
-                InternalLogger.get().debug("SRC changed to  " + new_ip_tracked + " (from buffer)")
+                InternalLogger.get().debug("SRC changed to  " + unpack(new_ip_tracked) + " (from buffer)")
+                return True, new_ip_tracked
             #not in tracking, search in mapping
             else:
                 new_ip = self._mapping.get(packet.src)
                 if new_ip is not None:
-                    packet.src = new_ip
-                    InternalLogger.get().debug("SRC changed to " + new_ip + "(from mapping)")
+                    InternalLogger.get().debug("SRC changed to " + unpack(new_ip) + "(from mapping)")
+                    return True, new_ip
                 else:
                     InternalLogger.get().debug("Forwarding the leaving packet, SRC != MTD Host")
-        return True
+        return True, None
 
     def check_buffer(self, packet):
         """
         Check if a mapping for the connection exisits in the connection tacker buffer
-        :param packet:
+        :param packet: IPv4 / IPv6 Packet (PacketView) or FlowEvent
         :return:
         """
         tracked_ip = None
-        if packet.haslayer(TCP):
-            tcp = packet[TCP]
+        if packet.is_tcp():
             port = 0
             if self._io == IO.INPUT:
-                port = tcp.dport
+                port = packet.dport
             else:
-                port = tcp.sport
+                port = packet.sport
             # check if this connection is allowed to continue based on connection tracking
             result = self._nas_tracker.check_buffer(packet, self._io)
 
@@ -173,5 +195,5 @@ class IPTranslatorNAS(ILayerController):
         """
         Forward new Mapping to the tracker
         """
-        if self._nas_tracker is not None:
-            self._nas_tracker.set_mapping(self._mapping)
\ No newline at end of file
+        if self._nas_tracker is not None and self._snapshot is not None:
+            self._nas_tracker.set_mapping(self._snapshot.forward)
\ No newline at end of file
@@ -2,6 +2,8 @@ import abc
 from abc import ABC
 from enum import Enum
 
+from controller.helper.mappingsnapshot import MappingSnapshot
+
 
 class ITranslator(ABC):
     """
@@ -9,21 +11,27 @@ class ITranslator(ABC):
     """
     def __init__(self, mapping, io):
         self._io = io
+        self._snapshot = None
         self.set_mapping(mapping)
         self._virtual_subnets = None
 
     def set_mapping(self, mapping):
         """
-        Set incoming mapping and reverse it if
-        :param mapping:
+        Set the mapping, the index of the direction (INPUT: vIP -> rIP, OUTPUT: rIP -> vIP) is used
+        :param mapping: MappingSnapshot (built once by the HfController) or vIP: rIP (Strings)
         """
         if mapping is None:
+            self._snapshot = None
             self._mapping = None
         else:
+            if not isinstance(mapping, MappingSnapshot):
+                mapping = MappingSnapshot.build(mapping)
+            self._snapshot = mapping
+            # one reference swap, packet threads only read self._mapping
             if self._io == IO.INPUT:
-                self._mapping = mapping
+                self._mapping = mapping.forward
             else:
-                self._mapping = {v: k for k, v in mapping.items()}
+                self._mapping = mapping.reverse
         self.mapping_changed()
 
     @abc.abstractmethod
@@ -0,0 +1,52 @@
+import hashlib
+import time
+
+from controller.ph_function.epochphfunction import EpochPhFunction
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+
+class AesCtrFunction(EpochPhFunction):
+    """
+        Port Hopping Function based on an AES-CTR keystream (requires the cryptography package)
+
+        hash = first 2 bytes of the AES-128-CTR keystream with the counter block
+        (client nonce (8 bytes), T (8 bytes)). The AES key is derived from the PSK (blake2b, 16 bytes),
+        the client nonce from the packed client address (blake2b, 8 bytes).
+    """
+    def __init__(self, hopping_period, max_buffer, keymap=None, acceptance_window=0, service_ports=None,
+                 clock=time.time):
+        """
+
+        :param hopping_period: Hopping Period in Seconds
+        :param max_buffer: Maximum Hash Buffer (clients which are not in the keymap)
+        :param keymap: Map of IPs (Strings) to PSKs, hashes of these clients are precomputed
+        :param acceptance_window: 0: only T is accepted, 1: T-1, T and T+1 are accepted for incoming packets
+        :param service_ports: rPorts of the services (known before a leaving packet is seen)
+        :param clock: time function (seconds)
+        """
+        if Cipher is None:
+            raise ImportError("The PH function aes_ctr requires the cryptography package")
+        super().__init__(hopping_period, max_buffer, keymap, acceptance_window, service_ports, clock)
+        # PSK: AES key
+        self._aes_keys = {}
+        self.start()
+
+    def epoch_hasher(self, t):
+        """
+        :param t: T
+        :return: function (PSK, packed client IP) -> hash (Int, 16 bit) of T
+        """
+        t_bytes = t.to_bytes(8, byteorder='big')
+
+        def hasher(key, client_ip):
+            aes_key = self._aes_keys.get(key)
+            if aes_key is None:
+                aes_key = self._aes_keys[key] = hashlib.blake2b(key.encode(), digest_size=16).digest()
+            nonce = hashlib.blake2b(client_ip, digest_size=8).digest()
+            encryptor = Cipher(algorithms.AES(aes_key), modes.CTR(nonce + t_bytes)).encryptor()
+            return int.from_bytes(encryptor.update(b"\0\0"), byteorder='big', signed=False)
+        return hasher
@@ -0,0 +1,340 @@
+import abc
+import time
+from array import array
+from collections import OrderedDict
+from threading import Thread, Lock, Event
+
+from InternalLogger.internallogger import InternalLogger
+from controller.helper.address import pack
+from controller.ph_function.iphfunction import IPhFunction
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# values of the known ports: learned in T, learned in T-1 (both known), service port (always known)
+_LEARNED = 1
+_LEARNED_BEFORE = 2
+_SERVICE = 255
+# aging at the boundary of T: learned in T -> learned in T-1 -> unknown
+_AGE = bytes([_LEARNED_BEFORE if value == _LEARNED else value if value == _SERVICE else 0 for value in range(256)])
+
+
+class EpochPhFunction(IPhFunction):
+    """
+        Port Hopping Function based on a hash per time interval (T) and client: vPort = hash ^ rPort
+
+        The hashes of all clients of the keymap are precomputed for the current and the next time interval (T)
+        by a background thread, the tables are replaced at the boundary of the interval. Translating a port is
+        a lookup in the table of the current T and an XOR. Hashes of other clients are calculated on demand (buffer).
+
+        Clock skew: with an acceptance window, the tables of T-1 and T+1 are kept as well. If the rPort of an
+        incoming vPort is not a known port (service ports, rPorts of leaving packets of T and T-1), the rPorts of
+        T-1 and T+1 are checked (lookups, no hashing). The used offsets are counted (offset_counters).
+        Learned rPorts are aged at the boundary of T, so ephemeral ports of finished connections are forgotten.
+
+        Batches (offline replay, evaluation, batched pipelines) are translated with NumPy (optional): the clients
+        of the keymap are numbered (client_indices), every table has an array client index -> hash, a batch is
+        translated by indexing and a vectorized XOR (real_ports_to_vports, virtual_ports_to_rports).
+
+        Subclasses implement the hash (epoch_hasher).
+    """
+    # the missing NumPy is logged once per process
+    _numpy_missing_logged = False
+
+    def __init__(self, hopping_period, max_buffer, keymap=None, acceptance_window=0, service_ports=None,
+                 clock=time.time):
+        """
+
+        :param hopping_period: Hopping Period in Seconds
+        :param max_buffer: Maximum Hash Buffer (clients which are not in the keymap)
+        :param keymap: Map of IPs (Strings) to PSKs, hashes of these clients are precomputed
+        :param acceptance_window: 0: only T is accepted, 1: T-1, T and T+1 are accepted for incoming packets
+        :param service_ports: rPorts of the services (known before a leaving packet is seen)
+        :param clock: time function (seconds)
+        """
+        super().__init__()
+        self._hopping_period = hopping_period
+        self._stopped = Event()
+        self._thread = None
+        self._max_buffer = max_buffer
+        self._clock = clock
+        self._hash_buffer = OrderedDict()
+        self._buffer_lock = Lock()
+        # packed IP: PSK
+        self._keymap = {pack(ip): key for ip, key in (keymap or {}).items()}
+        # packed IP: client index (order of the hash arrays)
+        self._client_index = {client_ip: index for index, client_ip in enumerate(self._keymap)}
+        self._acceptance_window = acceptance_window
+        # port: 0 or _LEARNED, _LEARNED_BEFORE, _SERVICE (known rPort), replaced at the boundary of T
+        self._known_ports = bytearray(65536)
+        for port in (service_ports or []):
+            self._known_ports[int(port)] = _SERVICE
+        # uses of T (index 0), T+1 (index 1), T-1 (index -1 = 3) and vPorts without known rPort (index 2)
+        self._offset_counters = array("Q", bytes(8 * 4))
+        # T: {packed client IP: hash} (never changed after it has been built)
+        self._tables = {}
+        # (T, table of T, ((offset, table), ..) of the acceptance window), replaced at the boundary of T
+        self._current = None
+        # T: hash array (client index: hash), only with NumPy
+        self._hash_arrays = {}
+        # (T, hash array of T, ((offset, hash array), ..) of the acceptance window)
+        self._current_arrays = None
+
+    def start(self):
+        """
+        Build the tables of the current T and start the thread replacing them (called by the subclass constructor)
+        """
+        if numpy is None and not EpochPhFunction._numpy_missing_logged:
+            EpochPhFunction._numpy_missing_logged = True
+            InternalLogger.get().info("NumPy is not installed, ports are translated one by one "
+                                      "(batch translation is not available)")
+        self._update_tables()
+        self._thread = Thread(target=self._run, daemon=True, name=type(self).__name__)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the thread replacing the tables (the current tables are kept, they are not replaced anymore)
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    @abc.abstractmethod
+    def epoch_hasher(self, t):
+        """
+        :param t: T
+        :return: function (PSK, packed client IP) -> hash (Int, 16 bit) of T
+        """
+        pass
+
+    def real_port_to_vport(self, r_port, client_ip, client_key):
+        """
+
+        :param r_port: Int, Real Port
+        :param client_ip: packed Client IP Address
+        :param client_key: String, Client PreShared Key (the key of the keymap is used for precomputed hashes)
+        :return: Virtual Port, Int
+        """
+        (t, table, window) = self._current
+        h = table.get(client_ip)
+        if h is None:
+            h = self.get_hash(t, client_key, client_ip)
+        known_ports = self._known_ports
+        if known_ports[r_port] != _SERVICE:
+            known_ports[r_port] = _LEARNED
+        return h ^ r_port
+
+    def virtual_port_to_rport(self, v_port, client_ip, client_key):
+        """
+
+        :param v_port: Int, Virtual Port
+        :param client_ip: packed Client IP Address
+        :param client_key: String, Client PreShared Key (the key of the keymap is used for precomputed hashes)
+        :return: Real Port, Int
+        """
+        (t, table, window) = self._current
+        h = table.get(client_ip)
+        if h is None:
+            # not in the keymap, no acceptance window
+            return self.get_hash(t, client_key, client_ip) ^ v_port
+        r_port = h ^ v_port
+        if not window:
+            return r_port
+        if not self._known_ports[r_port]:
+            for offset, other_table in window:
+                other_r_port = other_table[client_ip] ^ v_port
+                if self._known_ports[other_r_port]:
+                    self._offset_counters[offset] += 1
+                    return other_r_port
+            self._offset_counters[2] += 1
+        else:
+            self._offset_counters[0] += 1
+        return r_port
+
+    def get_T(self):
+        """
+        get T, time interval value
+        :return: T
+        """
+        return int(self._clock() / self._hopping_period)
+
+    def offset_counters(self):
+        """
+        :return: number of incoming vPorts translated with T-1, T, T+1 and without known rPort (Dictionary)
+        """
+        counters = self._offset_counters
+        return {"T-1": counters[-1], "T": counters[0], "T+1": counters[1], "unknown": counters[2]}
+
+    def table_size(self):
+        """
+        :return: number of precomputed hashes (all tables)
+        """
+        return sum(len(table) for table in self._tables.values())
+
+    def _run(self):
+        """
+        Replace the tables at the boundary of T and precompute the table of the next T
+        """
+        while not self._stopped.is_set():
+            try:
+                (t, table, window) = self._current
+                if self._stopped.wait(max(0.0, (t + 1) * self._hopping_period - self._clock())):
+                    return
+                self._update_tables()
+            except Exception as e:
+                InternalLogger.get().error("Error: " + str(e), exc_info=True)
+                self._stopped.wait(1)
+
+    def _update_tables(self):
+        """
+        Use the (prefetched) table of the current T, build the table of the next T
+        """
+        t = self.get_T()
+        table = self._tables.get(t)
+        if table is None:
+            table = self.build_table(t)
+        tables = {t: table}
+        if self._acceptance_window:
+            # T-1 is the previous table (built at the start)
+            previous_table = self._tables.get(t - 1)
+            if previous_table is None:
+                previous_table = self.build_table(t - 1)
+            tables[t - 1] = previous_table
+            self._current = (t, table, ((-1, previous_table),))
+        else:
+            self._current = (t, table, ())
+        next_table = self._tables.get(t + 1)
+        if next_table is None:
+            next_table = self.build_table(t + 1)
+        tables[t + 1] = next_table
+        if self._acceptance_window:
+            self._current = (t, table, ((-1, previous_table), (1, next_table)))
+        self._tables = tables
+        if numpy is not None:
+            self._update_hash_arrays(t)
+        if self._acceptance_window:
+            self._age_known_ports()
+            InternalLogger.get().info(type(self).__name__ + " T = " + str(t) + ", offsets used: "
+                                      + str(self.offset_counters()))
+
+    def _age_known_ports(self):
+        """
+        Forget rPorts which have not been used by leaving packets in T-1 and T-2 (one reference swap,
+        a port learned in the old array during the swap is learned again by the next leaving packet)
+        """
+        self._known_ports = bytearray(self._known_ports.translate(_AGE))
+
+    def _update_hash_arrays(self, t):
+        """
+        Hash arrays of the current tables (built once per table)
+        """
+        hash_arrays = {}
+        for table_t, table in self._tables.items():
+            hash_array = self._hash_arrays.get(table_t)
+            if hash_array is None:
+                hash_array = numpy.fromiter((table[client_ip] for client_ip in self._client_index),
+                                            dtype=numpy.uint16, count=len(self._client_index))
+            hash_arrays[table_t] = hash_array
+        window = tuple((offset, hash_arrays[t + offset]) for offset in (-1, 1) if self._acceptance_window)
+        self._hash_arrays = hash_arrays
+        self._current_arrays = (t, hash_arrays[t], window)
+
+    def client_indices(self, client_ips):
+        """
+        :param client_ips: packed client IPs (Iterable)
+        :return: client indices (NumPy array, -1 if the client is not in the keymap)
+        """
+        index = self._client_index
+        return numpy.fromiter((index.get(client_ip, -1) for client_ip in client_ips), dtype=numpy.intp)
+
+    def real_ports_to_vports(self, r_ports, client_indices):
+        """
+        Batch version of real_port_to_vport (clients of the keymap)
+
+        :param r_ports: real ports (NumPy array)
+        :param client_indices: client indices (NumPy array, see client_indices)
+        :return: virtual ports (NumPy array, uint16)
+        """
+        (t, hashes, window) = self._batch_arrays(client_indices)
+        r_ports = numpy.asarray(r_ports, dtype=numpy.uint16)
+        known_ports = numpy.frombuffer(self._known_ports, dtype=numpy.uint8)
+        known_ports[r_ports] = numpy.where(known_ports[r_ports] == _SERVICE, _SERVICE, _LEARNED)
+        return hashes[client_indices] ^ r_ports
+
+    def virtual_ports_to_rports(self, v_ports, client_indices):
+        """
+        Batch version of virtual_port_to_rport (clients of the keymap, same acceptance window)
+
+        :param v_ports: virtual ports (NumPy array)
+        :param client_indices: client indices (NumPy array, see client_indices)
+        :return: real ports (NumPy array, uint16)
+        """
+        (t, hashes, window) = self._batch_arrays(client_indices)
+        v_ports = numpy.asarray(v_ports, dtype=numpy.uint16)
+        r_ports = hashes[client_indices] ^ v_ports
+        if not window:
+            return r_ports
+        known_ports = numpy.frombuffer(self._known_ports, dtype=numpy.uint8)
+        known = known_ports[r_ports].astype(bool)
+        self._offset_counters[0] += int(numpy.count_nonzero(known))
+        for offset, other_hashes in window:
+            other_r_ports = other_hashes[client_indices] ^ v_ports
+            use = ~known & known_ports[other_r_ports].astype(bool)
+            r_ports = numpy.where(use, other_r_ports, r_ports)
+            self._offset_counters[offset] += int(numpy.count_nonzero(use))
+            known |= use
+        self._offset_counters[2] += int(len(known) - numpy.count_nonzero(known))
+        return r_ports
+
+    def _batch_arrays(self, client_indices):
+        """
+        :return: (T, hash array, window) of the current T
+        :raises ImportError: NumPy is not installed
+        :raises ValueError: a client is not in the keymap
+        """
+        if numpy is None:
+            raise ImportError("Batch translation requires numpy")
+        if len(client_indices) and numpy.min(client_indices) < 0:
+            raise ValueError("Batch translation is only possible for clients of the keymap")
+        return self._current_arrays
+
+    def build_table(self, t):
+        """
+        :param t: T
+        :return: packed client IP: hash of all clients of the keymap
+        """
+        hasher = self.epoch_hasher(t)
+        return {client_ip: hasher(key, client_ip) for client_ip, key in self._keymap.items()}
+
+    def get_hash(self, t, key, client_ip):
+        """
+
+        :param t:  t = T = Time Interval Value
+        :param key: PSK
+        :param client_ip: IP of the Client (packed)
+        :return: Hash
+        """
+
+        #Search in Buffer first
+        with self._buffer_lock:
+            hash_int = self._hash_buffer.get((t, key, client_ip))
+            if hash_int is not None:
+                self._hash_buffer.move_to_end((t, key, client_ip), last=False)
+                return hash_int
+
+        # Generate
+        InternalLogger.get().debug("Trying to generate hash")
+        hash_int = self.epoch_hasher(t)(key, client_ip)
+
+        # Save to buffer
+        with self._buffer_lock:
+            self._hash_buffer[(t, key, client_ip)] = hash_int
+            self._hash_buffer.move_to_end((t, key, client_ip), last=False) # move to the beginning
+            # Cleanup
+            while(len(self._hash_buffer) > self._max_buffer):
+                #remove first element(s)
+                self._hash_buffer.popitem(last=True)
+        return hash_int
@@ -7,7 +7,7 @@ class IPhFunction():
         Return vPort for rPort
         Return None if no valid port could be found
         :param client_key: String
-        :param client_ip: String
+        :param client_ip: packed IP-Address (see controller.helper.address)
         :rtype: int (Port)
         :param v_port: virtual port
         """
@@ -19,9 +19,14 @@ class IPhFunction():
         Return rPort for vPort
         Return None if no valid port could be found
         :param client_key: String
-        :param client_ip:  String
+        :param client_ip: packed IP-Address (see controller.helper.address)
         :rtype: int (Port)
         :param r_port: virtual port
         """
         pass
 
+    def stop(self):
+        """
+        Stop background threads of the function (if any)
+        """
+        pass
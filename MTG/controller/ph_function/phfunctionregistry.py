@@ -0,0 +1,30 @@
+from controller.ph_function.aesctrfunction import AesCtrFunction
+from controller.ph_function.rpahfunction import RpahFunction
+from controller.ph_function.siphashfunction import SipHashFunction
+from controller.ph_function.testphfunction import TestPhFunction
+
+# name (ph.function): PH function class
+PH_FUNCTIONS = {
+    "rpah": RpahFunction,
+    "siphash": SipHashFunction,
+    "aes_ctr": AesCtrFunction,
+    "test": TestPhFunction,
+}
+
+
+def create_ph_function(name, hopping_period, max_buffer, keymap=None, acceptance_window=0, service_ports=None):
+    """
+    Create the Port Hopping Function selected by the configuration
+
+    :param name: name of the PH function (PH_FUNCTIONS)
+    :param hopping_period: Hopping Period in Seconds
+    :param max_buffer: Maximum Hash Buffer (clients which are not in the keymap)
+    :param keymap: Map of IPs (Strings) to PSKs
+    :param acceptance_window: 0: only T is accepted, 1: T-1, T and T+1 are accepted for incoming packets
+    :param service_ports: rPorts of the services
+    :return: IPhFunction
+    """
+    ph_function_class = PH_FUNCTIONS.get(name)
+    if ph_function_class is None:
+        raise ValueError("Unknown PH function " + str(name) + ", available: " + ", ".join(PH_FUNCTIONS))
+    return ph_function_class(hopping_period, max_buffer, keymap, acceptance_window, service_ports)
@@ -1,98 +1,68 @@
 import hashlib
+import time
 from collections import OrderedDict
-from random import random, randint
+from threading import Lock
 
-from InternalLogger.internallogger import InternalLogger
-from controller.ph_function.iphfunction import IPhFunction
-from datetime import datetime
+from controller.helper.address import unpack
+from controller.ph_function.epochphfunction import EpochPhFunction
 
+# hashed for T (the hash input of T are T zero bytes)
+_ZEROS = memoryview(bytes(1 << 20))
 
-class RpahFunction(IPhFunction):
+
+class RpahFunction(EpochPhFunction):
     """
         RPAH inspired Port Hopping Function
+
+        hash = blake2b (2 bytes) of T zero bytes, PSK and the canonical textual client address.
+        The blake2b state after T is computed once per T and copied for every client.
     """
-    def __init__(self, hopping_period, max_buffer):
+    def __init__(self, hopping_period, max_buffer, keymap=None, acceptance_window=0, service_ports=None,
+                 clock=time.time):
         """
 
         :param hopping_period: Hopping Period in Seconds
-        :param max_buffer: Maximum Hash Buffer
-        """
-        super().__init__()
-        self._hopping_period = hopping_period
-        self._hash_buffer = OrderedDict()
-        self._max_buffer = max_buffer
-
-    def real_port_to_vport(self, r_port, client_ip, client_key):
-        """
-
-        :param r_port: Int, Real Port
-        :param client_ip: String, Client IP Address
-        :param client_key: String, Client PreShared Key
-        :return: Virtual Port, Int
-        """
-        t = self.get_T()
-        h = self.get_hash(t, client_key, client_ip)
-        v_port = h ^ r_port
-        InternalLogger.get().debug("RPAH vPort =" + str(v_port))
-        return v_port
-
-    def virtual_port_to_rport(self, v_port, client_ip, client_key):
-        """
-
-        :param v_port: Int, Virtual Port
-        :param client_ip: String, Client IP Address
-        :param client_key: String, Client PreShared Key
-        :return: Real Port, Int
+        :param max_buffer: Maximum Hash Buffer (clients which are not in the keymap)
+        :param keymap: Map of IPs (Strings) to PSKs, hashes of these clients are precomputed
+        :param acceptance_window: 0: only T is accepted, 1: T-1, T and T+1 are accepted for incoming packets
+        :param service_ports: rPorts of the services (known before a leaving packet is seen)
+        :param clock: time function (seconds)
         """
-        t = self.get_T()
-        h = self.get_hash(t, client_key, client_ip)
-        r_port = h ^ v_port
-        InternalLogger.get().debug("RPAH rPort =" + str(r_port))
-        return r_port
+        super().__init__(hopping_period, max_buffer, keymap, acceptance_window, service_ports, clock)
+        # T: blake2b state after hashing T
+        self._t_states = OrderedDict()
+        self._t_lock = Lock()
+        self.start()
 
-    def get_T(self):
+    def epoch_hasher(self, t):
         """
-        get T, time interval value
-        :return: T
+        :param t: T
+        :return: function (PSK, packed client IP) -> hash (Int, 16 bit) of T
         """
-        now = datetime.now()
-        timestamp = datetime.timestamp(now)
-        #random time
-        #timestamp = timestamp + (randint(-3, 3) / 10)
+        t_state = self._t_state(t)
 
-        return int(timestamp / self._hopping_period)
+        def hasher(key, client_ip):
+            h = t_state.copy()
+            h.update(key.encode())
+            h.update(unpack(client_ip).encode())
+            return int.from_bytes(h.digest(), byteorder='big',  signed=False)
+        return hasher
 
-    def get_hash(self, t, key, client_ip):
+    def _t_state(self, t):
         """
-
-        :param t:  t = T = Time Interval Value
-        :param key: PSK
-        :param client_ip: IP of the Client
-        :return: Hash
+        :param t: T
+        :return: blake2b state after hashing T (shared, has to be copied)
         """
-
-        #Search in Buffer first
-        InternalLogger.get().debug("Searching for hash in buffer")
-        hash_int = self._hash_buffer.get((t, key, client_ip))
-        if hash_int is not None:
-            InternalLogger.get().debug("Found hash in buffer")
-            self._hash_buffer.move_to_end((t, key, client_ip), last=False)
-            return hash_int
-
-        # Generate
-        InternalLogger.get().debug("Trying to generate hash")
-        h = hashlib.blake2b(digest_size=2)          # optimized for 64 bit
-        h.update(bytes(t))
-        h.update(key.encode())
-        h.update(client_ip.encode())
-        hash_result = h.digest()
-        hash_int = int.from_bytes(hash_result, byteorder='big',  signed=False)
-
-        # Save to buffer
-        self._hash_buffer[(t, key, client_ip)] = hash_int
-        self._hash_buffer.move_to_end((t, key, client_ip), last=False) # move to the beginning
-        # Cleanup
-        while(len(self._hash_buffer) > self._max_buffer):
-            #remove first element(s)
-            self._hash_buffer.popitem(last=True)
-        return hash_int
+        with self._t_lock:
+            h = self._t_states.get(t)
+            if h is None:
+                h = hashlib.blake2b(digest_size=2)          # optimized for 64 bit
+                # same as h.update(bytes(t)) without allocating T bytes
+                remaining = t
+                while remaining > 0:
+                    h.update(_ZEROS[:remaining])
+                    remaining -= len(_ZEROS)
+                self._t_states[t] = h
+                while len(self._t_states) > 4:
+                    self._t_states.popitem(last=False)
+            return h
@@ -0,0 +1,92 @@
+import hashlib
+import struct
+import time
+
+from controller.ph_function.epochphfunction import EpochPhFunction
+
+_MASK = 0xffffffffffffffff
+
+
+def _rotl(x, b):
+    return ((x << b) | (x >> (64 - b))) & _MASK
+
+
+def siphash24(key, data):
+    """
+    SipHash-2-4 (pure Python)
+
+    :param key: 16 bytes
+    :param data: bytes
+    :return: 64 bit hash (Int)
+    """
+    (k0, k1) = struct.unpack("<QQ", key)
+    v0 = k0 ^ 0x736f6d6570736575
+    v1 = k1 ^ 0x646f72616e646f6d
+    v2 = k0 ^ 0x6c7967656e657261
+    v3 = k1 ^ 0x7465646279746573
+
+    def rounds(v0, v1, v2, v3, count):
+        for _ in range(count):
+            v0 = (v0 + v1) & _MASK
+            v1 = _rotl(v1, 13) ^ v0
+            v0 = _rotl(v0, 32)
+            v2 = (v2 + v3) & _MASK
+            v3 = _rotl(v3, 16) ^ v2
+            v0 = (v0 + v3) & _MASK
+            v3 = _rotl(v3, 21) ^ v0
+            v2 = (v2 + v1) & _MASK
+            v1 = _rotl(v1, 17) ^ v2
+            v2 = _rotl(v2, 32)
+        return v0, v1, v2, v3
+
+    length = len(data)
+    end = length - (length % 8)
+    for (m,) in struct.iter_unpack("<Q", data[:end]):
+        v3 ^= m
+        (v0, v1, v2, v3) = rounds(v0, v1, v2, v3, 2)
+        v0 ^= m
+    last = ((length & 0xff) << 56) | int.from_bytes(data[end:], "little")
+    v3 ^= last
+    (v0, v1, v2, v3) = rounds(v0, v1, v2, v3, 2)
+    v0 ^= last
+    v2 ^= 0xff
+    (v0, v1, v2, v3) = rounds(v0, v1, v2, v3, 4)
+    return v0 ^ v1 ^ v2 ^ v3
+
+
+class SipHashFunction(EpochPhFunction):
+    """
+        Port Hopping Function based on SipHash-2-4
+
+        hash = lower 16 bit of SipHash-2-4 of T (8 bytes) and the packed client address,
+        the SipHash key is derived from the PSK (blake2b, 16 bytes).
+    """
+    def __init__(self, hopping_period, max_buffer, keymap=None, acceptance_window=0, service_ports=None,
+                 clock=time.time):
+        """
+
+        :param hopping_period: Hopping Period in Seconds
+        :param max_buffer: Maximum Hash Buffer (clients which are not in the keymap)
+        :param keymap: Map of IPs (Strings) to PSKs, hashes of these clients are precomputed
+        :param acceptance_window: 0: only T is accepted, 1: T-1, T and T+1 are accepted for incoming packets
+        :param service_ports: rPorts of the services (known before a leaving packet is seen)
+        :param clock: time function (seconds)
+        """
+        super().__init__(hopping_period, max_buffer, keymap, acceptance_window, service_ports, clock)
+        # PSK: SipHash key
+        self._sip_keys = {}
+        self.start()
+
+    def epoch_hasher(self, t):
+        """
+        :param t: T
+        :return: function (PSK, packed client IP) -> hash (Int, 16 bit) of T
+        """
+        t_bytes = struct.pack("<Q", t)
+
+        def hasher(key, client_ip):
+            sip_key = self._sip_keys.get(key)
+            if sip_key is None:
+                sip_key = self._sip_keys[key] = hashlib.blake2b(key.encode(), digest_size=16).digest()
+            return siphash24(sip_key, t_bytes + client_ip) & 0xffff
+        return hasher
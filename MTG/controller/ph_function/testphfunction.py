@@ -3,10 +3,13 @@ from controller.ph_function.iphfunction import IPhFunction
 
 class TestPhFunction(IPhFunction):
     """
-
+        Port Hopping Function for tests: vPort = rPort + 8000
     """
-    def __init__(self, mapping, io):
-        super().__init__(mapping, io)
+    def __init__(self, *args, **kwargs):
+        """
+        Accepts (and ignores) the parameters of the other PH functions
+        """
+        super().__init__()
 
     def real_port_to_vport(self, r_port, client_ip, client_key):
         """
@@ -27,4 +30,3 @@ class TestPhFunction(IPhFunction):
         :return:
         """
         return v_port - 8000
-
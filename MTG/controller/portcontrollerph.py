@@ -1,8 +1,9 @@
-from netaddr import IPNetwork
 from scapy.layers.inet import TCP, UDP
 
 from InternalLogger.internallogger import InternalLogger
+from controller.helper.address import pack, unpack
 from controller.helper.networkhelper import NetworkHelper
+from controller.helper.prefixindex import WHITELIST, PH_SERVER
 from controller.ilayercontroller import ILayerController
 from controller.itranslator import IO
 
@@ -17,77 +18,79 @@ class PortTranslatorPh(ILayerController):
         """
         return [TCP, UDP]
 
-    def __init__(self, ph_function, io, whitelist, client, keymap, ph_subnet_server):
+    def __init__(self, ph_function, io, prefix_index, client, keymap):
         """
 
         :param ph_function: Port Hopping Function (IPHFunction)
         :param io: Input or Output
-        :param whitelist: Whitelist (Ips)
+        :param prefix_index: Whitelist and PH server subnets (PrefixIndex, shared by all translators)
         :param client: Is this Host part of the client network?
-        :param keymap: Map of IPs to PSKs
+        :param keymap: Map of IPs (Strings) to PSKs
         """
         super().__init__(None, io)
         self._ph_function = ph_function
         self._io = io
-        self._whitelist = whitelist
+        self._prefix_index = prefix_index
         self._client = client
-        self._keymap = keymap
-        self._network_helper = NetworkHelper()
-        self._ph_subnet_server = ph_subnet_server
+        # packed IP: PSK
+        self._keymap = {pack(ip): key for ip, key in keymap.items()}
+        self._network_helper = NetworkHelper.get()
 
     def process_packet(self, packet):
         """
         Forward the packet to the translator if necessary
 
-        :param packet: IPv4/IPv6 Packet with TCP or UDP Payload
+        :param packet: IPv4/IPv6 Packet (PacketView) with TCP or UDP Payload
         :return: forward?
         """
+        (forward, sport, dport) = self.translate(packet, packet.src)
+        if sport is not None:
+            packet.sport = sport
+        if dport is not None:
+            packet.dport = dport
+        return forward
+
+    def translate(self, packet, src, classes=None, local=None):
+        """
+        Calculate the new ports without changing the packet (used by the FusedTranslator as well)
+
+        :param packet: IPv4/IPv6 Packet (PacketView) with TCP or UDP Payload
+        :param src: Source IP-Address (packed), differs from packet.src if the address has already been translated
+        :param classes: classes of the destination and the source (PrefixIndex), looked up if None
+        :param local: destination is a local address, checked if None
+        :return: (forward?, new source port or None, new destination port or None)
+        """
+        if classes is None:
+            classes = self._prefix_index.lookup(packet.dst) | self._prefix_index.lookup(src)
         #check if source or dst ip is in ph_subnet_server list
-        is_not_in_sever_subnet = False
-        for subnet in self._ph_subnet_server:
-            netw = IPNetwork(subnet)
-            if not (packet.dst in netw or packet.src in netw):
-                is_not_in_sever_subnet = True
-        if is_not_in_sever_subnet:
+        if not classes & PH_SERVER:
             InternalLogger.get().debug("PH: Forwarding the incoming packet, not a connection to a MTD Host")
 
         #check if source or dst ip is in whitelist (for incoming and leaving packets)
-        is_whitelist = False
-        for whitelist_address in self._whitelist:
-            netw = IPNetwork(whitelist_address)
-            if packet.dst in netw or packet.src in netw:
-                is_whitelist = True
-                break
-
-        if is_whitelist:
+        if classes & WHITELIST:
             InternalLogger.get().debug("PH: Forwarding the incoming packet, no MTD Host and in whitelist")
         #check if destination is this host (local address)
-        elif packet.dst in self._network_helper.local_addresses():
+        elif local if local is not None else self._network_helper.is_local(packet.dst):
             InternalLogger.get().debug("PH: Accepting the incoming packet, destination = local address")
         else:
             #translate ports
-            return self._translate(packet)
-        return True
+            return self._translate(packet, src)
+        return True, None, None
 
-    def _translate(self, packet):
+    def _translate(self, packet, src):
         """
         Translate ports
 
-        :param packet: IPv4/IPv6 Packet with TCP or UDP Payload
-        :return: forward?
+        :param packet: IPv4/IPv6 Packet (PacketView) with TCP or UDP Payload
+        :param src: Source IP-Address (packed)
+        :return: (forward?, new source port or None, new destination port or None)
         """
         InternalLogger.get().debug("Trying to translate port...")
-        #check if packet has TCP or UDP payload and extract it
-        tcp_or_udp = None
-        if packet.haslayer(TCP):
-            tcp_or_udp = packet[TCP]
-        if packet.haslayer(UDP):
-            tcp_or_udp = packet[UDP]
-        if tcp_or_udp is None:
+        #check if packet has TCP or UDP payload (ports are read from the packet header directly)
+        if not (packet.is_tcp() or packet.is_udp()):
             InternalLogger.get().error("ERROR: No TCP or UDP Layer found")
-            return True     #Internal Error? Forward Anyways
+            return True, None, None     #Internal Error? Forward Anyways
 
-        new_port = None
         #Translate incoming packets
         if self._io == IO.INPUT:
             if self._client:
@@ -96,53 +99,53 @@ class PortTranslatorPh(ILayerController):
                 key = self._keymap.get(ip)
                 if key is None:
                     # No key, drop packet
-                    InternalLogger.get().debug("No key for " + ip)
-                    return False
-                old_port = tcp_or_udp.sport
+                    InternalLogger.get().debug("No key for " + unpack(ip))
+                    return False, None, None
+                old_port = packet.sport
                 new_port = self._ph_function.virtual_port_to_rport(old_port, ip, key)
-                tcp_or_udp.sport = new_port
+                ports = (new_port, None)
             else:
                 # Gateway is part of the host network
-                ip = packet.src
+                ip = src
                 key = self._keymap.get(ip)
                 if key is None:
                     # No key, drop packet
-                    InternalLogger.get().debug("No key for " + ip)
-                    return False
-                old_port = tcp_or_udp.dport
+                    InternalLogger.get().debug("No key for " + unpack(ip))
+                    return False, None, None
+                old_port = packet.dport
                 new_port = self._ph_function.virtual_port_to_rport(old_port, ip, key)
-                tcp_or_udp.dport = new_port
+                ports = (None, new_port)
         else:
         #Translate leaving packets
             if self._client:
                 # Gateway is part of the client network
-                ip = packet.src
+                ip = src
                 key = self._keymap.get(ip)
                 if key is None:
                     # No key, drop packet
-                    InternalLogger.get().debug("No key for " + ip)
-                    return False
-                old_port = tcp_or_udp.dport
+                    InternalLogger.get().debug("No key for " + unpack(ip))
+                    return False, None, None
+                old_port = packet.dport
                 new_port = self._ph_function.real_port_to_vport(old_port, ip, key)
-                tcp_or_udp.dport = new_port
+                ports = (None, new_port)
             else:
                 # Gateway is part of the host network
                 ip = packet.dst
                 key = self._keymap.get(ip)
                 if key is None:
-                    InternalLogger.get().debug("No key for " + ip)
+                    InternalLogger.get().debug("No key for " + unpack(ip))
                     #No key, drop packet
-                    return False
-                old_port = tcp_or_udp.sport
+                    return False, None, None
+                old_port = packet.sport
                 new_port = self._ph_function.real_port_to_vport(old_port, ip, key)
-                tcp_or_udp.sport = new_port
+                ports = (new_port, None)
 
         if new_port is None:
             InternalLogger.get().error("Error no rPort found")
-            return
+            return None, None, None
         InternalLogger.get().debug("Old Port = " + str(old_port))
         InternalLogger.get().debug("New Port = " + str(new_port))
-        return True
+        return (True,) + ports
 
     def mapping_changed(self):
         """
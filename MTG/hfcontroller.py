@@ -1,20 +1,29 @@
-import json
 import secrets
 import time
-from concurrent.futures.thread import ThreadPoolExecutor
-from threading import Thread
-import requests
+from threading import Thread, Lock, Timer
 from netaddr import IPNetwork
 
+import hfsync
 from InternalLogger.internallogger import InternalLogger
+from controller.helper.address import pack_mapping
+from controller.helper.mappingsnapshot import MappingSnapshot
 
 
 class HfController(Thread):
     """
     High Frequency Controller
     Calculates new rIP based on the Subnets received by the LFMappingAPI
+
+    Every change of the total mapping is published as an immutable MappingSnapshot (forward and reverse index, epoch),
+    the translators swap their reference to it. Changes (hopping thread, REST threads) are serialized by a lock.
+    Changes are collected as deltas (vIP: rIP or None), only changed entries are applied to the published snapshot.
+    Mappings of other gateways are published after coalesce_window, so rapid updates of several gateways
+    result in one publication.
+
+    :param receiver: HfMappingSender (receivers of the own mapping)
+    :param coalesce_window: time to collect updates of other gateways in seconds (0: publish every update)
     """
-    def __init__(self, translators, receiver, hopping_period, dynamic_port_priority):
+    def __init__(self, translators, receiver, hopping_period, dynamic_port_priority, coalesce_window=0):
         Thread.__init__(self)
         self._translators = translators
         self._lf_mapping = None
@@ -23,8 +32,16 @@ class HfController(Thread):
         self._hopping_period = hopping_period
         self._hf_mapping_other = {}
         self._receiver = receiver
-        self._executor = ThreadPoolExecutor(max_workers=10)
         self._dynamic_port_priority = dynamic_port_priority
+        self._lock = Lock()
+        self._epoch = 0
+        self._snapshot = MappingSnapshot.build({}, 0)
+        self._coalesce_window = coalesce_window
+        # vIP: rIP or None (revoked), changes of the total mapping not published yet
+        self._pending = {}
+        self._publish_timer = None
+        # gateway ID: {"instance", "version", "mapping"} of other gateways (versioned sync, see hfsync)
+        self._peers = {}
 
     def run(self):
         """
@@ -73,33 +90,72 @@ class HfController(Thread):
             InternalLogger.get().debug("Error: No LF Mapping")
         InternalLogger.get().debug("--HF Controller finished")
         InternalLogger.get().debug(new_mapping)
-        #save old mapping and set new mapping
-        self._hf_mapping_old = self._hf_mapping
-        self._hf_mapping = new_mapping
+        with self._lock:
+            #save old mapping and set new mapping
+            self._hf_mapping_old = self._hf_mapping
+            self._hf_mapping = new_mapping
+            #mappings of other gateways take precedence
+            for v_ip in (self._hf_mapping_old or {}):
+                if v_ip not in new_mapping and v_ip not in self._hf_mapping_other:
+                    self._pending[v_ip] = None
+            for v_ip, r_ip in new_mapping.items():
+                if v_ip not in self._hf_mapping_other:
+                    self._pending[v_ip] = r_ip
+            self.send_new_mapping()
+            epoch = self._epoch
+            hf_mapping_old = self._hf_mapping_old
         #send new mapping to other gatways (defined in nas/receiver) if necessary
-        self.send_new_mapping()
+        self.send_all_rest(epoch, new_mapping, hf_mapping_old)
 
     def send_new_mapping(self):
         """
-        Merge external (other gateways) and internal mappings
+        Apply the collected changes (internal and external mappings) to the total mapping
         send new mapping to the receivers = translators (trackers/controllers) internally
-        send new mapping to other gatways (defined in nas/receiver) if necessary
-        """
-        total_mapping = {}
-        #Internal mapping
-        if self._hf_mapping is not None:
-            total_mapping.update(self._hf_mapping)
-        #external mapping
-        if self._hf_mapping_other is not None:
-            total_mapping.update(self._hf_mapping_other)
+
+        Called with self._lock held
+        """
+        if self._publish_timer is not None:
+            self._publish_timer.cancel()
+            self._publish_timer = None
+        if not self._pending and self._epoch > 0:
+            return
+        self._epoch += 1
+        self._snapshot = self._snapshot.apply(self._pending, self._epoch)
+        InternalLogger.get().debug("Total Mapping, epoch " + str(self._epoch) + ", "
+                                   + str(len(self._pending)) + " changes")
+        InternalLogger.get().debug(self._pending)
+        self._pending = {}
         #send new mapping to translators
         for translator in self._translators:
             #POSSIBLE: total_mapping just for DNS
-            translator.set_mapping(total_mapping)
-        InternalLogger.get().debug("Total Mapping")
-        InternalLogger.get().debug(total_mapping)
-        #send new mapping to other gateways
-        self._executor.submit(self.send_all_rest)
+            translator.set_mapping(self._snapshot)
+
+    def _schedule_mapping(self):
+        """
+        Publish the collected changes after the coalesce window
+
+        Called with self._lock held
+        """
+        if self._coalesce_window <= 0:
+            self.send_new_mapping()
+        elif self._publish_timer is None:
+            self._publish_timer = Timer(self._coalesce_window, self._publish_pending)
+            self._publish_timer.daemon = True
+            self._publish_timer.start()
+
+    def _publish_pending(self):
+        try:
+            with self._lock:
+                self._publish_timer = None
+                self.send_new_mapping()
+        except Exception as e:
+            InternalLogger.get().error("Error: " + str(e), exc_info=True)
+
+    def get_snapshot(self):
+        """
+        :return: current total mapping (MappingSnapshot) or None
+        """
+        return self._snapshot
 
     def set_lf_mapping(self, mapping):
         """
@@ -108,7 +164,8 @@ class HfController(Thread):
         Set LF (Low Frequency) Mapping for this gateway (possible interfaces for every MT host)
         :param mapping: Mapping
         """
-        self._lf_mapping = mapping
+        with self._lock:
+            self._lf_mapping = mapping
         #Recalculate total mapping (merge) and send
         self.recalculate_mapping()
 
@@ -122,9 +179,12 @@ class HfController(Thread):
         """
         InternalLogger.get().debug("Adding addresses")
         InternalLogger.get().debug(hf_mapping)
-        self._hf_mapping_other.update(hf_mapping)
-        # Recalculate total mapping (merge) and send
-        self.send_new_mapping()
+        #invalid addresses are rejected before the mapping is changed
+        pack_mapping(hf_mapping)
+        with self._lock:
+            self._hf_mapping_other.update(hf_mapping)
+            self._pending.update(hf_mapping)
+            self._schedule_mapping()
 
     def revoke_hf_mapping(self, hf_mapping):
         """
@@ -134,39 +194,105 @@ class HfController(Thread):
 
         :param hf_mapping: revoked high frequency mapping
         """
+        InternalLogger.get().debug("Revoking addresses")
+        InternalLogger.get().debug(hf_mapping)
+        with self._lock:
+            #delete revoked mappings
+            for v_ip, r_ip in hf_mapping.items():
+                if self._hf_mapping_other.get(v_ip) is not None:
+                    del self._hf_mapping_other[v_ip]
+                    #the internal mapping is used again if it contains the vIP
+                    self._pending[v_ip] = (self._hf_mapping or {}).get(v_ip)
+            self._schedule_mapping()
 
+    def sync_hf_mapping(self, message):
+        """
+        called by REST endpoint
 
+        versioned high frequency mapping (changes, digest or buckets) of another gateway, see hfsync
 
-        InternalLogger.get().debug("Revoking addresses")
-        InternalLogger.get().debug(hf_mapping)
-        #delete revoked mappings
-        for v_ip, r_ip in hf_mapping.items():
-            if self._hf_mapping_other.get(v_ip) is not None:
+        :param message: Dictionary
+        :return: (response, HTTP status)
+        """
+        gateway = message["gateway"]
+        version = message["version"]
+        #invalid addresses are rejected before the mapping is changed
+        pack_mapping(message.get("hf_added"))
+        pack_mapping(message.get("hf_buckets"))
+        with self._lock:
+            peer = self._peers.get(gateway)
+            if peer is not None and peer["instance"] == message["instance"]:
+                known_version = peer["version"]
+            else:
+                known_version = 0
+            if "digest" in message:
+                if known_version != version:
+                    return {"version": known_version}, 200
+                digest = hfsync.digest(peer["mapping"])
+                buckets = [i for i, bucket_hash in message["digest"].items() if digest.get(i) != bucket_hash]
+                return {"version": known_version, "buckets": buckets}, 200
+            if "buckets" in message:
+                if known_version != version:
+                    return {"version": known_version}, 409
+                InternalLogger.get().info("Resync of " + str(gateway) + ", buckets " + str(message["buckets"]))
+                (added, revoked) = hfsync.delta(hfsync.select_buckets(peer["mapping"], message["buckets"]),
+                                                message["hf_buckets"])
+                self._apply_peer_changes(peer, added, revoked)
+                return {"version": known_version}, 200
+            base = message.get("base", 0)
+            if known_version != 0 and version <= known_version:
+                #duplicate or reordered message
+                return {"version": known_version}, 200
+            if base != 0 and base != known_version:
+                return {"version": known_version}, 409
+            added = message.get("hf_added") or {}
+            if peer is None:
+                peer = self._peers[gateway] = {"instance": None, "version": 0, "mapping": {}}
+            if base == 0:
+                #complete mapping, everything else of this gateway is revoked
+                revoked = {v_ip: r_ip for v_ip, r_ip in peer["mapping"].items() if v_ip not in added}
+            else:
+                revoked = message.get("hf_revoked") or {}
+            InternalLogger.get().debug("Sync of " + str(gateway) + ": version " + str(version) + ", base " + str(base)
+                                       + ", " + str(len(added)) + " added, " + str(len(revoked)) + " revoked")
+            peer["instance"] = message["instance"]
+            peer["version"] = version
+            self._apply_peer_changes(peer, added, revoked)
+            return {"version": version}, 200
+
+    def _apply_peer_changes(self, peer, added, revoked):
+        """
+        Apply changes of the mapping of another gateway
+
+        Called with self._lock held
+        """
+        for v_ip in revoked:
+            r_ip = peer["mapping"].pop(v_ip, None)
+            if r_ip is not None and self._hf_mapping_other.get(v_ip) == r_ip:
                 del self._hf_mapping_other[v_ip]
-        # Recalculate total mapping (merge) and send
-        self.send_new_mapping()
+                #the internal mapping is used again if it contains the vIP
+                self._pending[v_ip] = (self._hf_mapping or {}).get(v_ip)
+        for v_ip, r_ip in added.items():
+            peer["mapping"][v_ip] = r_ip
+            self._hf_mapping_other[v_ip] = r_ip
+            self._pending[v_ip] = r_ip
+        self._schedule_mapping()
 
-    def send_all_rest(self):
+    def send_all_rest(self, epoch, hf_mapping, hf_mapping_old):
         """
-        Send the High Frequency mapping (total) to Receivers (REST endpoint of other gateways) if necessary
+        Send the High Frequency mapping (own) to Receivers (REST endpoint of other gateways) if necessary
+
+        :param epoch: epoch of the total mapping
+        :param hf_mapping: added (own) mapping of this change
+        :param hf_mapping_old: revoked (own) mapping of this change
         """
-        try:
-            for url in self._receiver:
-                #Send mapping to url of receiver
-                InternalLogger.get().debug("Sending Mapping to: " + url)
-                #Create structure
-                json_structure = {}
-                #add new mapping
-                json_structure["hf_added"] = self._hf_mapping
-                #revoke old mapping
-                json_structure["hf_revoked"] = self._hf_mapping_old
-                json_mapping = json.dumps(json_structure)
-                headers = {"Content-Type": "application/json"}
-                #Send via HTTP
-                r = requests.put(url, data=json_mapping, headers=headers)
-                InternalLogger.get().debug("Status: " + str(r.status_code))
-        except Exception as e:
-            InternalLogger.get().error("Error: " + str(e), exc_info=True)
+        self._receiver.send(epoch, hf_mapping, hf_mapping_old)
+
+    def get_push_stats(self):
+        """
+        :return: push statistics of every receiver (url: Dictionary)
+        """
+        return self._receiver.stats()
 
     def set_hf_subnet(self, subnets):
         for translator in self._translators:
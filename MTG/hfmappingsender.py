@@ -0,0 +1,313 @@
+import json
+import secrets
+import time
+from collections import OrderedDict
+from threading import Thread, Condition, Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import hfsync
+from InternalLogger.internallogger import InternalLogger
+from controller.helper.address import pack, unpack
+from rest import mappingcodec
+
+
+class HfMappingSender:
+    """
+    Sends the own HF mapping to the receivers (REST endpoint of other gateways), see hfsync for the protocol
+
+    Every receiver has its own thread and session (persistent connection), so a slow receiver does not delay
+    the others. Failed requests are retried with exponential backoff. A receiver gets the changes between
+    the version it acknowledged and the newest version, versions in between are skipped.
+    Every sync_interval the digest of the mapping is compared and differing buckets are sent again.
+
+    :param receiver: List of URLs
+    :param gateway_id: ID of this gateway (unique among the gateways)
+    :param timeout: timeout of a request (connect and read) in seconds
+    :param retries: number of retries of a failed request
+    :param backoff: delay before the first retry in seconds (doubled for every retry)
+    :param sync_interval: interval of the digest comparison in seconds
+    :param history: number of versions kept to send changes (older versions: complete mapping)
+    :param binary: send the binary format (rest.mappingcodec), JSON is used for receivers which do not support it
+    """
+    def __init__(self, receiver, gateway_id, timeout=2.0, retries=3, backoff=0.5, sync_interval=10.0, history=32,
+                 binary=False):
+        self.gateway_id = gateway_id
+        # changes with every start, receivers drop the mapping of the old instance
+        self.instance = secrets.token_hex(8)
+        self._history = history
+        self._lock = Lock()
+        # version: mapping
+        self._versions = OrderedDict()
+        self._version = 0
+        self._peers = [_Peer(self, url, timeout, retries, backoff, sync_interval, binary) for url in receiver]
+
+    def send(self, epoch, hf_mapping, hf_mapping_old):
+        """
+        Send a new mapping to all receivers (non blocking)
+
+        :param epoch: epoch of the mapping (version)
+        :param hf_mapping: (own) mapping
+        :param hf_mapping_old: previous (own) mapping (the changes are calculated from the versions)
+        """
+        #canonical addresses, the receivers compare the textual addresses (delta, digest)
+        mapping = {unpack(pack(v_ip)): unpack(pack(r_ip)) for v_ip, r_ip in (hf_mapping or {}).items()}
+        with self._lock:
+            self._versions[epoch] = mapping
+            self._version = epoch
+            while len(self._versions) > self._history:
+                self._versions.popitem(last=False)
+        for peer in self._peers:
+            peer.new_version()
+
+    def current(self):
+        """
+        :return: (version, mapping) newest version (0 if there is none)
+        """
+        with self._lock:
+            return self._version, self._versions.get(self._version)
+
+    def mapping(self, version):
+        """
+        :param version: version
+        :return: mapping of the version or None if it is not kept
+        """
+        with self._lock:
+            return self._versions.get(version)
+
+    def stats(self):
+        """
+        :return: push statistics of every receiver (url: Dictionary)
+        """
+        return {peer.url: peer.stats() for peer in self._peers}
+
+
+class _Peer(Thread):
+    """
+    Sender thread of a receiver
+    """
+    def __init__(self, sender, url, timeout, retries, backoff, sync_interval, binary):
+        Thread.__init__(self, daemon=True, name="HfMappingSender " + url)
+        self.url = url
+        self._sender = sender
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._sync_interval = sync_interval
+        self._binary = binary
+        self._session = requests.Session()
+        self._session.mount(url, HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self._session.headers["Content-Type"] = "application/json"
+        self._condition = Condition()
+        self._notified = False
+        # new versions since the last sync (versions replaced by a newer one before they are sent are skipped)
+        self._new_versions = 0
+        # version the receiver holds (None: unknown)
+        self._acked = None
+        self._stats_lock = Lock()
+        self._sent = 0
+        self._failed = 0
+        self._skipped = 0
+        self._conflicts = 0
+        self._resyncs = 0
+        self._latency_last = None
+        self._latency_avg = None
+        self._latency_max = None
+        self.start()
+
+    def notify(self):
+        with self._condition:
+            self._notified = True
+            self._condition.notify()
+
+    def new_version(self):
+        """
+        A new version of the mapping has to be sent
+        """
+        with self._condition:
+            self._new_versions += 1
+            self._notified = True
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                if not self._notified:
+                    self._condition.wait(self._sync_interval)
+                notified = self._notified
+                self._notified = False
+                new_versions = self._new_versions
+                self._new_versions = 0
+            try:
+                (version, mapping) = self._sender.current()
+                if version == 0:
+                    continue
+                if new_versions > 1:
+                    # only the newest version is sent
+                    with self._stats_lock:
+                        self._skipped += new_versions - 1
+                if self._acked != version:
+                    self._sync(version, mapping)
+                elif not notified:
+                    self._compare_digest(version, mapping)
+            except Exception as e:
+                InternalLogger.get().error("Error: " + str(e), exc_info=True)
+
+    def _message(self, version):
+        return {"gateway": self._sender.gateway_id, "instance": self._sender.instance, "version": version}
+
+    def _sync(self, version, mapping):
+        """
+        Send the changes since the acknowledged version (retried with backoff)
+        """
+        delay = self._backoff
+        attempt = 0
+        while attempt <= self._retries:
+            if self._sender.current()[0] != version:
+                # superseded, the next loop sends the newest version
+                with self._stats_lock:
+                    self._skipped += 1
+                return
+            message = self._message(version)
+            acked_mapping = None if self._acked is None else self._sender.mapping(self._acked)
+            if acked_mapping is None:
+                message["base"] = 0
+                (message["hf_added"], message["hf_revoked"]) = (mapping, {})
+            else:
+                message["base"] = self._acked
+                (message["hf_added"], message["hf_revoked"]) = hfsync.delta(acked_mapping, mapping)
+            InternalLogger.get().debug("Sending Mapping to: " + self.url + ", version " + str(version)
+                                       + ", base " + str(message["base"]))
+            response = self._put(message)
+            if self._binary and response is not None and not isinstance(_json(response), dict):
+                self._fallback_to_json()
+                continue
+            if response is not None and response.status_code == 409:
+                # the receiver holds another version, send the changes since this one
+                self._acked = _response_version(response, 0)
+                with self._stats_lock:
+                    self._conflicts += 1
+            elif response is not None and response.status_code < 300:
+                result = _json(response)
+                if not isinstance(result, dict):
+                    # receiver without versions, it answers without content
+                    self._acked = version
+                    return
+                if isinstance(result.get("version"), int):
+                    self._acked = result["version"]
+                    return
+                # not acknowledged, sent again after the sync interval
+                InternalLogger.get().error("Error: invalid response of " + self.url + " to version " + str(version)
+                                           + ": " + str(result))
+                return
+            elif response is not None and response.status_code < 500:
+                # rejected, not retried before the sync interval
+                InternalLogger.get().error("Error: mapping (version " + str(version) + ") rejected by " + self.url
+                                           + ", status " + str(response.status_code) + ": " + str(_json(response)))
+                return
+            else:
+                time.sleep(delay)
+                delay *= 2
+            attempt += 1
+        InternalLogger.get().error("Error: mapping (version " + str(version) + ") not sent to " + self.url)
+
+    def _compare_digest(self, version, mapping):
+        """
+        Compare the digests, send differing buckets again
+        """
+        message = self._message(version)
+        message["digest"] = hfsync.digest(mapping)
+        response = self._put(message)
+        if response is None:
+            return
+        result = _json(response)
+        if self._binary and not isinstance(result, dict):
+            self._fallback_to_json()
+            return
+        if response.status_code >= 300:
+            InternalLogger.get().warning("Digest of version " + str(version) + " not compared by " + self.url
+                                         + ", status " + str(response.status_code) + ": " + str(result))
+            return
+        if not isinstance(result, dict):
+            # receiver without versions
+            return
+        if result.get("version") != version:
+            InternalLogger.get().info("Receiver " + self.url + " holds version " + str(result.get("version"))
+                                      + " instead of " + str(version))
+            self._acked = result.get("version")
+            self.notify()
+            return
+        buckets = result.get("buckets")
+        if buckets:
+            InternalLogger.get().info("Mapping of " + self.url + " differs, sending buckets " + str(buckets))
+            message = self._message(version)
+            message["buckets"] = buckets
+            message["hf_buckets"] = hfsync.select_buckets(mapping, buckets)
+            self._put(message)
+            with self._stats_lock:
+                self._resyncs += 1
+
+    def _fallback_to_json(self):
+        InternalLogger.get().info("Receiver " + self.url + " does not support the binary format, using JSON")
+        self._binary = False
+
+    def _put(self, message):
+        """
+        :return: response or None (error)
+        """
+        if self._binary:
+            data = mappingcodec.encode(message)
+            headers = {"Content-Type": mappingcodec.CONTENT_TYPE}
+        else:
+            data = json.dumps(message)
+            headers = None
+        start = time.monotonic()
+        try:
+            response = self._session.put(self.url, data=data, headers=headers, timeout=self._timeout)
+        except requests.RequestException as e:
+            InternalLogger.get().debug("Error sending mapping to " + self.url + ": " + str(e))
+            with self._stats_lock:
+                self._failed += 1
+            return None
+        latency = time.monotonic() - start
+        InternalLogger.get().debug("Status: " + str(response.status_code))
+        with self._stats_lock:
+            if response.status_code >= 500:
+                self._failed += 1
+            else:
+                self._sent += 1
+                self._latency_last = latency
+                self._latency_avg = latency if self._latency_avg is None else 0.8 * self._latency_avg + 0.2 * latency
+                self._latency_max = latency if self._latency_max is None else max(self._latency_max, latency)
+        return response
+
+    def stats(self):
+        """
+        :return: Dictionary (sent, failed, skipped, conflicts, resyncs, version, latency_last, latency_avg,
+         latency_max in seconds)
+        """
+        with self._stats_lock:
+            return {"sent": self._sent, "failed": self._failed, "skipped": self._skipped, "conflicts": self._conflicts,
+                    "resyncs": self._resyncs, "version": self._acked, "latency_last": self._latency_last,
+                    "latency_avg": self._latency_avg, "latency_max": self._latency_max}
+
+
+def _json(response):
+    """
+    :return: content of a JSON response or None
+    """
+    try:
+        return response.json()
+    except ValueError:
+        return None
+
+
+def _response_version(response, default):
+    """
+    :return: version the receiver holds (default if the response does not contain one)
+    """
+    result = _json(response)
+    if isinstance(result, dict) and isinstance(result.get("version"), int):
+        return result["version"]
+    return default
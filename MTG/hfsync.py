@@ -0,0 +1,62 @@
+"""
+Versioned HF mapping synchronisation between gateways
+
+Every gateway sends its own HF mapping with a version (epoch of the mapping) and the version the receiver
+acknowledged last (base), so only the changes since the acknowledged version are sent:
+    {"gateway": id, "instance": token, "version": v, "base": acknowledged version (0: complete mapping),
+     "hf_added": {vIP: rIP}, "hf_revoked": {vIP: rIP}}
+The receiver answers with the version it holds ({"version": v}), status 409 if the base does not match.
+Invalid messages are answered with status 400, errors while applying them with 500, the sender only acknowledges
+a version the receiver answered with (a receiver without versions answers with status 200 and no content).
+The instance token changes with every start of a gateway, a receiver only accepts a complete mapping of a new instance.
+
+Periodically a digest (hash of the entries per bucket of vIPs) is sent instead:
+    {"gateway": id, "instance": token, "version": v, "digest": {bucket: hash}}
+The receiver answers with the buckets which differ ({"version": v, "buckets": [bucket]}), those buckets are sent again:
+    {"gateway": id, "instance": token, "version": v, "buckets": [bucket], "hf_buckets": {vIP: rIP}}
+"""
+import zlib
+from hashlib import blake2b
+
+BUCKETS = 16
+
+
+def bucket(v_ip):
+    """
+    :param v_ip: vIP (String)
+    :return: bucket of the vIP
+    """
+    return zlib.crc32(v_ip.encode()) % BUCKETS
+
+
+def digest(mapping):
+    """
+    :param mapping: vIP: rIP (Strings)
+    :return: bucket (String): hash of the entries of the bucket (hex String)
+    """
+    entries = [[] for _ in range(BUCKETS)]
+    for v_ip, r_ip in mapping.items():
+        entries[bucket(v_ip)].append(v_ip + "=" + r_ip)
+    return {str(i): blake2b(";".join(sorted(bucket_entries)).encode(), digest_size=8).hexdigest()
+            for i, bucket_entries in enumerate(entries)}
+
+
+def delta(old, new):
+    """
+    :param old: vIP: rIP (Strings)
+    :param new: vIP: rIP (Strings)
+    :return: (added, revoked) changes from old to new
+    """
+    added = {v_ip: r_ip for v_ip, r_ip in new.items() if old.get(v_ip) != r_ip}
+    revoked = {v_ip: r_ip for v_ip, r_ip in old.items() if v_ip not in new}
+    return added, revoked
+
+
+def select_buckets(mapping, buckets):
+    """
+    :param mapping: vIP: rIP (Strings)
+    :param buckets: List of buckets
+    :return: entries of the mapping in the buckets
+    """
+    buckets = set(int(i) for i in buckets)
+    return {v_ip: r_ip for v_ip, r_ip in mapping.items() if bucket(v_ip) in buckets}
@@ -1,17 +1,21 @@
-from concurrent.futures import ThreadPoolExecutor
+import sys
 from threading import Thread
 import fnfqueue
 
-
-from scapy.all import *
-from scapy.layers.inet import TCP, UDP, IP
-from scapy.layers.inet6 import _ICMPv6, IPv6
-from scapy.layers.l2 import Ether
-
 from InternalLogger.internallogger import InternalLogger
+from connection_tracker.flowevent import FlowEvent
 from connection_tracker.iconnectiontracker import IConnectionTracker
+from controller.helper.address import unpack
+from controller.helper.packetview import PacketView, DISPATCH_PROTOCOLS, PROTO_TCP, TCP_SYN, TCP_FIN, TCP_RST, \
+    layer_filter
 from controller.ilayercontroller import ILayerController
 from controller.itranslator import IO
+from packetpipeline import PacketPipeline
+
+# tracking events with these flags wait for the tracker workers instead of being dropped (overload).
+# Only these are guaranteed: a dropped ACK which completes a handshake (SYN state) is recovered by the next ACK
+# of the connection, a dropped last ACK after FIN by the FIN timeout (the connection is removed when it expires)
+_STATE_FLAGS = TCP_SYN | TCP_FIN | TCP_RST
 
 
 class IpController(Thread):
@@ -21,25 +25,52 @@ class IpController(Thread):
     :param: controller: List of controllers or trackers (Hast to implement IConnectionTracker or ILayerController)
     :param: debug_forward: Forward all packets directly, dont use controllers or trackers
     :param: io: Input or Output (Output = Client Net or Host Net to Public Net)
+    :param: incremental_checksum: Patch checksums in place (RFC 1624) instead of recalculating them over the whole packet
+    :param: pipeline_conf: Settings of the worker pipelines (workers, ring_size, batch_size, backpressure_timeout, tracker_workers)
     """
-    def __init__(self, queue_num, controller, debug_forward, io):
+    def __init__(self, queue_num, controller, debug_forward, io, incremental_checksum=True, pipeline_conf=None):
         Thread.__init__(self)
         self._queue_num = queue_num
         self._debug_direct_forward = debug_forward
-        self._executor = ThreadPoolExecutor(max_workers=1000)
-        self._controller = controller
+        self.set_controller(controller)
         self._io = io
+        self._incremental_checksum = incremental_checksum
+        if pipeline_conf is None:
+            pipeline_conf = {}
+        ring_size = pipeline_conf.get("ring_size", 4096)
+        batch_size = pipeline_conf.get("batch_size", 32)
+        backpressure_timeout = pipeline_conf.get("backpressure_timeout", 0.001)
+        # Packets of a flow are always handled by the same worker (order is preserved)
+        self._pipeline = PacketPipeline(self.handle_packets, pipeline_conf.get("workers", 8), ring_size, batch_size,
+                                        backpressure_timeout, "queue" + str(queue_num))
+        # Tracking in separate threads (no realtime changes required)
+        self._tracker_pipeline = PacketPipeline(self.forward_to_trackers, pipeline_conf.get("tracker_workers", 1),
+                                                ring_size, batch_size, backpressure_timeout, "tracker" + str(queue_num))
 
         #test
         self.conn = fnfqueue.Connection()
 
     def receive(self, pkt):
         """
-        Start thread for every new packet
+        Hand over the packet to the worker of its flow, drop it if the worker is overloaded
 
         :param pkt: raw packet from nfQueue
         """
-        self._executor.submit(self.handle_packet, pkt)
+        try:
+            # Parse the IP header (v4/v6) directly from the raw payload, scapy is only used on demand
+            packet = PacketView(pkt.payload, self._incremental_checksum)
+        except ValueError as e:
+            InternalLogger.get().error("Invalid packet: " + str(e))
+            pkt.drop()
+            return
+        if not self._pipeline.submit(packet.flow_key(), (pkt, packet)):
+            pkt.drop()
+
+    def overload_drops(self):
+        """
+        :return: (dropped packets, dropped tracking events) because of overloaded workers
+        """
+        return self._pipeline.overload_drops, self._tracker_pipeline.overload_drops
 
     def run(self):
         """
@@ -69,27 +100,27 @@ class IpController(Thread):
             except Exception as e:
                 InternalLogger.get().critical("Error: " + str(e), exc_info=True)
 
-    def handle_packet(self, pkt):
+    def handle_packets(self, batch):
+        """
+        Handle a batch of packets (called by the pipeline workers)
+
+        :param batch: List of (raw packet, PacketView)
+        """
+        for (pkt, packet) in batch:
+            self.handle_packet(pkt, packet)
+
+    def handle_packet(self, pkt, packet):
         """
         Forward packets to layer controllers and trackers
 
         :param pkt: Raw Packet
+        :param packet: Parsed packet (PacketView)
         """
         try:
             InternalLogger.get().debug("---Detected packet (" + str(pkt) + "),\t queue_num=" + str(self._queue_num))
-            data = pkt.payload
-            # Detect v4/v6 and load as IP object
-            ip_packet = None
-            try:
-                ip_packet = IPv6(data)
-                ip_version = 6
-            except Exception as e:
-                InternalLogger.get().debug("Exception in IPv6 Packet, trying IPv4")
-            if ip_packet is None or ip_packet.version == 4:
-                ip_packet = IP(data)
-                ip_version = 4
             # Output data
-            InternalLogger.get().debug("--Source: " + ip_packet.src + "\tDest: " + ip_packet.dst + "\tIPv" + str(ip_version))
+            InternalLogger.get().debug("--Source: " + unpack(packet.src) + "\tDest: " + unpack(packet.dst) + "\tIPv"
+                                       + str(packet.version))
 
             if self._debug_direct_forward:
                 #Directly forward
@@ -97,14 +128,14 @@ class IpController(Thread):
                 pkt.mangle()
             else:
                 InternalLogger.get().debug("Checking layers")
-                forward = self.check_layers(ip_packet)
+                forward = self.check_layers(packet)
                 #check if the packet should be forwarded to the network stack (Attention: internal ip routes are responsible to forward it)
                 if forward:
-                    InternalLogger.get().debug("Recalculating checksums and length")
-                    self.recalculate_checksums(ip_packet, ip_version)
+                    InternalLogger.get().debug("Recalculating checksums")
+                    self.recalculate_checksums(packet)
                     InternalLogger.get().debug("Sending packet")
                     #Redirect packet to network stack
-                    pkt.payload = raw(ip_packet)
+                    pkt.payload = packet.payload()
                     pkt.mangle()
                 else:
                     InternalLogger.get().debug("Dropped")
@@ -115,77 +146,122 @@ class IpController(Thread):
             InternalLogger.get().critical("Error: " + str(e), exc_info=True)
 
 
+    def set_controller(self, controller):
+        """
+        Set the layer controllers and trackers (e.g. after reconfiguration) and compile the dispatch plan
+
+        :param controller: Map of priority to controller or tracker (IConnectionTracker or ILayerController)
+        """
+        self._controller = controller
+        # replaced as a whole, packet threads always use a complete plan
+        self._dispatch_plan = self.compile_dispatch_plan(controller)
+
+    @staticmethod
+    def compile_dispatch_plan(controller):
+        """
+        Compile the ordered stages for every IP version and upper layer protocol once,
+        so no sorting and type checks are required per packet
+
+        :param controller: Map of priority to controller or tracker
+        :return: Map (ip version, protocol or None) to tuple of stages (controller, is tracker, predicate or None)
+        """
+        plan = {}
+        for version in (4, 6):
+            for proto in DISPATCH_PROTOCOLS:
+                stages = []
+                for (id, stage_controller) in sorted(controller.items()):
+                    if isinstance(stage_controller, ILayerController):
+                        predicates = []
+                        for layer in stage_controller.layers():
+                            (versions, protos, predicate) = layer_filter(layer)
+                            if version in versions and proto in protos:
+                                predicates.append(predicate)
+                        if not predicates:
+                            continue
+                        if None in predicates:
+                            # unconditional
+                            stages.append((stage_controller, False, None))
+                        elif len(predicates) == 1:
+                            stages.append((stage_controller, False, predicates[0]))
+                        else:
+                            stages.append((stage_controller, False,
+                                           lambda packet, predicates=tuple(predicates): any(p(packet) for p in predicates)))
+                    elif isinstance(stage_controller, IConnectionTracker) and proto == PROTO_TCP:
+                        # trackers receive flow events of TCP packets
+                        stages.append((stage_controller, True, None))
+                plan[(version, proto)] = tuple(stages)
+        return plan
+
     def check_layers(self, packet):
         """
         Hand over packets to the layer controller or trackers
 
-        :param packet: ipv4 / ipv6 packet (scapy), packet can be modified in this method
+        :param packet: ipv4 / ipv6 packet (PacketView), packet can be modified in this method
         :return: forward (should it be forwarded to the network stack)
         """
         forward = True
-        #check every controller or translator
-        for (id, controller) in sorted(self._controller.items()):
-            if isinstance(controller, ILayerController):
-                # check if layer for controller exists
-                layer_types = controller.layers()
-                for layer in layer_types:
-                    if packet.haslayer(layer):
-                        InternalLogger.get().debug("Forwarding to controller" + str(type(controller)))
-                        #original packet, translators can modify
-                        forward_controller = controller.process_packet(packet)
-                        forward = forward and forward_controller
-                        break # Dont send to controller twice
-            elif isinstance(controller, IConnectionTracker):
-                #Copy Packet, dont allow to change it
-                #Track in new thead (no realtime changes required)
-                packet_copy = copy.deepcopy(packet)
+        #run the stages of the dispatch plan for this kind of packet
+        for (controller, tracker, predicate) in self._dispatch_plan.get(packet.dispatch_key(), ()):
+            if predicate is not None and not predicate(packet):
+                continue
+            if not tracker:
+                InternalLogger.get().debug("Forwarding to controller" + str(type(controller)))
+                #original packet, translators can modify
+                forward_controller = controller.process_packet(packet)
+                forward = forward and forward_controller
+            else:
+                #Immutable flow event instead of the packet, dont allow to change it
+                event = FlowEvent.from_packet(packet, self._io)
                 InternalLogger.get().debug("Forwarding to tracker" + str(type(controller)))
-                self._executor.submit(self.forward_to_tracker, controller, packet_copy, self._io)
+                if controller.is_inline():
+                    #Track before the packet is forwarded (state is known when the reply arrives)
+                    self.forward_to_tracker(controller, event, self._io)
+                else:
+                    #Track in new thead (no realtime changes required), SYN/FIN/RST wait for the tracker workers
+                    if not self._tracker_pipeline.submit(packet.flow_key(), (controller, event, self._io),
+                                                         block=bool(event.flags & _STATE_FLAGS)):
+                        self._tracker_event_dropped(event)
         return forward
 
-    def forward_to_tracker(self, tracker, packet, io):
+    def _tracker_event_dropped(self, event):
+        """
+        Log a dropped tracking event (recovered by the next packet of the connection or its idle timeout),
+        the first one and then every 1000th drop
+
+        :param event: FlowEvent
+        """
+        drops = self._tracker_pipeline.overload_drops
+        if drops == 1 or drops % 1000 == 0:
+            InternalLogger.get().warning("Tracker workers overloaded (queue " + str(self._queue_num) + "), "
+                                         + str(drops) + " tracking events dropped, last: " + str(event))
+
+    def forward_to_trackers(self, batch):
+        """
+        Execute tracker methods of a batch (called by the tracker pipeline workers)
+
+        :param batch: List of (Tracker, FlowEvent, Input or Output)
+        """
+        for (tracker, event, io) in batch:
+            self.forward_to_tracker(tracker, event, io)
+
+    def forward_to_tracker(self, tracker, event, io):
         """
         Execute tracker method
 
         :param tracker: Tracker (IConnectionTracker)
-        :param packet: IPv4/IPv6 Packet
+        :param event: FlowEvent
         :param io: Input or Output
         """
-        tracker.track_connection(packet, io)
+        try:
+            tracker.track_connection(event, io)
+        except Exception as e:
+            InternalLogger.get().critical("Error: " + str(e), exc_info=True)
 
-    def recalculate_checksums(self, ip_packet, ip_version):
+    def recalculate_checksums(self, packet):
         """
         Recalculate all necessary checksums
+        Only required if the header has been changed and the checksums have not been updated incrementally
 
-        :param ip_packet: IPv4 /IPv6 Packet
-        :param ip_version: IP version
-        """
-        layers = self.get_packet_layers(ip_packet)
-        if ip_version == 4:
-            # recalculate IPv4 checksum
-            del ip_packet.chksum
-            del ip_packet.len
-        for layer in layers:
-            #recalculate layer checksums
-            if isinstance(layer, _ICMPv6):
-                del layer.cksum
-            if isinstance(layer, UDP):
-                del layer.chksum
-                del layer.len
-            if isinstance(layer, TCP):
-                del layer.chksum
-
-    def get_packet_layers(self, packet):
-        """
-        Get all layers of the packet
-        :param packet: IPv4 / IPv6 Packet
-        :returns List of Protocols
-        """
-        counter = 0
-        while True:
-            layer = packet.getlayer(counter)
-            if layer is None:
-                break
-
-            yield layer
-            counter += 1
+        :param packet: IPv4 /IPv6 Packet (PacketView)
+        """
+        packet.update_checksums()
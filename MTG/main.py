@@ -1,3 +1,4 @@
+import atexit
 import json
 import sys
 from threading import Thread
@@ -12,14 +13,20 @@ from scapy.layers.inet6 import IPv6
 from InternalLogger.internallogger import InternalLogger
 from connection_tracker.dynamic_port_priority import DynamicPortPriority
 from controller.dnstranslator import DnsTranslator
+from controller.fusedtranslator import FusedTranslator
+from controller.helper.prefixindex import PrefixIndex, WHITELIST, PH_SERVER
 from controller.iptranslatornas import IPTranslatorNAS
 from controller.itranslator import IO
 from connection_tracker.nasconnectiontracker import NasConnectionTracker
-from controller.ph_function.rpahfunction import RpahFunction
+from controller.ph_function.phfunctionregistry import create_ph_function
 from controller.portcontrollerph import PortTranslatorPh
 from hfcontroller import HfController
+from hfmappingsender import HfMappingSender
 from ipcontroller import IpController
+from queueworker import QueueWorker
+from rest.hfpushstatsapi import HfPushStatsApi
 from rest.lfmappingapi import LfMappingApi
+from shared_state.sharedstatepublisher import SharedStatePublisher
 
 app = Flask(__name__)
 '''
@@ -36,6 +43,19 @@ Leaving:
 70: NasConnectionTracker
 100: PortController PH
 
+NAS and PH fused (fused_translation):
+
+Incoming:
+
+10: FusedTranslator (PH, NAS), calls an inline NasConnectionTracker between PH and NAS
+30: NasConnectionTracker (if not inline)
+
+Leaving:
+
+51: DnsTranslator
+60: FusedTranslator (NAS, PH), after the DnsTranslator (DNS answers are dissected by the port)
+70: NasConnectionTracker
+
 '''
 
 def main():
@@ -49,13 +69,95 @@ def main():
     with open('conf.json') as json_file:
         conf_data = json.load(json_file)
 
-    whitelist = conf_data["whitelist"]
     enable_file_logging = conf_data["file_logging"]
     enable_debug_output = conf_data["debug_output"]
     InternalLogger.init(enable_file_logging, enable_debug_output)
     InternalLogger.get().info("Starting...")
 
     debug_forward = conf_data["debug_forward"]
+    incremental_checksum = conf_data.get("incremental_checksum", True)
+    pipeline_conf = conf_data.get("pipeline")
+    conf_data_nas = conf_data["nas"]
+    enable_nas = conf_data_nas["activate"]
+    conf_data_queue_balance = conf_data.get("queue_balance", {"activate": False})
+
+    if conf_data_queue_balance["activate"]:
+        # One worker process per queue, the main process runs the HF Controller and the connection tracker
+        InternalLogger.get().info("Starting queue balancing")
+        controllers = build_layer_controllers(conf_data, NasConnectionTracker)
+        if controllers is None:
+            return
+        # Only the tracker and the dynamic port priority of the main process are used, packets are handled by the workers
+        (_, _, _, dynamic_port_priority, tracker) = controllers
+        try:
+            publisher = SharedStatePublisher(tracker, conf_data_queue_balance.get("shared_memory_size", 16777216),
+                                             conf_data_queue_balance.get("publish_interval", 0.05))
+        except ValueError as e:
+            InternalLogger.get().error("Error: " + str(e))
+            return
+        atexit.register(publisher.close)
+        publisher.start()
+        ip_translators = [publisher]
+        for io, (first_queue, last_queue) in [(IO.INPUT, conf_data_queue_balance["in"]),
+                                               (IO.OUTPUT, conf_data_queue_balance["out"])]:
+            for queue_num in range(first_queue, last_queue + 1):
+                worker = QueueWorker(queue_num, io, conf_data, build_layer_controllers,
+                                     publisher.snapshot_names(), publisher.event_queue)
+                worker.start()
+    else:
+        controllers = build_layer_controllers(conf_data, NasConnectionTracker)
+        if controllers is None:
+            return
+        (layer_controller_in, layer_controller_out, ip_translators, dynamic_port_priority, tracker) = controllers
+
+        incoming_data = IpController(1, layer_controller_in, debug_forward, IO.INPUT, incremental_checksum, pipeline_conf)
+        incoming_data.start()
+        leaving_data = IpController(2, layer_controller_out, debug_forward, IO.OUTPUT, incremental_checksum, pipeline_conf)
+        leaving_data.start()
+
+    if enable_nas:
+        # Start HF Controller
+        if ip_translators is None:
+            InternalLogger.get().debug("WARNING: No Translators")
+        rest_local = conf_data_nas["rest_iface"]
+        rest_port = conf_data_nas.get("rest_port", 5000)
+        gateway_id = conf_data_nas.get("gateway_id", rest_local + ":" + str(rest_port))
+        hf_receiver = HfMappingSender(conf_data_nas["receiver"], gateway_id, conf_data_nas.get("push_timeout", 2.0),
+                                      conf_data_nas.get("push_retries", 3),
+                                      sync_interval=conf_data_nas.get("sync_interval", 10),
+                                      binary=conf_data_nas.get("wire_format", "json") == "binary")
+        hopping_period = conf_data_nas["hopping_period"]
+        coalesce_window = conf_data_nas.get("coalesce_window", 0.05)
+        controller = HfController(ip_translators, hf_receiver, hopping_period, dynamic_port_priority, coalesce_window)
+        controller.set_lf_mapping(None)
+        controller.start()
+        subnetmapping_receiver = [controller]
+
+        InternalLogger.get().info("Starting rest at: " + rest_local + ":" + str(rest_port))
+
+        # Start Rest API
+        api = Api(app)
+        api.add_resource(LfMappingApi, '/v1.0/nas_mapping', endpoint='nas_mapping',
+                         resource_class_kwargs={'subnet_controller': subnetmapping_receiver})
+        api.add_resource(HfPushStatsApi, '/v1.0/nas_push_stats', endpoint='nas_push_stats',
+                         resource_class_kwargs={'hf_controller': controller})
+        Thread.start(run_flask(rest_local, rest_port))
+
+
+def build_layer_controllers(conf_data, tracker_factory):
+    """
+    Create and configure the PH/NAS layer controllers and trackers
+    (called by the main process and by every queue worker process)
+
+    :param conf_data: Configuration
+    :param tracker_factory: creates the connection tracker (IConnectionTracker, parameters inline, capacity, timeouts)
+     if tracking is enabled
+    :return: (layer_controller_in, layer_controller_out, ip_translators, dynamic_port_priority, tracker)
+     or None if the configuration is invalid
+    """
+    # whitelist, PH server subnets and virtual subnets, shared by all translators
+    prefix_index = PrefixIndex()
+    prefix_index.set_prefixes(WHITELIST, conf_data["whitelist"])
     conf_data_nas = conf_data["nas"]
     conf_data_ph = conf_data["ph"]
     enable_nas = conf_data_nas["activate"]
@@ -65,9 +167,9 @@ def main():
     layer_controller_in = {}
     ip_translators = None
     dynamic_port_priority = None
+    tracker = None
     # Enable Network Address Shuffling
     if enable_nas:
-        conf_data_nas = conf_data["nas"]
         InternalLogger.get().info("Starting NAS")
         dns_ttl = conf_data_nas["dns_ttl"]
         # Set Controllers
@@ -76,12 +178,13 @@ def main():
         conf_data_nas_tracking_honeypot = conf_data_nas["honeypot"]
         honeypot = conf_data_nas_tracking_honeypot["activate"]
 
-        tracker = None
         conf_data_nas_tracking = conf_data_nas["tracking"]
         enable_nas_track = conf_data_nas_tracking["activate"]
         if enable_nas_track:
             #Enable Tracking
-            tracker = NasConnectionTracker()
+            timeouts = dict(NasConnectionTracker.DEFAULT_TIMEOUTS, **conf_data_nas_tracking.get("timeouts", {}))
+            tracker = tracker_factory(inline=conf_data_nas_tracking.get("inline", False),
+                                      capacity=conf_data_nas_tracking.get("capacity", 1000), timeouts=timeouts)
             layer_controller_out[70] = tracker
             layer_controller_in[30] = tracker
 
@@ -92,9 +195,11 @@ def main():
             priority_def_list = conf_data_nas_tracking_priority["priority_def"]
             continue_all = conf_data_nas_tracking["continue_all"]
             dynamic_port_priority = DynamicPortPriority(continue_list, priority_list, priority_def_list, continue_all, tracker)
+            tracker.set_port_priority(dynamic_port_priority.port_priority)
+            tracker.set_port_listener(dynamic_port_priority)
 
-        ip_out = IPTranslatorNAS(None, whitelist, IO.OUTPUT, enable_nas_track, tracker, dynamic_port_priority)
-        ip_in = IPTranslatorNAS(None, whitelist, IO.INPUT, enable_nas_track, tracker, dynamic_port_priority)
+        ip_out = IPTranslatorNAS(None, prefix_index, IO.OUTPUT, enable_nas_track, tracker, dynamic_port_priority)
+        ip_in = IPTranslatorNAS(None, prefix_index, IO.INPUT, enable_nas_track, tracker, dynamic_port_priority)
 
         honeypot_v4_address = None
         honeypot_v6_address = None
@@ -102,8 +207,8 @@ def main():
             honeypot_v4_address = conf_data_nas_tracking_honeypot["v4_address"]
             honeypot_v6_address = conf_data_nas_tracking_honeypot["v6_address"]
             if honeypot_v6_address is None or honeypot_v4_address is None:
-                InternalLogger.error("Honeypot address not set")
-                return
+                InternalLogger.get().error("Honeypot address not set")
+                return None
             ip_in.set_honeypot(honeypot_v4_address, honeypot_v6_address)
             ip_out.set_honeypot(honeypot_v4_address, honeypot_v6_address)
 
@@ -123,52 +228,43 @@ def main():
         max_buffer = conf_data_ph["max_buffer"]
         hopping_period = conf_data_ph["hopping_period"]
 
-        ph_function = RpahFunction(hopping_period, max_buffer)
         keymap = conf_data_ph["keymap"]
-        subnets_server = conf_data_ph["ph_subnets_server"]
+        ph_function = create_ph_function(conf_data_ph.get("function", "rpah"), hopping_period, max_buffer, keymap,
+                                         conf_data_ph.get("acceptance_window", 1), conf_data_ph.get("service_ports", []))
+        prefix_index.set_prefixes(PH_SERVER, conf_data_ph["ph_subnets_server"])
         #tracker needs to use ph function to preserve tracking
-        # ph_function = TestPhFunction()
-        ph_out = PortTranslatorPh(ph_function, IO.OUTPUT, whitelist, enable_ph_client, keymap, subnets_server)
+        ph_out = PortTranslatorPh(ph_function, IO.OUTPUT, prefix_index, enable_ph_client, keymap)
         layer_controller_out[100] = ph_out
 
-        ph_in = PortTranslatorPh(ph_function, IO.INPUT, whitelist, enable_ph_client, keymap, subnets_server)
+        ph_in = PortTranslatorPh(ph_function, IO.INPUT, prefix_index, enable_ph_client, keymap)
         layer_controller_in[10] = ph_in
 
+        if enable_nas and conf_data.get("fused_translation", True):
+            # one stage per direction, the IPTranslatorNAS keep receiving the mapping (ip_translators)
+            InternalLogger.get().info("Fusing NAS and PH")
+            tracker_in = None
+            if tracker is not None and tracker.is_inline():
+                # tracked between PH and NAS of the fused stage
+                tracker_in = layer_controller_in.pop(30)
+            del layer_controller_in[50]
+            del layer_controller_out[50]
+            del layer_controller_out[100]
+            layer_controller_in[10] = FusedTranslator(ip_in, ph_in, prefix_index, IO.INPUT, tracker_in)
+            layer_controller_out[60] = FusedTranslator(ip_out, ph_out, prefix_index, IO.OUTPUT)
+
     if not (enable_nas or enable_ph):
         InternalLogger.get().warning("WARNING: PH and NAS not activated")
 
-    incoming_data = IpController(1, layer_controller_in, debug_forward, IO.INPUT)
-    incoming_data.start()
-    leaving_data = IpController(2, layer_controller_out, debug_forward, IO.OUTPUT)
-    leaving_data.start()
-
-    if enable_nas:
-        # Start HF Controller
-        if ip_translators is None:
-            InternalLogger.get().debug("WARNING: No Translators")
-        hf_receiver = conf_data_nas["receiver"]
-        hopping_period = conf_data_nas["hopping_period"]
-        controller = HfController(ip_translators, hf_receiver, hopping_period, dynamic_port_priority)
-        controller.set_lf_mapping(None)
-        controller.start()
-        subnetmapping_receiver = [controller]
-
-        rest_local = conf_data_nas["rest_iface"]
-        InternalLogger.get().info("Starting rest at: " + rest_local)
-
-        # Start Rest API
-        api = Api(app)
-        api.add_resource(LfMappingApi, '/v1.0/nas_mapping', endpoint='nas_mapping',
-                         resource_class_kwargs={'subnet_controller': subnetmapping_receiver})
-        Thread.start(run_flask(rest_local))
+    return layer_controller_in, layer_controller_out, ip_translators, dynamic_port_priority, tracker
 
 
-def run_flask(rest_local):
+def run_flask(rest_local, rest_port=5000):
     """
 
     :param rest_local: Local rest ip
+    :param rest_port: Local rest port
     """
-    app.run(debug=False, use_reloader=False, host=rest_local)
+    app.run(debug=False, use_reloader=False, host=rest_local, port=rest_port)
 
 
 if __name__ == "__main__":
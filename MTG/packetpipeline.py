@@ -0,0 +1,86 @@
+from collections import deque
+from threading import Thread, Condition, Lock
+
+from InternalLogger.internallogger import InternalLogger
+
+
+class PacketPipeline:
+    """
+    Fixed number of worker threads, each one fed by its own bounded ring
+
+    Items are pinned to a worker by the hash of their flow key, so the order within a flow is preserved.
+    Workers dequeue and handle the items in batches.
+    If the ring of a worker is full, submit() waits up to backpressure_timeout, then the item is rejected and counted as overload drop.
+    Items which must not be dropped are submitted with block=True (waits until the worker has space).
+
+    :param handler: function, called with a list of items (batch)
+    :param workers: number of worker threads
+    :param ring_size: maximum number of items per worker ring
+    :param batch_size: maximum number of items per batch
+    :param backpressure_timeout: time to wait for space in a full ring in seconds
+    :param name: name of the pipeline (logging)
+    """
+    def __init__(self, handler, workers, ring_size, batch_size, backpressure_timeout, name):
+        self._handler = handler
+        self._ring_size = ring_size
+        self._batch_size = batch_size
+        self._backpressure_timeout = backpressure_timeout
+        self._name = name
+        self._rings = [deque() for _ in range(workers)]
+        self._conditions = [Condition(Lock()) for _ in range(workers)]
+        self._overload_drops = 0
+        self._drop_lock = Lock()
+        for worker in range(workers):
+            Thread(target=self._run, args=(worker,), daemon=True, name=name + "-" + str(worker)).start()
+
+    @property
+    def overload_drops(self):
+        """
+        :return: number of items rejected because of full rings
+        """
+        return self._overload_drops
+
+    def submit(self, flow_key, item, block=False):
+        """
+        Add an item to the ring of the worker responsible for the flow
+
+        :param flow_key: hashable flow identifier (e.g. 5-tuple)
+        :param item: item for the handler
+        :param block: wait for space without timeout (the item is never rejected)
+        :return: False if the item has been rejected (overload)
+        """
+        worker = hash(flow_key) % len(self._rings)
+        ring = self._rings[worker]
+        condition = self._conditions[worker]
+        with condition:
+            if len(ring) >= self._ring_size:
+                # backpressure: wait for the worker to catch up
+                condition.wait_for(lambda: len(ring) < self._ring_size, None if block else self._backpressure_timeout)
+                if len(ring) >= self._ring_size:
+                    with self._drop_lock:
+                        self._overload_drops += 1
+                    InternalLogger.get().debug(self._name + ": ring " + str(worker) + " full, overload drops = "
+                                               + str(self._overload_drops))
+                    return False
+            ring.append(item)
+            condition.notify_all()
+        return True
+
+    def _run(self, worker):
+        """
+        Worker loop, handle batches of the ring
+
+        :param worker: index of the worker
+        """
+        ring = self._rings[worker]
+        condition = self._conditions[worker]
+        while True:
+            with condition:
+                condition.wait_for(lambda: len(ring) > 0)
+                batch = [ring.popleft() for _ in range(min(len(ring), self._batch_size))]
+                # wake up a waiting producer
+                condition.notify_all()
+            try:
+                self._handler(batch)
+            except Exception as e:
+                InternalLogger.get().critical("Error: " + str(e), exc_info=True)
@@ -0,0 +1,62 @@
+from multiprocessing import Process
+
+from InternalLogger.internallogger import InternalLogger
+from connection_tracker.sharedconnectiontracker import SharedConnectionTracker
+from controller.itranslator import IO
+from ipcontroller import IpController
+from shared_state.sharedstatesubscriber import SharedStateSubscriber
+
+
+class QueueWorker(Process):
+    """
+    Worker process for one NFQUEUE (queue balancing, iptables --queue-balance)
+    Every worker creates its own layer controllers, the state of the main process is loaded from shared memory
+
+    :param queue_num: Number of the IpTables Queue for this worker
+    :param io: Input or Output
+    :param conf_data: Configuration
+    :param build_layer_controllers: function to create the layer controllers (see main.py)
+    :param snapshot_names: names of the shared memory snapshots (SharedStatePublisher)
+    :param event_queue: queue for tracking events to the main process
+    """
+    def __init__(self, queue_num, io, conf_data, build_layer_controllers, snapshot_names, event_queue):
+        Process.__init__(self, daemon=True)
+        self._queue_num = queue_num
+        self._io = io
+        self._conf_data = conf_data
+        self._build_layer_controllers = build_layer_controllers
+        self._snapshot_names = snapshot_names
+        self._event_queue = event_queue
+
+    def run(self):
+        """
+        Create layer controllers and process packets of the queue
+        """
+        conf_data = self._conf_data
+        if InternalLogger.logger is None:
+            # not inherited from the main process
+            InternalLogger.init(conf_data["file_logging"], conf_data["debug_output"])
+        InternalLogger.get().info("Starting worker, queue_num=" + str(self._queue_num))
+        controllers = self._build_layer_controllers(conf_data, self._create_tracker)
+        if controllers is None:
+            return
+        (layer_controller_in, layer_controller_out, ip_translators, dynamic_port_priority, tracker) = controllers
+
+        poll_interval = conf_data["queue_balance"].get("publish_interval", 0.05)
+        subscriber = SharedStateSubscriber(self._snapshot_names, ip_translators or [], tracker, poll_interval)
+        subscriber.refresh()
+        subscriber.start()
+
+        layer_controller = layer_controller_in if self._io == IO.INPUT else layer_controller_out
+        ip_controller = IpController(self._queue_num, layer_controller, conf_data["debug_forward"], self._io,
+                                     conf_data.get("incremental_checksum", True), conf_data.get("pipeline"))
+        ip_controller.run()
+
+    def _create_tracker(self, inline=False, capacity=1000, timeouts=None):
+        """
+        :param inline: track connections synchronously on the packet threads
+        :param capacity: maximum number of tracked connections
+        :param timeouts: idle timeouts per state in seconds
+        :return: tracker of this worker
+        """
+        return SharedConnectionTracker(self._queue_num, self._event_queue, inline, capacity, timeouts)
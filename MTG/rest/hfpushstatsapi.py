@@ -0,0 +1,21 @@
+from flask_restful import Resource
+
+from InternalLogger.internallogger import InternalLogger
+
+
+class HfPushStatsApi(Resource):
+    """
+        REST API
+        Monitoring: statistics of the HF mapping push to other gateways (per receiver)
+    """
+    def __init__(self, hf_controller):
+        self._hf_controller = hf_controller
+
+    def get(self):
+        """
+        HTTP Get Request
+        :return: url: {sent, failed, skipped (versions replaced by a newer one before they were sent), conflicts,
+         resyncs, version (acknowledged by the receiver), latency_last, latency_avg, latency_max (seconds)}
+        """
+        InternalLogger.get().debug("Push statistics requested")
+        return self._hf_controller.get_push_stats()
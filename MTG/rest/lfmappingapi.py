@@ -4,6 +4,7 @@ from flask_restful import Resource
 from flask import request
 
 from InternalLogger.internallogger import InternalLogger
+from rest import mappingcodec
 
 
 class LfMappingApi(Resource):
@@ -18,17 +19,31 @@ class LfMappingApi(Resource):
     def put(self):
         """
         HTTP Put Request
+        JSON or binary (Content-Type mappingcodec.CONTENT_TYPE)
+
+        :return: None (LF mapping), response of the HF sync (hfsync) or (error, HTTP status): 400 invalid data,
+         500 error while applying the data
         """
         try:
             InternalLogger.get().debug("Received mapping")
-            #Check for json errors
-            data = request.json
+            if request.mimetype == mappingcodec.CONTENT_TYPE:
+                data = mappingcodec.decode(request.get_data())
+            else:
+                #invalid JSON: None
+                data = request.get_json(silent=True)
             if data is None:
                 InternalLogger.get().debug("Error: No JSON Data")
-                return
+                return {"error": "No JSON Data"}, 400
             if type(data) is not dict:
                 InternalLogger.get().debug("Error: No Dictionary")
-                return
+                return {"error": "No Dictionary"}, 400
+            #Versioned HF Data of other gateway
+            if data.get("gateway") is not None:
+                InternalLogger.get().debug("-> hf sync received")
+                response = None
+                for controller in self._subnet_controller:
+                    response = controller.sync_hf_mapping(data)
+                return response
             #Receive LF Data
             lf = data.get("lf")
             if lf is not None:
@@ -51,11 +66,15 @@ class LfMappingApi(Resource):
             if lf_subnet is not None:
                 for controller in self._subnet_controller:
                     controller.set_hf_subnet(lf_subnet)
-
-
-        except Exception as e:
+        except (KeyError, TypeError, ValueError) as e:
+            #missing fields or invalid addresses, the sender must not acknowledge the data
             InternalLogger.get().debug("Error: " + str(e))
             InternalLogger.get().debug(traceback.format_exc())
+            return {"error": "Invalid data: " + str(e)}, 400
+        except Exception as e:
+            InternalLogger.get().error("Error: " + str(e))
+            InternalLogger.get().debug(traceback.format_exc())
+            return {"error": str(e)}, 500
 
 
     def get(self):
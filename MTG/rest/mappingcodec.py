@@ -0,0 +1,173 @@
+"""
+Binary format of the mapping messages (LF mapping of the MT Controller, HF mappings of other gateways)
+
+Used instead of JSON if the Content-Type of the request is CONTENT_TYPE. Addresses are packed (see
+controller.helper.address), records of a section have a fixed length, so large IPv6 mappings are smaller
+and are converted without parsing the textual addresses.
+
+    message := MAGIC section*
+    section := type (uint8) first length (uint8) second length (uint8) count (uint32, network byte order) record*
+    record  := first packed address [prefix length (uint8)] second packed address [prefix length (uint8)]
+
+The lengths are the address lengths of the records (4 or 16, 0 if the record has no second address),
+the entries of a mapping are split in several sections if the address families differ.
+
+Sections (records):
+    META            JSON object of the other keys (gateway, instance, version, ...), count is the length in bytes
+    LF              rIP, subnet (with prefix length)
+    HF_ADDED        vIP, rIP
+    HF_REVOKED      vIP, rIP
+    HF_BUCKETS      vIP, rIP
+    VIRTUAL_SUBNETS subnet (with prefix length)
+"""
+import json
+import socket
+import struct
+
+from controller.helper.address import pack
+
+CONTENT_TYPE = "application/vnd.openmtd.mapping"
+
+MAGIC = b"MTM\x02"
+
+META = 0
+LF = 1
+HF_ADDED = 2
+HF_REVOKED = 3
+HF_BUCKETS = 4
+VIRTUAL_SUBNETS = 5
+
+# key: section of address pairs
+_MAPPING_SECTIONS = {"lf": LF, "hf_added": HF_ADDED, "hf_revoked": HF_REVOKED, "hf_buckets": HF_BUCKETS}
+_SECTION_KEYS = {section: key for key, section in _MAPPING_SECTIONS.items()}
+_SECTION_KEYS[VIRTUAL_SUBNETS] = "virtual_subnets"
+
+_SECTION_HEADER = struct.Struct("!BBBI")
+_FAMILY = {4: socket.AF_INET, 16: socket.AF_INET6}
+
+
+def encode(message):
+    """
+    :param message: Dictionary (keys of the JSON message)
+    :return: binary message (bytes)
+    """
+    data = bytearray(MAGIC)
+    meta = {}
+    for key, value in message.items():
+        if value is None:
+            continue
+        section = _MAPPING_SECTIONS.get(key)
+        if section == LF:
+            _write_section(data, LF, [(pack(r_ip), _pack_subnet(subnet)) for r_ip, subnet in value.items()])
+        elif section is not None:
+            _write_section(data, section, [(pack(v_ip), pack(r_ip)) for v_ip, r_ip in value.items()])
+        elif key == "virtual_subnets":
+            _write_section(data, VIRTUAL_SUBNETS, [(_pack_subnet(subnet), b"") for subnet in value])
+        else:
+            meta[key] = value
+    if meta:
+        meta_data = json.dumps(meta).encode()
+        data += _SECTION_HEADER.pack(META, 0, 0, len(meta_data))
+        data += meta_data
+    return bytes(data)
+
+
+def decode(data):
+    """
+    :param data: binary message (bytes)
+    :return: Dictionary (same keys and values as the JSON message, canonical textual addresses)
+    :raises ValueError: invalid message
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("Invalid mapping message")
+    view = memoryview(data)
+    offset = len(MAGIC)
+    message = {}
+    while offset < len(view):
+        if offset + _SECTION_HEADER.size > len(view):
+            raise ValueError("Truncated mapping message")
+        (section, first_length, second_length, count) = _SECTION_HEADER.unpack_from(view, offset)
+        offset += _SECTION_HEADER.size
+        if section == META:
+            if offset + count > len(view):
+                raise ValueError("Truncated mapping message")
+            message.update(json.loads(bytes(view[offset:offset + count])))
+            offset += count
+            continue
+        if section not in _SECTION_KEYS:
+            raise ValueError("Unknown section " + str(section))
+        first_family = _FAMILY.get(first_length)
+        second_family = _FAMILY.get(second_length)
+        if first_family is None or (second_family is None and section != VIRTUAL_SUBNETS):
+            raise ValueError("Invalid address length")
+        if section == LF:
+            record_length = first_length + second_length + 1
+            first = _read_addresses(view, offset, count, first_family, first_length, record_length)
+            second = _read_subnets(view, offset + first_length, count, second_family, second_length, record_length)
+        elif section == VIRTUAL_SUBNETS:
+            record_length = first_length + 1
+            first = _read_subnets(view, offset, count, first_family, first_length, record_length)
+            second = None
+        else:
+            record_length = first_length + second_length
+            first = _read_addresses(view, offset, count, first_family, first_length, record_length)
+            second = _read_addresses(view, offset + first_length, count, second_family, second_length, record_length)
+        offset += count * record_length
+        key = _SECTION_KEYS[section]
+        if second is None:
+            message.setdefault(key, []).extend(first)
+        else:
+            message.setdefault(key, {}).update(zip(first, second))
+    return message
+
+
+def _pack_subnet(subnet):
+    """
+    :return: packed address and prefix length (bytes)
+    """
+    (address, _, prefix_length) = subnet.partition("/")
+    address = pack(address)
+    return address + bytes((int(prefix_length) if prefix_length else 8 * len(address),))
+
+
+def _write_section(data, section, records):
+    """
+    Write the records in one section per combination of address lengths
+
+    :param records: List of (first, second) packed addresses (subnets with prefix length)
+    """
+    groups = {}
+    for first, second in records:
+        groups.setdefault((len(first), len(second)), []).append(first + second)
+    if not groups:
+        # empty section, the key is kept
+        groups[(5, 0) if section == VIRTUAL_SUBNETS else (4, 5) if section == LF else (4, 4)] = []
+    for (first_length, second_length), group in groups.items():
+        if section == LF:
+            second_length -= 1
+        if section == VIRTUAL_SUBNETS:
+            first_length -= 1
+        data += _SECTION_HEADER.pack(section, first_length, second_length, len(group))
+        data += b"".join(group)
+
+
+def _read_addresses(view, offset, count, family, length, record_length):
+    """
+    :return: List of textual addresses (every record_length bytes, starting at offset)
+    """
+    end = offset + count * record_length
+    if end - record_length + length > len(view):
+        raise ValueError("Truncated mapping message")
+    ntop = socket.inet_ntop
+    return [ntop(family, view[i:i + length]) for i in range(offset, end, record_length)]
+
+
+def _read_subnets(view, offset, count, family, length, record_length):
+    """
+    :return: List of textual subnets (address / prefix length)
+    """
+    end = offset + count * record_length
+    if end - record_length + length + 1 > len(view):
+        raise ValueError("Truncated mapping message")
+    ntop = socket.inet_ntop
+    return [ntop(family, view[i:i + length]) + "/" + str(view[i + length]) for i in range(offset, end, record_length)]
@@ -0,0 +1,84 @@
+import pickle
+import struct
+import time
+from multiprocessing import shared_memory
+
+
+class SharedSnapshot:
+    """
+    Snapshot of a (picklable) object in shared memory, versioned by an epoch counter
+
+    One process publishes, any number of processes read. The epoch is used as sequence lock:
+    it is odd while a new snapshot is written and even afterwards, readers retry if it has changed while reading.
+
+    :param size: size of the shared memory block in bytes (only used to create it)
+    :param name: name of an existing shared memory block, create a new one if None
+    """
+    _HEADER = struct.Struct("QQ")  # epoch, length of the pickled snapshot
+
+    def __init__(self, size=None, name=None):
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+            self._HEADER.pack_into(self._shm.buf, 0, 0, 0)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+
+    @property
+    def name(self):
+        """
+        :return: name of the shared memory block (used to attach in other processes)
+        """
+        return self._shm.name
+
+    def epoch(self):
+        """
+        Cheap check for new snapshots
+
+        :return: epoch of the current snapshot (0 = nothing published)
+        """
+        return self._HEADER.unpack_from(self._shm.buf, 0)[0]
+
+    def publish(self, obj):
+        """
+        Publish a new snapshot (single writer, callers have to synchronize)
+
+        :param obj: picklable object
+        :return: new epoch
+        """
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        if self._HEADER.size + len(data) > self._shm.size:
+            raise ValueError("Snapshot too large for shared memory (" + str(len(data)) + " bytes)")
+        epoch = self.epoch()
+        # odd epoch: write in progress
+        self._HEADER.pack_into(self._shm.buf, 0, epoch + 1, 0)
+        self._shm.buf[self._HEADER.size:self._HEADER.size + len(data)] = data
+        self._HEADER.pack_into(self._shm.buf, 0, epoch + 2, len(data))
+        return epoch + 2
+
+    def read(self):
+        """
+        Read the current snapshot
+
+        :return: (epoch, object) or (0, None) if nothing has been published
+        """
+        while True:
+            (epoch, length) = self._HEADER.unpack_from(self._shm.buf, 0)
+            if epoch & 1:
+                # writer active
+                time.sleep(0)
+                continue
+            if epoch == 0:
+                return 0, None
+            data = bytes(self._shm.buf[self._HEADER.size:self._HEADER.size + length])
+            if self.epoch() == epoch:
+                return epoch, pickle.loads(data)
+
+    def close(self, unlink=False):
+        """
+        Detach from the shared memory block
+
+        :param unlink: destroy the block (only the creator should do this)
+        """
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
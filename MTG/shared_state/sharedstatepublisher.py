@@ -0,0 +1,194 @@
+import multiprocessing
+import os
+import pickle
+import queue
+from threading import Thread, Lock
+
+from InternalLogger.internallogger import InternalLogger
+from shared_state.sharedsnapshot import SharedSnapshot
+
+
+class SharedStatePublisher(Thread):
+    """
+    Publishes the state of the main process to the queue worker processes (queue balancing)
+
+    NAS state (HF mapping, virtual subnets) is published whenever it changes, it is used like a translator by the HfController.
+    Tracking events of the workers are applied to the NasConnectionTracker of the main process.
+    Its connections are published as a snapshot (generation) at the start, afterwards only the changed connections
+    are published regularly (publish_interval): every publication contains all changes since the snapshot
+    (latest value per connection and the number of the publication which changed it), so a worker which missed
+    publications is still complete. If the changes exceed a quarter of the capacity, a new snapshot is published.
+
+    :param tracker: NasConnectionTracker of the main process or None
+    :param shared_memory_size: size of each shared memory block
+    :param publish_interval: interval to publish tracked connections in seconds
+    :raises ValueError: the shared memory blocks are too small for the connections of the tracker (capacity)
+    """
+    def __init__(self, tracker, shared_memory_size, publish_interval):
+        Thread.__init__(self, daemon=True)
+        self._tracker = tracker
+        self._publish_interval = publish_interval
+        self._max_changes = 0
+        if tracker is not None:
+            capacity = tracker.memory_usage()["capacity"]
+            required = _snapshot_size(capacity)
+            if required > shared_memory_size:
+                raise ValueError("shared_memory_size " + str(shared_memory_size) + " is too small for "
+                                 + str(capacity) + " tracked connections (about " + str(required) + " bytes)")
+            self._max_changes = max(256, capacity // 4)
+            tracker.record_changes()
+        self._nas_snapshot = SharedSnapshot(size=shared_memory_size)
+        self._tracker_snapshot = SharedSnapshot(size=shared_memory_size)
+        self._changes_snapshot = SharedSnapshot(size=shared_memory_size)
+        self._event_queue = multiprocessing.Queue()
+        self._mapping = None
+        self._virtual_subnets = None
+        self._applied = {}
+        # generation of the published snapshot, number of the last publication of changes
+        self._generation = 0
+        self._publication = 0
+        # key: (publication, connection or None) changes since the snapshot
+        self._changes = {}
+        self._lock = Lock()
+
+    @property
+    def event_queue(self):
+        """
+        :return: queue for tracking events of the workers
+        """
+        return self._event_queue
+
+    def snapshot_names(self):
+        """
+        :return: (name of the NAS snapshot, name of the tracker snapshot, name of the tracker changes)
+        """
+        return self._nas_snapshot.name, self._tracker_snapshot.name, self._changes_snapshot.name
+
+    def set_mapping(self, mapping):
+        """
+        Publish new HF mapping (called by the HfController)
+        :param mapping: total HF mapping (MappingSnapshot), the workers load the snapshot as it is
+        """
+        if self._tracker is not None:
+            self._tracker.set_mapping(mapping.forward)
+        with self._lock:
+            self._mapping = mapping
+            self._publish_nas()
+
+    def set_virtual_subnets(self, v_subnets):
+        """
+        Publish new virtual subnets (called by the HfController)
+        :param v_subnets: List of subnets
+        """
+        with self._lock:
+            self._virtual_subnets = v_subnets
+            self._publish_nas()
+
+    def _publish_nas(self):
+        try:
+            epoch = self._nas_snapshot.publish({"mapping": self._mapping, "virtual_subnets": self._virtual_subnets})
+            InternalLogger.get().debug("Published NAS state, epoch " + str(epoch))
+        except ValueError as e:
+            InternalLogger.get().error("Error: " + str(e))
+
+    def run(self):
+        """
+        Apply tracking events of the workers and publish the changed connections
+        """
+        if self._tracker is not None:
+            self._publish_connections()
+        while True:
+            try:
+                applied = self._apply_events()
+                if self._tracker is not None:
+                    self._publish_changes(applied)
+            except Exception as e:
+                InternalLogger.get().error("Error: " + str(e), exc_info=True)
+
+    def _publish_changes(self, applied):
+        """
+        Publish the changes since the snapshot (if connections have changed or events have been applied)
+
+        :param applied: events have been applied
+        """
+        changes = self._tracker.get_changes()
+        if not (changes or applied):
+            return
+        self._publication += 1
+        for key, value in changes.items():
+            self._changes[key] = (self._publication, value)
+        if len(self._changes) > self._max_changes:
+            self._publish_connections()
+            return
+        try:
+            epoch = self._changes_snapshot.publish({"generation": self._generation, "changes": self._changes,
+                                                    "applied": dict(self._applied)})
+        except ValueError as e:
+            InternalLogger.get().warning("Changes not published (" + str(e) + "), publishing all connections")
+            self._publish_connections()
+            return
+        InternalLogger.get().debug("Published " + str(len(self._changes)) + " changed connections, epoch "
+                                   + str(epoch))
+
+    def _publish_connections(self):
+        """
+        Publish all connections as new snapshot (generation), the changes start again
+        """
+        self._tracker.get_changes()
+        self._generation += 1
+        self._changes = {}
+        state = {"generation": self._generation, "applied": dict(self._applied)}
+        try:
+            epoch = self._tracker_snapshot.publish(dict(state, connections=self._tracker.get_connections()))
+        except ValueError as e:
+            InternalLogger.get().critical("Error: tracked connections can not be published to the workers ("
+                                          + str(e) + "), increase shared_memory_size")
+            return
+        self._changes_snapshot.publish(dict(state, changes={}))
+        InternalLogger.get().debug("Published connections, generation " + str(self._generation) + ", epoch "
+                                   + str(epoch))
+
+    def _apply_events(self):
+        """
+        Apply all events received within one publish interval
+
+        :return: events applied?
+        """
+        try:
+            event = self._event_queue.get(timeout=self._publish_interval)
+        except queue.Empty:
+            return False
+        while event is not None:
+            self._apply_event(event)
+            try:
+                event = self._event_queue.get_nowait()
+            except queue.Empty:
+                event = None
+        return True
+
+    def _apply_event(self, event):
+        (kind, worker_id, seq, *data) = event
+        if self._tracker is not None:
+            if kind == "track":
+                (io, event) = data
+                self._tracker.track_connection(event, io)
+            elif kind == "add":
+                self._tracker.add_connection(*data[0])
+        self._applied[worker_id] = seq
+
+    def close(self):
+        """
+        Destroy the shared memory blocks
+        """
+        self._nas_snapshot.close(unlink=True)
+        self._tracker_snapshot.close(unlink=True)
+        self._changes_snapshot.close(unlink=True)
+
+
+def _snapshot_size(capacity):
+    """
+    :param capacity: capacity of the tracker
+    :return: size of a snapshot of a full tracker in bytes (IPv6 connections, estimated by a sample)
+    """
+    sample = [((os.urandom(16), 65535, os.urandom(16), 65535), (True, os.urandom(16), True)) for _ in range(64)]
+    return -(-len(pickle.dumps(sample, protocol=pickle.HIGHEST_PROTOCOL)) * capacity // len(sample)) + 65536
@@ -0,0 +1,60 @@
+import time
+from threading import Thread
+
+from InternalLogger.internallogger import InternalLogger
+from shared_state.sharedsnapshot import SharedSnapshot
+
+
+class SharedStateSubscriber(Thread):
+    """
+    Loads the state published by the main process (SharedStatePublisher) in a queue worker process
+
+    The epochs of the snapshots are checked regularly, new snapshots are forwarded to the translators and the tracker.
+
+    :param snapshot_names: (name of the NAS snapshot, name of the tracker snapshot, name of the tracker changes)
+    :param translators: translators of this worker (set_mapping, set_virtual_subnets)
+    :param tracker: SharedConnectionTracker of this worker or None
+    :param poll_interval: interval to check the epochs in seconds
+    """
+    def __init__(self, snapshot_names, translators, tracker, poll_interval):
+        Thread.__init__(self, daemon=True)
+        (nas_name, tracker_name, changes_name) = snapshot_names
+        self._nas_snapshot = SharedSnapshot(name=nas_name)
+        self._tracker_snapshot = SharedSnapshot(name=tracker_name)
+        self._changes_snapshot = SharedSnapshot(name=changes_name)
+        self._translators = translators
+        self._tracker = tracker
+        self._poll_interval = poll_interval
+        self._nas_epoch = 0
+        self._tracker_epoch = 0
+        self._changes_epoch = 0
+
+    def run(self):
+        """
+        Poll the snapshots
+        """
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                InternalLogger.get().error("Error: " + str(e), exc_info=True)
+            time.sleep(self._poll_interval)
+
+    def refresh(self):
+        """
+        Load new snapshots (if the epoch has changed)
+        """
+        if self._nas_snapshot.epoch() != self._nas_epoch:
+            (self._nas_epoch, state) = self._nas_snapshot.read()
+            InternalLogger.get().debug("Loading NAS state, epoch " + str(self._nas_epoch))
+            for translator in self._translators:
+                translator.set_mapping(state["mapping"])
+                translator.set_virtual_subnets(state["virtual_subnets"])
+        if self._tracker is not None and self._tracker_snapshot.epoch() != self._tracker_epoch:
+            (self._tracker_epoch, state) = self._tracker_snapshot.read()
+            self._tracker.apply_snapshot(state)
+        if self._tracker is not None and self._changes_snapshot.epoch() != self._changes_epoch:
+            (epoch, changes) = self._changes_snapshot.read()
+            # changes of a newer snapshot are read again after the snapshot has been loaded
+            if self._tracker.apply_changes(changes):
+                self._changes_epoch = epoch